@@ -1,110 +1,203 @@
 'use client'
-import email,ssl
-
 from bson import ObjectId
 from providers import PROVIDERS
-from flask import Flask, jsonify, request
+from serialization import respond
+from ratelimit import rate_limited
+from pagination import (InvalidCursor, decode_cursor, decode_token, encode_cursor, encode_token, keyset_condition,
+                        keyset_page, keyset_query, newest_cursor, parse_limit)
+from indexes import ensure_indexes
+from cache import make_cache
+import archive
+import attachments
+import group_inbox
+import read_state
+import database
+import memberships
+import metrics
+import otp_store
+import presence
+import ratelimit
+import search
+import serialization
+import summaries
+from pubsub import get_broker, group_channel, user_channel
+from tenancy import TENANT_FIELD, scope
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime, timedelta
-from pymongo import MongoClient
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
 from dotenv import load_dotenv
 import os
 import pytz
-import random
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import threading
 
 app = Flask(__name__)
 CORS(app)
-load_dotenv()
+# Behind N reverse proxies (e.g. Vercel's edge), take the client address from X-Forwarded-For for rate limiting
+if int(os.getenv('PROXY_COUNT', 0)):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('PROXY_COUNT')))
+metrics.instrument(app)  # Per-route latency, payload size and DB command counts, see /metrics
+serialization.install(app)  # ObjectId-aware fast JSON, optional MessagePack and gzip/br, see serialization.py
+if not os.getenv('VERCEL'):  # Vercel injects the environment; skip the .env file search on cold starts
+    load_dotenv()
 
 # Email settings
 EMAIL_ADDRESS = os.getenv('EMAIL_USER')  # Your email from environment variable
 EMAIL_PASSWORD = os.getenv('EMAIL_PASS')  # Your email password from environment variable
 
-# Get the MongoDB URI from the environment variable
-mongo_uri = os.getenv('MONGO_URI')
-# MongoDB setup
-client = MongoClient(mongo_uri)
-db = client.InOfficeMessaging
-users_collection = db.users
-messages_collection=db.messages
-groups_collection = db.groups
-group_messages_collection = db.group_messages
-
-def send_sms_via_email(
-    number: str,
-    message: str,
-    provider: str,
-    sender_credentials: tuple,
-    subject: str = "NVision InOffice Messaging",
-    smtp_server: str = "smtp.gmail.com",
-    smtp_port: int = 465,
-):
-    sender_email, email_password = sender_credentials
-    receiver_email = f'{number}@{PROVIDERS.get(provider).get("sms")}'
-
-    email_message = f"Subject:{subject}\nTo:{receiver_email}\n{message}"
-     # Send the message via an SSL connection
-    try:
-
-        with smtplib.SMTP_SSL(
-            smtp_server, smtp_port, context=ssl.create_default_context()
-        ) as email:
-            email.login(sender_email, email_password)
-            email.sendmail(sender_email, receiver_email, email_message)
-        return True
-    except Exception as e:
-        print(f"Failed to send email: {e}")
-        return False
+# MongoDB setup; the client (MONGO_URI, pool settings) is created on first use, see database.py.
+# Message, group and membership collections hold every company's data; routes use them through
+# tenancy.scope(collection, company) so each query stays inside one company, see tenancy.py
+db = database.LazyDatabase()
+users_collection = database.LazyCollection('users')
+messages_collection = database.LazyCollection('messages')
+groups_collection = database.LazyCollection('groups')
+group_members_collection = database.LazyCollection('group_members')  # One document per (group, member), see memberships.py
+group_messages_collection = database.LazyCollection('group_messages')
+conversations_collection = database.LazyCollection('conversations')  # Per-user inbox summaries, see summaries.py
+read_cursors_collection = database.LazyCollection('read_cursors')  # Per-user group read marks, see read_state.py
+group_inbox_collection = database.LazyCollection('group_inbox')  # Per-member entries for small groups, see group_inbox.py
+otps_collection = database.LazyCollection('otps')  # Pending signup codes with TTL expiry, see otp_store.py
+otp_deliveries_collection = database.LazyCollection('otp_deliveries')  # Latest OTP email per address, see mailer.py
+sms_jobs_collection = database.LazyCollection('sms_jobs')  # SMS jobs with per-recipient status, see mailer.py
+attachment_files_collection = database.LazyCollection('attachments.files')  # GridFS file documents, see attachments.py
+attachment_aliases_collection = database.LazyCollection('attachment_aliases')  # Re-uploads of stored files
+# Messages older than ARCHIVE_AFTER_DAYS live in compressed buckets; reads fall back to them, see archive.py
+message_tier = archive.message_tier(messages_collection, database.LazyCollection('message_archive'))
+group_message_tier = archive.group_message_tier(group_messages_collection,
+                                                database.LazyCollection('group_message_archive'))
+
+# Fields returned for messages; the JSON provider encodes their ObjectIds and dates directly
+MESSAGE_FIELDS = {'sender': 1, 'receiver': 1, 'message': 1, 'timestamp': 1, 'isRead': 1, 'readAt': 1, 'attachments': 1}
+GROUP_MESSAGE_FIELDS = {'group_id': 1, 'sender': 1, 'message': 1, 'timestamp': 1, 'attachments': 1}
+
+# Create missing indexes on startup when asked to (otherwise run `python indexes.py`)
+if os.getenv('ENSURE_INDEXES') == '1':
+    ensure_indexes(db)
+
+# Open the MongoDB connection in the background while the first request is parsed
+if os.getenv('MONGO_WARM_UP') == '1':
+    database.warm_up(background=True)
+
+# Read-through caches for hot lookups; routes that change these documents invalidate them
+user_cache = make_cache('user_by_email')
+group_cache = make_cache('group_by_id')
+member_groups_cache = make_cache('groups_by_member')
+
+def get_user(email):
+    """Return the user document (without _id) for an email, cached."""
+    return user_cache.get_or_load(email, lambda: users_collection.find_one({'email': email}, {'_id': 0}))
+
+def get_group(group_id):
+    """Return the group document for an id, cached."""
+    return group_cache.get_or_load(str(group_id), lambda: groups_collection.find_one({'_id': ObjectId(group_id)}))
+
+def get_member_groups(email):
+    """Return [{'_id', 'group_name', 'fanout', 'company_name'}] for every group the user belongs to, cached."""
+    def load():
+        group_ids = memberships.member_group_ids(scope(group_members_collection, get_company(email)), email)
+        if not group_ids:
+            return []
+        return list(groups_collection.find({'_id': {'$in': group_ids}},
+                                           {'_id': 1, 'group_name': 1, 'fanout': 1, TENANT_FIELD: 1}))
+    return member_groups_cache.get_or_load(email, load)
+
+def get_company(email):
+    """The company a user belongs to, or None for an unregistered email."""
+    user = get_user(email)
+    return user.get('company_name') if user else None
+
+def conversation_company(a, b):
+    """The company a direct conversation is stored under: its participants', or the registered one's."""
+    return get_company(a) or get_company(b)
+
+def other_company_members(members, company):
+    """The registered users among members who belong to a company other than company."""
+    return [user['email'] for user in users_collection.find(
+        {'email': {'$in': list(members)}, 'company_name': {'$ne': company}}, {'_id': 0, 'email': 1})]
+
+# SMS-over-email delivery shares pooled SMTP connections; job status lives in sms_jobs
+SMS_SENDER_CREDENTIALS = (
+    os.getenv('SMS_EMAIL_USER', "nvisionwebsiterequest@gmail.com"),
+    os.getenv('SMS_EMAIL_PASS', "zuek mepr tfel opvg"),
+)
+_mail_lock = threading.Lock()
+_sms_queue = None
+_otp_dispatcher = None
+
+# The SMTP machinery (smtplib, ssl, email) is only imported by the routes that send mail
+def get_sms_queue():
+    global _sms_queue
+    with _mail_lock:
+        if _sms_queue is None:
+            from mailer import SMS_SMTP_PORT, SMTP_HOST, SMTP_USE_TLS, SMSDeliveryQueue, SMTPPool
+            _sms_queue = SMSDeliveryQueue(
+                SMTPPool(SMTP_HOST, SMS_SMTP_PORT, SMS_SENDER_CREDENTIALS, use_ssl=SMTP_USE_TLS, name='sms'),
+                SMS_SENDER_CREDENTIALS[0],
+                sms_jobs_collection,
+            )
+    return _sms_queue
 
 # Flask route to trigger SMS sending
 @app.route('/send_sms', methods=['POST'])
+@rate_limited('send_sms')
 def send_sms():
     data = request.json
     numbers = data.get("numbers", [])
     message = data.get("message", "No message provided")
     provider = data.get("provider", "AT&T")  # Default to AT&T
-    sender_credentials = ("nvisionwebsiterequest@gmail.com", "zuek mepr tfel opvg")
-
-    # Send SMS to each number
-    for number in numbers:
-        success = send_sms_via_email(number, message, provider, sender_credentials)
-        if not success:
-            return jsonify({"error": f"Failed to send SMS to {number}"}), 500
 
-    return jsonify({"status": "SMS sent successfully"}), 200
+    if provider not in PROVIDERS:
+        return jsonify({"error": f"Unknown provider {provider}"}), 400
+    if not numbers:
+        return jsonify({"error": "At least one number is required."}), 400
+
+    # Queue the sends and return straight away; progress is available from /sms_status
+    job_id = get_sms_queue().submit(numbers, message, provider)
+    return jsonify({"status": "SMS queued", "job_id": job_id}), 202
+
+@app.route('/sms_status/<job_id>', methods=['GET'])
+def sms_status(job_id):
+    job = get_sms_queue().status(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job), 200
+
+# OTP emails go out from a background thread over one reused, logged-in SMTP session
+def get_otp_dispatcher():
+    global _otp_dispatcher
+    with _mail_lock:
+        if _otp_dispatcher is None:
+            from mailer import OTP_SMTP_PORT, SMTP_HOST, SMTP_USE_TLS, OTPDispatcher, SMTPPool
+            _otp_dispatcher = OTPDispatcher(
+                SMTPPool(SMTP_HOST, OTP_SMTP_PORT, (EMAIL_ADDRESS, EMAIL_PASSWORD), starttls=SMTP_USE_TLS,
+                         size=1, name='otp'),
+                EMAIL_ADDRESS,
+                otp_deliveries_collection,
+            )
+    return _otp_dispatcher
 
-def send_otp_email(email, otp):
-    try:
-        subject = "Your OTP for InOfficeMessaging"
-        body = f"Your OTP is {otp} "
+def is_unverified(user):
+    """Users stay unverified until they confirm their signup code ('otp' is the pre-OTP-store field)."""
+    if 'verified' in user:
+        return not user['verified']
+    return 'otp' in user
 
-        # Set up the MIME
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_ADDRESS
-        msg['To'] = email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
+def send_signup_code(email):
+    """Issue a fresh code (replacing any earlier one) and email it in the background, see /otp_status."""
+    get_otp_dispatcher().dispatch(email, otp_store.issue(otps_collection, email))
 
-        # Connect to Gmail's SMTP server
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(EMAIL_ADDRESS, email, text)
-        server.quit()
+# Seconds between SSE keep-alive comments on idle push connections
+PUSH_KEEPALIVE = float(os.getenv('PUSH_KEEPALIVE', 15))
 
-        print("OTP sent successfully.")
-        return True
-    except Exception as e:
-        print(f"Failed to send OTP: {e}")
-        return False
-
-def generate_otp():
-    """Generate a 6-digit OTP code."""
-    return random.randint(100000, 999999)
+def publish_message_event(channels, event_type, message_data):
+    """Push a newly stored message to subscribers of the given channels."""
+    payload = app.json.dumps({'type': event_type, 'message': message_data})
+    broker = get_broker()
+    for channel in set(channels):
+        broker.publish(channel, payload)
 
 @app.route('/')
 def home():
@@ -128,6 +221,7 @@ def create_post():
     return jsonify(response), 201
     
 @app.route('/signup', methods=['POST'])
+@rate_limited('signup')
 def signup():
     try:
         user_data = request.get_json()
@@ -143,28 +237,28 @@ def signup():
             if not name or not email or not company_name or not phone or not provider:
                 return jsonify({'error': 'Name, email, company name, phone, and provider are required.'}), 400
 
-            # Check if user with the email already exists
-            existing_user = users_collection.find_one({'email': email})
+            # Check if user with the email already exists; unverified signups just get a new code
+            existing_user = get_user(email)
             if existing_user:
+                if is_unverified(existing_user):
+                    send_signup_code(email)
+                    return jsonify({'success': True, 'message': 'OTP resent to your email.'}), 200
                 return jsonify({'error': 'User with this email already exists.'}), 409
 
-            # Generate OTP and send it via email
-            otp_code = generate_otp()
-            email_sent = send_otp_email(email, otp_code)
-
-            if not email_sent:
-                return jsonify({'error': 'Failed to send OTP email.'}), 500
-
-            # Insert new user (OTP will be stored for validation later)
+            # Insert new user; the OTP lives in the OTP store until it is verified
             result = users_collection.insert_one({
                 'name': name,
                 'email': email,
                 'company_name': company_name,
                 'phone': phone,  # Save phone number
                 'provider': provider,  # Save provider
-                'otp': otp_code,
+                'verified': False,
                 'signup_date': datetime.now(pytz.utc),  # Add timestamp for when the user signs up
             })
+            user_cache.invalidate(email)
+
+            # Send the OTP in the background
+            send_signup_code(email)
 
             # Return success response with the new user's ID
             return jsonify({'success': True, 'user_id': str(result.inserted_id), 'message': 'OTP sent to your email.'}), 201
@@ -173,7 +267,53 @@ def signup():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Retry mail deliveries left unfinished by frozen or restarted instances; run it every few minutes
+# (vercel.json schedules it as a Vercel cron job, which sends CRON_SECRET as a bearer token)
+@app.route('/resume_deliveries', methods=['GET', 'POST'])
+def resume_deliveries():
+    secret = os.getenv('CRON_SECRET')
+    if secret and request.headers.get('Authorization') != f'Bearer {secret}':
+        return jsonify({'error': 'Unauthorized.'}), 401
+    try:
+        otps = get_otp_dispatcher().resume(lambda email: otp_store.issue(otps_collection, email))
+        sms_jobs = get_sms_queue().resume()
+        return jsonify({'success': True, 'otps': otps, 'sms_jobs': sms_jobs}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/otp_status', methods=['GET'])
+def otp_status():
+    email = request.args.get('email')
+    if not email:
+        return jsonify({'error': 'Email is required.'}), 400
+
+    status = get_otp_dispatcher().status(email)
+    if status is None:
+        return jsonify({'error': 'No OTP delivery found for this email.'}), 404
+    return jsonify({'email': email, **status}), 200
+
+@app.route('/resend-otp', methods=['POST'])
+@rate_limited('resend_otp')
+def resend_otp():
+    try:
+        data = request.get_json() or {}
+        email = data.get('email')
+        if not email:
+            return jsonify({'success': False, 'message': 'Email is required.'}), 400
+
+        user = get_user(email)
+        if not user:
+            return jsonify({'success': False, 'message': 'User not found.'}), 404
+        if not is_unverified(user):
+            return jsonify({'success': False, 'message': 'Email is already verified.'}), 409
+
+        send_signup_code(email)
+        return jsonify({'success': True, 'message': 'OTP sent to your email.'}), 200
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @app.route('/verify-otp', methods=['POST'])
+@rate_limited('verify_otp')
 def verify_otp():
     try:
         # Get the request data
@@ -185,22 +325,25 @@ def verify_otp():
         if not email or not otp:
             return jsonify({'success': False, 'message': 'Email and OTP are required.'}), 400
 
-        # Check if the user exists with the provided email
-        user = users_collection.find_one({'email': email})
-
-        if not user:
-            return jsonify({'success': False, 'message': 'User not found.'}), 404
-
-        # Check if the provided OTP matches the one in the database
-        if str(user.get('otp')) == str(otp):
-            # OTP is correct; remove OTP from the user's record
-            users_collection.update_one(
-                {'email': email},
-                {'$unset': {'otp': ""}}  # Remove OTP field
-            )
+        # Check and consume the code in one round trip
+        status = otp_store.verify(otps_collection, email, otp)
+        if status == otp_store.VERIFIED:
+            # A code issued before the OTP store may still be on the user document; it is no longer needed
+            users_collection.update_one({'email': email}, {'$set': {'verified': True}, '$unset': {'otp': ''}})
+        elif status == otp_store.EXPIRED:
+            # Codes issued before the OTP store are still on the user document
+            otp_values = [str(otp), int(otp)] if str(otp).isdigit() else [str(otp)]
+            if users_collection.find_one_and_update({'email': email, 'otp': {'$in': otp_values}},
+                                                    {'$unset': {'otp': ''}, '$set': {'verified': True}},
+                                                    projection={'_id': 1}):
+                status = otp_store.VERIFIED
+
+        if status == otp_store.VERIFIED:
+            user_cache.invalidate(email)
             return jsonify({'success': True, 'message': 'OTP verified successfully.'}), 200
-        else:
+        if status == otp_store.INVALID:
             return jsonify({'success': False, 'message': 'Incorrect OTP.'}), 401
+        return jsonify({'success': False, 'message': 'OTP expired or not found. Request a new one.'}), 410
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
@@ -214,7 +357,7 @@ def signin():
     email = user_data.get('email')
     
     # Check if user exists
-    existing_user = users_collection.find_one({'email': email})
+    existing_user = get_user(email)
     if existing_user:
         return jsonify({'success': True, 'message': 'Sign in successful.'}), 200
     else:
@@ -225,11 +368,10 @@ def signin():
 def get_records():
     try:
         email = request.args.get('email')  # Get email from query params
-        print(f"Received request for email: {email}")  # Log the received email
+        app.logger.debug('Record lookup for %s', email)
 
         # Fetch the user by email
-        user = users_collection.find_one({'email': email}, {'_id': 0})
-        print(user)
+        user = get_user(email)
 
         if user is None:
             return jsonify({'error': 'User not found.'}), 404  # More specific error for user not found
@@ -251,27 +393,175 @@ def get_r():
 
     
 
+# Fields of a user document that are safe to list in the company directory
+DIRECTORY_FIELDS = {'_id': 0, 'name': 1, 'email': 1, 'company_name': 1, 'phone': 1, 'provider': 1}
+
+# Unpaginated directory kept for old clients; /directory pages and streams the same listing
 @app.route('/get_forms_company_name', methods=['GET'])
 def get_forms_by_company_name():
     try:
-        # Get query parameters from the request
-        company_name = request.args.get('company_name')  # Fetch 'group' parameter from the query string
+        company_name = request.args.get('company_name')
+        if not company_name:
+            return jsonify({'error': 'company_name is required.'}), 400
 
-        # Build the filter condition dynamically
-        filter_condition = {}
-        if company_name:
-            filter_condition['company_name'] = company_name
-
-        # Fetch documents matching the dynamic filter condition
-        records = list(users_collection.find(filter_condition, {'_id': 0}))  # Exclude the MongoDB ID field
+        # Only the directory fields: user documents also hold OTPs and verification state
+        records = list(users_collection.find({'company_name': company_name}, DIRECTORY_FIELDS))
 
         return jsonify(records), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-        
+
+# Paginated company directory, streamed from the cursor as chunked JSON
+@app.route('/directory', methods=['GET'])
+def directory():
+    try:
+        company_name = request.args.get('company_name')
+        if not company_name:
+            return jsonify({'error': 'company_name is required.'}), 400
+
+        limit = parse_limit(request.args.get('limit'), default=100, maximum=1000)
+        query = {'company_name': company_name}
+        after = request.args.get('after')
+        if after:
+            query['email'] = {'$gt': decode_token(after).get('email')}
+
+        cursor = users_collection.find(query, DIRECTORY_FIELDS).sort('email', 1).limit(limit + 1).batch_size(100)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    def generate():
+        yield '{"success":true,"users":['
+        count = 0
+        last_email = None
+        has_more = False
+        for user in cursor:
+            if count == limit:
+                has_more = True  # The extra document only tells us another page exists
+                break
+            yield (',' if count else '') + app.json.dumps(user)
+            count += 1
+            last_email = user.get('email')
+        cursor.close()
+        next_cursor = encode_token({'email': last_email}) if has_more else None
+        yield '],' + app.json.dumps({'next_cursor': next_cursor, 'has_more': has_more})[1:]
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+# Server-Sent Events stream of new direct and group messages for one user
+@app.route('/events', methods=['GET'])
+def events():
+    try:
+        email = request.args.get('email')
+        if not email:
+            return jsonify({'error': 'Email is required.'}), 400
+
+        # Group membership is resolved once per connection; reconnect to pick up new groups
+        group_ids = [str(group['_id']) for group in get_member_groups(email)]
+        subscription = get_broker().subscribe(
+            [user_channel(email)] + [group_channel(group_id) for group_id in group_ids]
+        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                payload = subscription.get(timeout=PUSH_KEEPALIVE)
+                if payload is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield f'data: {payload}\n\n'
+        finally:
+            subscription.close()
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 #messages
+# Presence heartbeat, kept in memory (or Redis) and never written to MongoDB, see presence.py
+@app.route('/presence/heartbeat', methods=['POST'])
+def presence_heartbeat():
+    try:
+        data = request.get_json(silent=True) or {}
+        email = data.get('email')
+        status = data.get('status', presence.ONLINE)
+        if not email:
+            return jsonify({'error': 'Email is required.'}), 400
+        if status not in presence.STATUSES:
+            return jsonify({'error': f"status must be one of {', '.join(presence.STATUSES)}."}), 400
+
+        presence.heartbeat(email, status)
+        return jsonify({'success': True, 'ttl': presence.PRESENCE_TTL}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Typing indicator for a direct conversation (receiver) or a group (group_id); changes are pushed to /events
+@app.route('/presence/typing', methods=['POST'])
+def presence_typing():
+    try:
+        data = request.get_json(silent=True) or {}
+        email = data.get('email')
+        receiver = data.get('receiver')
+        group_id = data.get('group_id')
+        typing = bool(data.get('typing', True))
+        if not email or not (receiver or group_id):
+            return jsonify({'error': 'Email and a receiver or group ID are required.'}), 400
+
+        conversation = user_channel(receiver) if receiver else group_channel(group_id)
+        if presence.set_typing(email, conversation, typing):
+            event = {'sender': email, 'typing': typing, 'ttl': presence.TYPING_TTL}
+            event.update({'receiver': receiver} if receiver else {'group_id': group_id})
+            publish_message_event([conversation], 'typing', event)
+        return jsonify({'success': True, 'ttl': presence.TYPING_TTL}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Bulk presence: ?emails=a,b,c (e.g. the contacts from /get_user_conversations) or ?group_id= for its members
+@app.route('/presence', methods=['GET'])
+def get_presence():
+    try:
+        group_id = request.args.get('group_id')
+        if group_id:
+            # One page of members at a time, like /group_members
+            group = get_group(group_id)
+            if not group:
+                return jsonify({'error': 'Group not found.'}), 404
+            members, next_cursor, has_more = memberships.page(
+                scope(group_members_collection, group.get(TENANT_FIELD)), group['_id'],
+                after=request.args.get('after'),
+                limit=parse_limit(request.args.get('limit'), default=100, maximum=presence.MAX_PRESENCE_QUERY)
+            )
+            emails = [member['member'] for member in members]
+            return respond({'success': True, 'presence': presence.statuses(emails),
+                            'typing': presence.typing_in(group_channel(group_id), emails),
+                            'next_cursor': next_cursor, 'has_more': has_more}), 200
+
+        emails = [email for email in request.args.get('emails', '').split(',') if email]
+        if not emails:
+            return jsonify({'error': 'emails or group_id is required.'}), 400
+        if len(emails) > presence.MAX_PRESENCE_QUERY:
+            return jsonify({'error': f'At most {presence.MAX_PRESENCE_QUERY} emails per request.'}), 400
+
+        result = {'success': True, 'presence': presence.statuses(emails)}
+        viewer = request.args.get('email')
+        if viewer:
+            # Which of them are typing to the viewer
+            result['typing'] = presence.typing_in(user_channel(viewer), emails)
+        return respond(result), 200
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Direct messages carry the client's time, 'YYYY-MM-DD hh:mm AM/PM'; /send_message and /send_messages both store it
+MESSAGE_TIMESTAMP_FORMAT = '%Y-%m-%d %I:%M %p'
+
 @app.route('/send_message', methods=['POST'])
+@rate_limited('send_message')
 def send_message():
     data = request.get_json()
 
@@ -284,33 +574,193 @@ def send_message():
     message = data.get('message')
     timestamp = data.get('timestamp')
 
-    # Validate required fields
-    if not sender or not receiver or not message or not timestamp:
+    # Validate required fields (a message may be just attachments)
+    if not sender or not receiver or not (message or data.get('attachments')) or not timestamp:
         return jsonify({'success': False, 'error': 'Missing required fields'}), 400
 
     # Attempt to parse the timestamp
     try:
-        # Assuming the timestamp format is 'YYYY-MM-DD hh:mm AM/PM'
-        timestamp = datetime.strptime(timestamp, "%Y-%m-%d %I:%M %p")  # Handle the new format
-    except ValueError:
+        timestamp = datetime.strptime(timestamp, MESSAGE_TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
         return jsonify({'success': False, 'error': 'Invalid timestamp format. Use YYYY-MM-DD hh:mm AM/PM.'}), 400
 
     # Store the message in the database
     message_data = {
         'sender': sender,
         'receiver': receiver,
-        'message': message,
+        'message': message or '',
         'timestamp': timestamp,
         'isRead': False  # New field to indicate unread status
     }
     
     try:
-        messages_collection.insert_one(message_data)  # Insert the message into the collection
+        # Direct messages stay inside one company
+        sender_company, receiver_company = get_company(sender), get_company(receiver)
+        if sender_company and receiver_company and sender_company != receiver_company:
+            return jsonify({'success': False, 'error': 'Sender and receiver belong to different companies.'}), 403
+        company = sender_company or receiver_company
+
+        # Attachments were uploaded to /attachments first; the message only keeps references
+        message_attachments = attachments.references(attachment_files_collection, attachment_aliases_collection,
+                                                      data.get('attachments'))
+        if message_attachments:
+            message_data['attachments'] = message_attachments
+        scope(messages_collection, company).insert_one(message_data)  # Insert the message into the collection
+        summaries.record_message(scope(conversations_collection, company), message_data)
+        publish_message_event([user_channel(sender), user_channel(receiver)], 'message', message_data)
         return jsonify({'success': True, 'message': 'Message sent successfully!'}), 200
+    except attachments.InvalidAttachment as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
         
           
+# Upper bound on messages accepted by one /send_messages call
+MAX_BATCH_SIZE = 500
+
+# Send many direct messages in one call: a list of items, or one message to several receivers
+@app.route('/send_messages', methods=['POST'])
+@rate_limited('send_messages')
+def send_messages():
+    data = request.get_json(silent=True)
+    if data is None:
+        return jsonify({'success': False, 'error': 'No data received'}), 400
+
+    sender = data.get('sender')
+    timestamp = data.get('timestamp')  # For items without their own
+    if 'items' in data:
+        items = data.get('items') or []
+    else:
+        items = [{'receiver': receiver, 'message': data.get('message')} for receiver in data.get('receivers') or []]
+
+    if not sender or not items:
+        return jsonify({'success': False, 'error': 'Sender and at least one item or receiver are required.'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'success': False, 'error': f'At most {MAX_BATCH_SIZE} messages per batch.'}), 400
+
+    # Malformed items fail the whole batch before anything is written
+    timestamps = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        message = item.get('message')
+        if message is not None and not isinstance(message, str):
+            return jsonify({'success': False, 'error': f'Item {index}: message must be a string.'}), 400
+        item_timestamp = item.get('timestamp', timestamp)
+        if not item_timestamp:
+            continue
+        try:
+            # Same source as /send_message, so both kinds of message order the same way in a conversation
+            timestamps[index] = datetime.strptime(item_timestamp, MESSAGE_TIMESTAMP_FORMAT)
+        except (TypeError, ValueError):
+            return jsonify({'success': False,
+                            'error': f'Item {index}: Invalid timestamp format. Use YYYY-MM-DD hh:mm AM/PM.'}), 400
+
+    try:
+        # Receivers' companies in one query; each message is stored under its conversation's company
+        sender_company = get_company(sender)
+        receivers = [item.get('receiver') for item in items if isinstance(item, dict) and item.get('receiver')]
+        receiver_companies = {user['email']: user.get('company_name') for user in users_collection.find(
+            {'email': {'$in': receivers}}, {'_id': 0, 'email': 1, 'company_name': 1})} if receivers else {}
+
+        results = []
+        documents = {}  # company -> [(index, document)]
+        for index, item in enumerate(items):
+            receiver = item.get('receiver') if isinstance(item, dict) else None
+            message = item.get('message') if isinstance(item, dict) else None
+            if not receiver or not message or index not in timestamps:
+                results.append({'index': index, 'receiver': receiver, 'success': False,
+                                'error': 'Missing required fields'})
+                continue
+            receiver_company = receiver_companies.get(receiver)
+            if sender_company and receiver_company and sender_company != receiver_company:
+                results.append({'index': index, 'receiver': receiver, 'success': False,
+                                'error': 'Receiver belongs to a different company.'})
+                continue
+            document = {
+                'sender': sender,
+                'receiver': receiver,
+                'message': message,
+                'timestamp': timestamps[index],
+                'isRead': False
+            }
+            results.append({'index': index, 'receiver': receiver, 'success': True})
+            documents.setdefault(sender_company or receiver_company, []).append((index, document))
+
+        for company, batch in documents.items():
+            failed = {}
+            try:
+                scope(messages_collection, company).insert_many([document for _, document in batch], ordered=False)
+            except BulkWriteError as e:
+                failed = {error['index']: error.get('errmsg', 'Write failed') for error in e.details['writeErrors']}
+
+            stored = []
+            for position, (index, document) in enumerate(batch):
+                if position in failed:
+                    results[index].update(success=False, error=failed[position])
+                else:
+                    results[index]['message_id'] = str(document['_id'])
+                    stored.append(document)
+
+            if stored:
+                # Ordered so the newest message wins when a batch hits the same conversation twice
+                scope(conversations_collection, company).bulk_write(
+                    [op for document in stored for op in summaries.record_message_ops(document)], ordered=True
+                )
+                for document in stored:
+                    publish_message_event([user_channel(sender), user_channel(document['receiver'])], 'message',
+                                          document)
+
+        sent = sum(1 for result in results if result['success'])
+        return jsonify({'success': sent == len(results), 'sent': sent, 'results': results}), 200
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def get_attachment_bucket():
+    return attachments.get_bucket(database.get_database())
+
+# Upload one attachment as the raw request body: POST /attachments?email=&filename= with the file's Content-Type
+@app.route('/attachments', methods=['POST'])
+def upload_attachment():
+    try:
+        email = request.args.get('email')
+        filename = request.args.get('filename')
+        if not email or not filename:
+            return jsonify({'success': False, 'error': 'Email and filename are required.'}), 400
+
+        retry_after = ratelimit.check('upload_attachment', request.remote_addr, request.args)
+        if retry_after:
+            return ratelimit.too_many_requests(retry_after)
+        if (request.content_length or 0) > attachments.ATTACHMENT_MAX_BYTES:
+            return jsonify({'success': False,
+                            'error': f'Attachments are limited to {attachments.ATTACHMENT_MAX_BYTES} bytes.'}), 413
+        if not get_user(email):
+            return jsonify({'success': False, 'error': 'User not found.'}), 404
+
+        # Read straight from the request stream so large files are never held in memory
+        file_doc, deduplicated = attachments.store(
+            get_attachment_bucket(), attachment_files_collection, attachment_aliases_collection, request.stream,
+            filename, request.content_type or 'application/octet-stream', email
+        )
+        return jsonify({'success': True, 'attachment': attachments.reference(file_doc),
+                        'deduplicated': deduplicated}), 201
+    except attachments.AttachmentTooLarge as e:
+        return jsonify({'success': False, 'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/attachments/<attachment_id>', methods=['GET'])
+def download_attachment(attachment_id):
+    from gridfs.errors import NoFile
+    try:
+        grid_out, alias = attachments.open_download(get_attachment_bucket(), attachment_aliases_collection,
+                                                    attachment_id)
+        return attachments.download_response(grid_out, alias)
+    except (attachments.InvalidAttachment, NoFile):
+        return jsonify({'error': 'Attachment not found.'}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/get_conversation', methods=['GET'])
 def get_conversation():
     try:
@@ -320,19 +770,28 @@ def get_conversation():
         if not sender or not receiver:
             return jsonify({'error': 'Sender and receiver are required.'}), 400
 
-        # Fetch messages where the sender and receiver are involved in the conversation
-        conversation = list(messages_collection.find({
-            '$or': [
-                {'sender': sender, 'receiver': receiver},
-                {'sender': receiver, 'receiver': sender}
-            ]
-        }).sort('timestamp', 1))  # Sort messages by timestamp (ascending)
+        # Fetch one window of messages where the sender and receiver are involved in the conversation
+        conversation, next_cursor, has_more = archive.page(
+            message_tier.for_company(conversation_company(sender, receiver)),
+            {'conversation': archive.conversation_key(sender, receiver)},
+            {
+                '$or': [
+                    {'sender': sender, 'receiver': receiver},
+                    {'sender': receiver, 'receiver': sender}
+                ]
+            },
+            before=request.args.get('before'),
+            after=request.args.get('after'),
+            limit=parse_limit(request.args.get('limit')),
+            projection=MESSAGE_FIELDS
+        )  # Newest messages first
 
         # Return the conversation
-        for msg in conversation:
-            msg['_id'] = str(msg['_id'])  # Convert ObjectId to string for JSON serialization
-
-        return jsonify({'success': True, 'conversation': conversation}), 200
+        return respond({'success': True, 'conversation': conversation,
+                        'next_cursor': next_cursor, 'has_more': has_more,
+                        'newest_cursor': newest_cursor(conversation, request.args.get('after'))}), 200
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -343,33 +802,51 @@ def mark_as_read():
         current_user = data.get('currentUser')  # Current logged-in user's email
         sender = data.get('sender')  # Sender's email
         receiver = data.get('receiver')  # Receiver's email
-        print(current_user,sender,receiver)
+        app.logger.debug('Mark as read by %s: %s -> %s', current_user, sender, receiver)
         if not current_user or not sender or not receiver:
             return jsonify({'error': 'Sender, receiver, and current user are required.'}), 400
 
         # Ensure the current user is the receiver
-      
-        # Find the latest message sent from the sender to the receiver that is not read
-        latest_message = messages_collection.find_one(
-            {'sender': sender, 'receiver': receiver, 'isRead': False},
-            sort=[('timestamp', -1)]  # Sort to get the latest message
+        if current_user != receiver:
+            return jsonify({'error': 'Only the receiver can mark messages as read.'}), 403
+
+        # Mark every unread message from the sender in one update, optionally only up to a given message
+        query = {'sender': sender, 'receiver': receiver, 'isRead': False}
+        up_to = data.get('up_to')  # Optional id of the newest message the user has seen
+        company = conversation_company(sender, receiver)
+        if up_to:
+            marker = scope(messages_collection, company).find_one(
+                {'_id': ObjectId(up_to), 'sender': sender, 'receiver': receiver}, {'timestamp': 1})
+            if not marker:
+                return jsonify({'error': 'Message not found.'}), 404
+            # "Up to" in the conversation's (timestamp, _id) order, the same keyset pages use
+            query = keyset_condition(query, marker['timestamp'], marker['_id'], 'before', inclusive=True)
+        result = scope(messages_collection, company).update_many(
+            query,
+            {'$set': {'isRead': True, 'readAt': datetime.utcnow()}}  # readAt feeds /sync
         )
-        if(current_user==receiver):
 
-            if latest_message:
-                # Update the isRead field to true
-                messages_collection.update_one(
-                    {'_id': latest_message['_id']},
-                    {'$set': {'isRead': True}}
-                )
-                return jsonify({'success': True, 'message': 'Message marked as read.'}), 200
-            else:
-                return jsonify({'success': True, 'message': 'No unread messages found.'}), 200
+        if result.modified_count == 0:
+            return jsonify({'success': True, 'message': 'No unread messages found.', 'marked': 0}), 200
+
+        summaries.mark_read(scope(conversations_collection, company), receiver, sender,
+                            result.modified_count if up_to else None)
+        return jsonify({'success': True, 'message': 'Messages marked as read.',
+                        'marked': result.modified_count}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def annotate_presence(user_email, conversations):
+    """Add each partner's status and typing-to-me flag, from the presence store (shared with asgi.py)."""
+    contacts = [conversation['partner'] for conversation in conversations]
+    statuses = presence.statuses(contacts)
+    typing = set(presence.typing_in(user_channel(user_email), contacts))
+    for conversation in conversations:
+        conversation['presence'] = statuses[conversation['partner']]
+        conversation['typing'] = conversation['partner'] in typing
+
 @app.route('/get_user_conversations', methods=['GET'])
 def get_user_conversations():
     try:
@@ -378,34 +855,219 @@ def get_user_conversations():
         if not user_email:
             return jsonify({'error': 'Email is required.'}), 400
 
-        # Fetch distinct conversation partners
-        contacts = messages_collection.distinct('receiver', {'sender': user_email}) + \
-                   messages_collection.distinct('sender', {'receiver': user_email})
+        # One indexed read of the user's conversation summaries, most recent first
+        conversations, next_cursor, has_more = keyset_page(
+            scope(conversations_collection, get_company(user_email)),
+            {'owner': user_email},
+            before=request.args.get('before'),
+            limit=parse_limit(request.args.get('limit')),
+            field='last_timestamp',
+            projection={'owner': 0, 'last_message_id': 0, TENANT_FIELD: 0}
+        )
+
+        contacts = [conversation['partner'] for conversation in conversations]
+        if request.args.get('presence') == '1':
+            annotate_presence(user_email, conversations)
+
+        return respond({'success': True,
+                        'contacts': contacts,
+                        'conversations': conversations,
+                        'next_cursor': next_cursor, 'has_more': has_more}), 200
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Seconds /sync re-reads behind its cursor once a client has caught up. ObjectIds and readAt come from
+# each app server's clock, and a write can commit after a newer one was read, so entries can land just
+# behind a cursor; re-reading this window picks them up and clients drop the duplicates by _id.
+SYNC_LOOKBACK = float(os.getenv('SYNC_LOOKBACK', 30))
+
+def parse_sync_since(since):
+    """Turn a /sync cursor or an ISO timestamp into (message id, group message id, read cursor, lookback)."""
+    try:
+        ts = datetime.fromisoformat(since)
+    except ValueError:
+        state = decode_token(since)
+        try:
+            return ObjectId(state['m']), ObjectId(state['g']), state.get('r'), bool(state.get('l'))
+        except Exception:
+            raise InvalidCursor('Invalid cursor.')
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(pytz.utc).replace(tzinfo=None)
+    since_id = ObjectId.from_datetime(ts)
+    # A synthetic read cursor at `ts`: anything read after that instant is new
+    return since_id, since_id, encode_cursor({'readAt': ts, '_id': since_id}, 'readAt'), False
+
+def sync_floor(position):
+    """An ObjectId SYNC_LOOKBACK seconds behind position."""
+    return ObjectId.from_datetime(position.generation_time - timedelta(seconds=SYNC_LOOKBACK))
+
+def read_floor(read_cursor):
+    """A read cursor SYNC_LOOKBACK seconds behind read_cursor."""
+    read_at, read_id = decode_cursor(read_cursor)
+    return encode_cursor({'readAt': read_at - timedelta(seconds=SYNC_LOOKBACK), '_id': read_id}, 'readAt')
+
+@app.route('/sync', methods=['GET'])
+def sync():
+    try:
+        email = request.args.get('email')
+        since = request.args.get('since')
+        if not email or not since:
+            return jsonify({'error': 'Email and since are required.'}), 400
+
+        limit = parse_limit(request.args.get('limit'), default=100, maximum=500)
+        message_id, group_message_id, read_cursor, lookback = parse_sync_since(since)
+        participant = {'$or': [{'sender': email}, {'receiver': email}]}
+        company = get_company(email)
+        company_messages = scope(messages_collection, company)
+
+        # Once caught up, re-read the last SYNC_LOOKBACK seconds for entries that landed behind the cursor
+        message_from, group_message_from, read_from = message_id, group_message_id, read_cursor
+        if lookback:
+            message_from, group_message_from = sync_floor(message_id), sync_floor(group_message_id)
+            read_from = read_floor(read_cursor) if read_cursor else None
+
+        # New direct messages, oldest first so the cursor can advance past them
+        messages = list(company_messages.find({**participant, '_id': {'$gt': message_from}})
+                        .sort('_id', 1).limit(limit + 1))
+
+        # New messages in any of the user's groups
+        group_ids = [group['_id'] for group in get_member_groups(email)]
+        group_messages = []
+        if group_ids:
+            group_messages = list(scope(group_messages_collection, company).find({
+                'group_id': {'$in': group_ids}, '_id': {'$gt': group_message_from}
+            }).sort('_id', 1).limit(limit + 1))
+
+        # isRead changes on messages the user sent or received
+        read_receipts = list(company_messages.find(
+            keyset_query({**participant, 'readAt': {'$exists': True}}, read_from, 'after', 'readAt'),
+            {'sender': 1, 'receiver': 1, 'isRead': 1, 'readAt': 1}
+        ).sort([('readAt', 1), ('_id', 1)]).limit(limit + 1))
+
+        more = [len(batch) > limit for batch in (messages, group_messages, read_receipts)]
+        has_more = any(more)
+        messages, group_messages, read_receipts = messages[:limit], group_messages[:limit], read_receipts[:limit]
+
+        # A kind with more to fetch continues strictly after its last entry. A caught-up kind keeps the
+        # furthest position seen, so re-sent entries never walk the window backwards. Once everything is
+        # caught up the next call re-reads the lookback window, so entries can arrive more than once and
+        # clients dedupe them by _id.
+        def position(current, batch, more_of_kind, key):
+            if not batch:
+                return current
+            return key(batch[-1]) if more_of_kind or current is None else max(current, key(batch[-1]))
+
+        message_id = position(message_id, messages, more[0], lambda doc: doc['_id'])
+        group_message_id = position(group_message_id, group_messages, more[1], lambda doc: doc['_id'])
+        read_position = position(decode_cursor(read_cursor) if read_cursor else None, read_receipts, more[2],
+                                 lambda doc: (doc['readAt'], doc['_id']))
+        if read_position:
+            read_cursor = encode_cursor({'readAt': read_position[0], '_id': read_position[1]}, 'readAt')
+        next_since = encode_token({
+            'm': str(message_id),
+            'g': str(group_message_id),
+            'r': read_cursor,
+            'l': not has_more,
+        })
+
+        return respond({'success': True, 'messages': messages, 'group_messages': group_messages,
+                        'read_receipts': read_receipts, 'next_since': next_since, 'has_more': has_more}), 200
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 
-        return jsonify({'success': True, 'contacts': list(set(contacts))}), 200
+# Ranked full-text search over the user's direct messages and groups
+@app.route('/search', methods=['GET'])
+def search_messages():
+    try:
+        email = request.args.get('email')
+        query = (request.args.get('q') or '').strip()
+        if not email or not query:
+            return jsonify({'error': 'Email and q are required.'}), 400
+        if len(query) > search.MAX_QUERY_LENGTH:
+            return jsonify({'error': f'q must be at most {search.MAX_QUERY_LENGTH} characters.'}), 400
+
+        group_ids = [group['_id'] for group in get_member_groups(email)]
+        company = get_company(email)
+        results, next_cursor, has_more = search.search_messages(
+            scope(messages_collection, company), scope(group_messages_collection, company), email, group_ids, query,
+            cursor=request.args.get('cursor'), limit=parse_limit(request.args.get('limit'), default=20, maximum=100)
+        )
+
+        return respond({'success': True, 'results': results,
+                        'next_cursor': next_cursor, 'has_more': has_more}), 200
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def add_group_members(group, members):
+    """Add members to a group, keeping member_count, the caches and the fan-out mode in step; returns the new ones."""
+    group_id, company = group['_id'], group.get(TENANT_FIELD)
+    group_members = scope(group_members_collection, company)
+    added = memberships.add(group_members, group_id, members)
+    if not added:
+        return added
+    group = groups_collection.find_one_and_update(
+        {'_id': group_id},
+        {'$inc': {'member_count': len(added)}},
+        projection={'member_count': 1, 'fanout': 1},
+        return_document=ReturnDocument.AFTER
+    )
+    group_cache.invalidate(str(group_id))
+    member_groups_cache.invalidate(*added)
+
+    # Groups that outgrow fan-out-on-write switch to fan-out-on-read for good
+    if group.get('fanout') == 'write' and group_inbox.fanout_mode(group['member_count']) == 'read':
+        groups_collection.update_one({'_id': group_id}, {'$set': {'fanout': 'read'}})
+        group_inbox.drop_group(scope(group_inbox_collection, company), group_id)
+        group_cache.invalidate(str(group_id))
+        member_groups_cache.invalidate(*memberships.member_emails(group_members, group_id))
+    return added
+
+def parse_members(data):
+    """The `members` list of a bulk add/remove request, or None if it is not a list of emails."""
+    members = data.get('members')
+    if not isinstance(members, list) or not members or not all(isinstance(m, str) and m for m in members):
+        return None
+    return members
+
 # 1. Create Group
 @app.route('/create_group', methods=['POST'])
 def create_group():
     try:
         data = request.get_json()
         group_name = data.get('group_name')
-        members = data.get('members', [])  # List of user emails or IDs
-        print(group_name,members)
+        members = list(dict.fromkeys(data.get('members', [])))  # List of user emails or IDs
         
         if not group_name or not members:
             return jsonify({'error': 'Group name and members are required.'}), 400
+        app.logger.debug('Create group %s with %d members', group_name, len(members))
+
+        # A group belongs to one company (by default the first registered member's) and only takes its users
+        company = data.get('company_name') or next(filter(None, map(get_company, members)), None)
+        outsiders = other_company_members(members, company)
+        if outsiders:
+            return jsonify({'error': f"Members belong to another company: {', '.join(outsiders)}."}), 400
         
+        # Members go to group_members; the group only keeps their count
         group_data = {
             'group_name': group_name,
-            'members': members,
+            'member_count': len(members),
+            'fanout': group_inbox.fanout_mode(len(members)),  # Small groups get per-member inbox entries
+            TENANT_FIELD: company,
             'created_at': datetime.utcnow()
         }
         
         result = groups_collection.insert_one(group_data)
+        memberships.add(scope(group_members_collection, company), result.inserted_id, members)
+        member_groups_cache.invalidate(*members)
         return jsonify({'success': True, 'group_id': str(result.inserted_id)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -421,21 +1083,91 @@ def add_member():
         if not group_id or not new_member:
             return jsonify({'error': 'Group ID and new member are required.'}), 400
         
-        # Add new member to the group
-        result = groups_collection.update_one(
-            {'_id': ObjectId(group_id)},
-            {'$addToSet': {'members': new_member}}  # Prevent duplicate members
-        )
-        
-        if result.matched_count == 0:
+        group = get_group(group_id)
+        if not group:
             return jsonify({'error': 'Group not found.'}), 404
+        if other_company_members([new_member], group.get(TENANT_FIELD)):
+            return jsonify({'error': 'The new member belongs to another company.'}), 400
+        add_group_members(group, [new_member])  # Already a member is not an error
         
         return jsonify({'success': True, 'message': 'Member added to the group.'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Add many members in one call
+@app.route('/add_members', methods=['POST'])
+def add_members():
+    try:
+        data = request.get_json(silent=True) or {}
+        group_id = data.get('group_id')
+        members = parse_members(data)
+        if not group_id or members is None:
+            return jsonify({'error': 'Group ID and a list of member emails are required.'}), 400
+        if len(members) > memberships.MAX_MEMBERS_PER_CALL:
+            return jsonify({'error': f'At most {memberships.MAX_MEMBERS_PER_CALL} members per call.'}), 400
+
+        group = get_group(group_id)
+        if not group:
+            return jsonify({'error': 'Group not found.'}), 404
+        outsiders = other_company_members(members, group.get(TENANT_FIELD))
+        if outsiders:
+            return jsonify({'error': f"Members belong to another company: {', '.join(outsiders)}."}), 400
+        added = add_group_members(group, members)
+        return jsonify({'success': True, 'added': len(added)}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Remove many members in one call
+@app.route('/remove_members', methods=['POST'])
+def remove_members():
+    try:
+        data = request.get_json(silent=True) or {}
+        group_id = data.get('group_id')
+        members = parse_members(data)
+        if not group_id or members is None:
+            return jsonify({'error': 'Group ID and a list of member emails are required.'}), 400
+        if len(members) > memberships.MAX_MEMBERS_PER_CALL:
+            return jsonify({'error': f'At most {memberships.MAX_MEMBERS_PER_CALL} members per call.'}), 400
+
+        group = get_group(group_id)
+        if not group:
+            return jsonify({'error': 'Group not found.'}), 404
+        group_id, company = group['_id'], group.get(TENANT_FIELD)
+        removed = memberships.remove(scope(group_members_collection, company), group_id, members)
+        if removed:
+            groups_collection.update_one({'_id': group_id}, {'$inc': {'member_count': -removed}})
+            group_inbox.drop_members(scope(group_inbox_collection, company), group_id, members)
+            group_cache.invalidate(str(group_id))
+            member_groups_cache.invalidate(*members)
+        return jsonify({'success': True, 'removed': removed}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Members of a group in email order, one page at a time
+@app.route('/group_members', methods=['GET'])
+def group_members():
+    try:
+        group_id = request.args.get('group_id')
+        if not group_id:
+            return jsonify({'error': 'Group ID is required.'}), 400
+
+        group = get_group(group_id)
+        if not group:
+            return jsonify({'error': 'Group not found.'}), 404
+        members, next_cursor, has_more = memberships.page(
+            scope(group_members_collection, group.get(TENANT_FIELD)), group['_id'], after=request.args.get('after'),
+            limit=parse_limit(request.args.get('limit'), default=100, maximum=1000)
+        )
+        return respond({'success': True, 'member_count': group.get('member_count'), 'members': members,
+                        'next_cursor': next_cursor, 'has_more': has_more}), 200
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # 3. Send Message to Group
 @app.route('/send_group_message', methods=['POST'])
+@rate_limited('send_group_message')
 def send_group_message():
     try:
         data = request.get_json()
@@ -444,24 +1176,40 @@ def send_group_message():
         message = data.get('message')
         timestamp = datetime.utcnow()
 
-        if not sender or not group_id or not message:
+        if not sender or not group_id or not (message or data.get('attachments')):
             return jsonify({'error': 'Sender, group ID, and message are required.'}), 400
         
-        # Check if group exists
-        group = groups_collection.find_one({'_id': ObjectId(group_id)})
+        group = get_group(group_id)
         if not group:
             return jsonify({'error': 'Group not found.'}), 404
+        # Checked against group_members on every send: the per-process group list cache may be stale
+        company = group.get(TENANT_FIELD)
+        if not memberships.is_member(scope(group_members_collection, company), group['_id'], sender):
+            return jsonify({'error': 'Sender is not a member of this group.'}), 403
         
         # Insert the message into the group_messages collection
         message_data = {
             'group_id': ObjectId(group_id),
             'sender': sender,
-            'message': message,
+            'message': message or '',
             'timestamp': timestamp
         }
+        # Every member sees the same stored files; the message only keeps references
+        message_attachments = attachments.references(attachment_files_collection, attachment_aliases_collection,
+                                                      data.get('attachments'))
+        if message_attachments:
+            message_data['attachments'] = message_attachments
         
-        group_messages_collection.insert_one(message_data)
+        scope(group_messages_collection, company).insert_one(message_data)
+        if group.get('fanout') == 'write':
+            # Only small groups fan out on write, so their member list is short
+            group_inbox.fan_out(scope(group_inbox_collection, company),
+                                memberships.member_emails(scope(group_members_collection, company), group['_id']),
+                                message_data)
+        publish_message_event([group_channel(group_id)], 'group_message', message_data)
         return jsonify({'success': True, 'message': 'Message sent to group.'}), 200
+    except attachments.InvalidAttachment as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -474,15 +1222,96 @@ def get_group_messages():
         if not group_id:
             return jsonify({'error': 'Group ID is required.'}), 400
         
-        # Fetch messages for the specified group
-        messages = list(group_messages_collection.find({'group_id': ObjectId(group_id)}).sort('timestamp', 1))
-        
-        # Convert ObjectId to string for JSON serialization
-        for msg in messages:
-            msg['_id'] = str(msg['_id'])
-            msg['group_id'] = str(msg['group_id'])
+        # Fetch one window of messages for the specified group, newest first
+        group = get_group(group_id)
+        messages, next_cursor, has_more = archive.page(
+            group_message_tier.for_company(group.get(TENANT_FIELD) if group else None),
+            {'group_id': ObjectId(group_id)},
+            {'group_id': ObjectId(group_id)},
+            before=request.args.get('before'),
+            after=request.args.get('after'),
+            limit=parse_limit(request.args.get('limit')),
+            projection=GROUP_MESSAGE_FIELDS
+        )
         
-        return jsonify({'success': True, 'messages': messages}), 200
+        return respond({'success': True, 'messages': messages,
+                        'next_cursor': next_cursor, 'has_more': has_more,
+                        'newest_cursor': newest_cursor(messages, request.args.get('after'))}), 200
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Mark a group as read up to a message (defaults to the newest one)
+@app.route('/mark_group_read', methods=['POST'])
+def mark_group_read():
+    try:
+        data = request.get_json()
+        email = data.get('email')
+        group_id = data.get('group_id')
+        up_to = data.get('up_to')
+
+        if not email or not group_id:
+            return jsonify({'error': 'Email and group ID are required.'}), 400
+
+        group = get_group(group_id)
+        if not group:
+            return jsonify({'error': 'Group not found.'}), 404
+        company = group.get(TENANT_FIELD)
+        if not memberships.is_member(scope(group_members_collection, company), group['_id'], email):
+            return jsonify({'error': 'Only group members can mark a group as read.'}), 403
+
+        if up_to:
+            last_read_id = ObjectId(up_to)
+        else:
+            latest = scope(group_messages_collection, company).find_one({'group_id': ObjectId(group_id)}, {'_id': 1},
+                                                        sort=[('_id', -1)])
+            if not latest:
+                return jsonify({'success': True, 'message': 'No messages in this group.'}), 200
+            last_read_id = latest['_id']
+
+        read_state.advance(scope(read_cursors_collection, company), email, read_state.group_conversation(group_id),
+                           last_read_id)
+        return jsonify({'success': True, 'last_read_id': str(last_read_id)}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Unread message counts for every group the user belongs to
+@app.route('/group_unread_counts', methods=['GET'])
+def group_unread_counts():
+    try:
+        email = request.args.get('email')
+        if not email:
+            return jsonify({'error': 'Email is required.'}), 400
+
+        group_ids = [group['_id'] for group in get_member_groups(email)]
+        company = get_company(email)
+        counts = read_state.group_unread_counts(scope(read_cursors_collection, company),
+                                                scope(group_messages_collection, company), email, group_ids)
+        return jsonify({'success': True, 'unread': counts, 'cap': read_state.UNREAD_COUNT_CAP}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Recent activity across all of a user's groups, newest first
+@app.route('/group_activity', methods=['GET'])
+def group_activity():
+    try:
+        email = request.args.get('email')
+        if not email:
+            return jsonify({'error': 'Email is required.'}), 400
+
+        # Fan-out-on-read groups have no inbox entries and are merged in from group_messages
+        read_group_ids = [group['_id'] for group in get_member_groups(email) if group.get('fanout') != 'write']
+        company = get_company(email)
+        entries, next_cursor, has_more = group_inbox.activity_page(
+            scope(group_inbox_collection, company), scope(group_messages_collection, company), email, read_group_ids,
+            before=request.args.get('before'), limit=parse_limit(request.args.get('limit'))
+        )
+
+        return respond({'success': True, 'activity': entries,
+                        'next_cursor': next_cursor, 'has_more': has_more}), 200
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -496,15 +1325,29 @@ def list_groups():
             return jsonify({'error': 'User email is required.'}), 400
         
         # Find all groups the user is part of
-        groups = list(groups_collection.find({'members': user_email}, {'_id': 1, 'group_name': 1}))
+        # Copy only the public fields, since the cached list is shared
+        groups = [{'_id': group['_id'], 'group_name': group.get('group_name')}
+                  for group in get_member_groups(user_email)]
         
-        # Convert ObjectId to string for JSON serialization
-        for group in groups:
-            group['_id'] = str(group['_id'])
-        
-        return jsonify({'success': True, 'groups': groups}), 200
+        return respond({'success': True, 'groups': groups}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Hit/miss counters for the lookup caches
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({cache.name: cache.stats() for cache in (user_cache, group_cache, member_groups_cache)}), 200
+
+# Cheap target for schedulers that keep a serverless instance and its MongoDB connection warm
+@app.route('/warmup', methods=['GET'])
+def warmup():
+    database.warm_up()
+    return jsonify({'success': True}), 200
+
+# Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
     app.run()
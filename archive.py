@@ -0,0 +1,289 @@
+"""
+Hot/cold tiering for message history.
+
+    python archive.py            # move messages older than ARCHIVE_AFTER_DAYS into the archive
+
+Messages older than ARCHIVE_AFTER_DAYS (default 90) move out of `messages`
+and `group_messages` into `message_archive` and `group_message_archive`.
+There they are stored as zlib-compressed BSON buckets of up to
+ARCHIVE_BUCKET_SIZE messages, one conversation or group per bucket:
+
+    {_id, company_name, conversation | group_id, count, first_timestamp,
+     first_id, last_timestamp, last_id, data}
+
+so the hot collections and their indexes only hold recent history. Unread
+direct messages stay hot, which keeps mark_as_read and unread counts
+correct. A message is written to its bucket before it is removed from the
+hot collection, so a job that is interrupted can simply be run again. The
+job works through one company at a time, on company-first indexes.
+
+page() is a drop-in for pagination.keyset_page. Every archived message is
+older than the horizon (now - ARCHIVE_AFTER_DAYS), so a page only reads
+the archive when it gets past that point: the hot results run out or reach
+the horizon, or an `after` cursor is older than it. The hot and archived
+candidates are then merged, so paging is seamless across the two tiers.
+Search and /sync only cover the hot tier.
+"""
+import argparse
+import logging
+import os
+import sys
+import zlib
+from datetime import datetime, timedelta
+
+import bson
+from bson import Binary
+
+from pagination import DEFAULT_PAGE_SIZE, decode_cursor, keyset_find, keyset_result
+from tenancy import TENANT_FIELD, companies, scope
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_BUCKET_SIZE = int(os.getenv('ARCHIVE_BUCKET_SIZE', 500))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 5000))
+COMPRESSION_LEVEL = 6
+
+
+def conversation_key(a, b):
+    """The archive key for the direct conversation between two users, in either direction."""
+    return '\n'.join(sorted((a, b)))
+
+
+def message_key(doc):
+    return {TENANT_FIELD: doc.get(TENANT_FIELD), 'conversation': conversation_key(doc['sender'], doc['receiver'])}
+
+
+def group_message_key(doc):
+    return {TENANT_FIELD: doc.get(TENANT_FIELD), 'group_id': doc['group_id']}
+
+
+class Tier:
+    """A hot collection, its archive, how messages map to buckets and which ones may be archived."""
+
+    def __init__(self, hot, archive, key_of, eligible=None):
+        self.hot = hot
+        self.archive = archive
+        self.key_of = key_of
+        self.eligible = eligible or {}
+
+    def for_company(self, company):
+        """The same tier with both collections scoped to one company (see tenancy.py)."""
+        return Tier(scope(self.hot, company), scope(self.archive, company), self.key_of, self.eligible)
+
+
+def message_tier(messages, archive):
+    # Unread messages stay hot so mark_as_read can still reach them
+    return Tier(messages, archive, message_key, eligible={'isRead': {'$ne': False}})
+
+
+def group_message_tier(group_messages, archive):
+    return Tier(group_messages, archive, group_message_key)
+
+
+def horizon():
+    """Everything in the archive is older than this."""
+    return datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+
+def _position(doc):
+    return doc['timestamp'], doc['_id']
+
+
+def pack(docs):
+    return Binary(zlib.compress(bson.encode({'messages': docs}), COMPRESSION_LEVEL))
+
+
+def unpack(bucket):
+    return bson.decode(zlib.decompress(bucket['data']))['messages']
+
+
+def _bucket(key, docs, bucket_id=None):
+    return {
+        '_id': bucket_id or docs[0]['_id'],
+        **key,
+        'count': len(docs),
+        'first_timestamp': docs[0]['timestamp'], 'first_id': docs[0]['_id'],
+        'last_timestamp': docs[-1]['timestamp'], 'last_id': docs[-1]['_id'],
+        'data': pack(docs),
+    }
+
+
+def _store(tier, key, docs, bucket_size, stats):
+    """Write one conversation's messages (oldest first), topping up its newest bucket when they follow it."""
+    newest = tier.archive.find_one(key, sort=[('last_timestamp', -1), ('last_id', -1)])
+    if newest is not None:
+        existing = unpack(newest)
+        # A rerun after an interrupted job finds its messages already written
+        seen = {doc['_id'] for doc in existing}
+        docs = [doc for doc in docs if doc['_id'] not in seen]
+        if docs and newest['count'] < bucket_size and _position(docs[0]) > _position(existing[-1]):
+            room = bucket_size - newest['count']
+            bucket = _bucket(key, existing + docs[:room], newest['_id'])
+            tier.archive.replace_one({**key, '_id': newest['_id']}, bucket)
+            stats['stored_bytes'] += len(bucket['data']) - len(newest['data'])
+            docs = docs[room:]
+
+    # Buckets are keyed by their first message, so rewriting one is idempotent. The filters carry
+    # the bucket key, which is the archive's shard key (tenancy.SHARD_KEYS), so a sharded cluster
+    # can route each write to one shard; an upsert without the full shard key is rejected there.
+    for start in range(0, len(docs), bucket_size):
+        bucket = _bucket(key, docs[start:start + bucket_size])
+        tier.archive.replace_one({**key, '_id': bucket['_id']}, bucket, upsert=True)
+        stats['buckets'] += 1
+        stats['stored_bytes'] += len(bucket['data'])
+
+
+def archive_batch(tier, cutoff, batch_size=ARCHIVE_BATCH_SIZE, bucket_size=ARCHIVE_BUCKET_SIZE, stats=None):
+    """Move up to batch_size of the oldest eligible messages before cutoff. Returns how many moved."""
+    stats = stats if stats is not None else {'moved': 0, 'buckets': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    docs = list(tier.hot.find({'timestamp': {'$lt': cutoff}, **tier.eligible})
+                .sort([('timestamp', 1), ('_id', 1)]).limit(batch_size))
+    if not docs:
+        return 0
+
+    conversations = {}
+    for doc in docs:
+        key = tier.key_of(doc)
+        conversations.setdefault(tuple(key.items()), (key, []))[1].append(doc)
+        stats['raw_bytes'] += len(bson.encode(doc))
+    for key, conversation_docs in conversations.values():
+        _store(tier, key, conversation_docs, bucket_size, stats)
+
+    tier.hot.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+    stats['moved'] += len(docs)
+    return len(docs)
+
+
+def archive_old(tier, batch_size=ARCHIVE_BATCH_SIZE, bucket_size=ARCHIVE_BUCKET_SIZE):
+    """Archive everything older than ARCHIVE_AFTER_DAYS; returns counts and raw vs compressed bytes."""
+    stats = {'moved': 0, 'buckets': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    cutoff = horizon()
+    for company in companies(tier.hot):
+        company_tier = tier.for_company(company)
+        while archive_batch(company_tier, cutoff, batch_size, bucket_size, stats):
+            logger.info('Archived %d messages from %s (%s)', stats['moved'], tier.hot.name, company)
+    return stats
+
+
+def _bucket_find(key, cursor, after):
+    """(filter, sort) for the buckets that can hold messages past cursor, nearest first."""
+    if after:
+        timestamp, _ = decode_cursor(cursor)
+        return {**key, 'last_timestamp': {'$gte': timestamp}}, [('first_timestamp', 1), ('first_id', 1)]
+    query = dict(key)
+    if cursor:
+        query['first_timestamp'] = {'$lte': decode_cursor(cursor)[0]}
+    return query, [('last_timestamp', -1), ('last_id', -1)]
+
+
+class _Collector:
+    """Gathers the limit + 1 archived messages nearest to a cursor from buckets read nearest first."""
+
+    def __init__(self, cursor, after, limit, projection):
+        self.bound = decode_cursor(cursor) if cursor else None
+        self.after = after
+        self.limit = limit
+        self.fields = None if projection is None else {name for name, keep in projection.items() if keep}
+        self.found = []
+        self.seen = set()
+
+    def done(self, bucket):
+        """True once no remaining bucket can hold a nearer message."""
+        if len(self.found) <= self.limit:
+            return False
+        kth = _position(self.found[self.limit])
+        if self.after:
+            return (bucket['first_timestamp'], bucket['first_id']) > kth
+        return (bucket['last_timestamp'], bucket['last_id']) < kth
+
+    def add(self, bucket):
+        for doc in unpack(bucket):
+            position = _position(doc)
+            if doc['_id'] in self.seen:
+                continue  # Also in an earlier bucket, after an interrupted archive run
+            if self.bound is None or (position > self.bound if self.after else position < self.bound):
+                self.found.append(doc)
+                self.seen.add(doc['_id'])
+        self.found.sort(key=_position, reverse=not self.after)
+        del self.found[self.limit + 1:]
+
+    def result(self):
+        if self.fields is None:
+            return self.found
+        return [{name: value for name, value in doc.items() if name == '_id' or name in self.fields}
+                for doc in self.found]
+
+
+def _needs_archive(docs, after, limit):
+    if after:
+        return decode_cursor(after)[0] < horizon()
+    return len(docs) <= limit or docs[-1]['timestamp'] < horizon()
+
+
+def _merge(docs, archived, after, limit):
+    """The limit + 1 nearest of the hot and archived candidates (hot wins if a message is in both)."""
+    ids = {doc['_id'] for doc in docs}
+    merged = docs + [doc for doc in archived if doc['_id'] not in ids]
+    merged.sort(key=_position, reverse=not after)
+    return merged[:limit + 1]
+
+
+def page(tier, key, query, before=None, after=None, limit=DEFAULT_PAGE_SIZE, projection=None):
+    """
+    keyset_page over the hot collection and its archive, ordered by (timestamp, _id).
+
+    key selects the conversation's buckets (see message_key and
+    group_message_key) and query its hot messages. projection must be an
+    inclusion projection that keeps timestamp.
+    """
+    filter_query, sort = keyset_find(query, before, after)
+    docs = list(tier.hot.find(filter_query, projection).sort(sort).limit(limit + 1))
+    if _needs_archive(docs, after, limit):
+        collector = _Collector(after or before, after, limit, projection)
+        bucket_query, bucket_sort = _bucket_find(key, after or before, after)
+        for bucket in tier.archive.find(bucket_query).sort(bucket_sort):
+            if collector.done(bucket):
+                break
+            collector.add(bucket)
+        docs = _merge(docs, collector.result(), after, limit)
+    return keyset_result(docs, limit, after)
+
+
+async def page_async(tier, key, query, before=None, after=None, limit=DEFAULT_PAGE_SIZE, projection=None):
+    """page() for async (motor) collections."""
+    filter_query, sort = keyset_find(query, before, after)
+    docs = await tier.hot.find(filter_query, projection).sort(sort).limit(limit + 1).to_list(limit + 1)
+    if _needs_archive(docs, after, limit):
+        collector = _Collector(after or before, after, limit, projection)
+        bucket_query, bucket_sort = _bucket_find(key, after or before, after)
+        async for bucket in tier.archive.find(bucket_query).sort(bucket_sort):
+            if collector.done(bucket):
+                break
+            collector.add(bucket)
+        docs = _merge(docs, collector.result(), after, limit)
+    return keyset_result(docs, limit, after)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move old messages into the compressed archive.')
+    parser.add_argument('--uri', default=None, help='MongoDB URI (defaults to MONGO_URI)')
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='messages moved per round')
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    load_dotenv()
+
+    db = MongoClient(args.uri or os.getenv('MONGO_URI'))[os.getenv('MONGO_DB_NAME', 'InOfficeMessaging')]
+    for tier in (message_tier(db.messages, db.message_archive),
+                 group_message_tier(db.group_messages, db.group_message_archive)):
+        stats = archive_old(tier, batch_size=args.batch_size)
+        ratio = stats['raw_bytes'] / stats['stored_bytes'] if stats['stored_bytes'] else 0
+        print(f"{tier.hot.name}: archived {stats['moved']} messages ({stats['buckets']} new buckets, "
+              f"{stats['raw_bytes']} bytes stored in {stats['stored_bytes']}, {ratio:.1f}x)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,454 @@
+"""
+ASGI entry point with async handlers for the messaging hot paths.
+
+    uvicorn asgi:application --workers 2
+
+The direct message, group message, inbox, sign-in and /events routes run
+as async handlers on motor, so slow queries and long-lived push streams do
+not hold a worker thread. Every other route (signup, OTP, SMS, directory,
+sync, ...) is served by the Flask app in app.py through a WSGI adapter on
+a thread pool, so the full API and its behaviour are unchanged. Needs the
+extra packages in requirements-asgi.txt.
+"""
+import asyncio
+import math
+import os
+import time
+from datetime import datetime
+
+from a2wsgi import WSGIMiddleware
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import app as flask_app
+import archive
+import attachments
+import group_inbox
+import memberships
+import metrics
+import ratelimit
+import serialization
+import summaries
+from pagination import InvalidCursor, keyset_condition, keyset_page_async, newest_cursor, parse_limit
+from pubsub import get_broker, group_channel, user_channel
+from tenancy import TENANT_FIELD, scope
+
+motor_client = AsyncIOMotorClient(os.getenv('MONGO_URI'), event_listeners=[metrics.mongo_listener])
+db = motor_client[os.getenv('MONGO_DB_NAME', 'InOfficeMessaging')]
+users_collection = db.users
+messages_collection = db.messages
+groups_collection = db.groups
+group_members_collection = db.group_members
+group_messages_collection = db.group_messages
+conversations_collection = db.conversations
+group_inbox_collection = db.group_inbox
+attachment_files_collection = db['attachments.files']
+attachment_aliases_collection = db.attachment_aliases
+message_tier = archive.message_tier(messages_collection, db.message_archive)
+group_message_tier = archive.group_message_tier(group_messages_collection, db.group_message_archive)
+
+
+class JSONResponse(Response):
+    """
+    Renders with the Flask app's JSON provider so output matches jsonify
+    (ObjectIds, dates, key order), then negotiates like respond() and the
+    Flask compression hook: MessagePack for `Accept: application/msgpack`,
+    br or gzip from COMPRESS_MIN_BYTES up (see serialization.py).
+    """
+    media_type = 'application/json'
+
+    def render(self, content):
+        self.content = content
+        return flask_app.app.json.dumps(content).encode('utf-8')
+
+    async def __call__(self, scope, receive, send):
+        request_headers = Headers(scope=scope)
+        if serialization.wants_msgpack(parse_accept_header(request_headers.get('accept'), MIMEAccept)):
+            self.body = serialization.pack(self.content)
+            self.headers['content-type'] = 'application/msgpack'
+        self.headers.add_vary_header('Accept')
+        self.headers.add_vary_header('Accept-Encoding')
+        if len(self.body) >= serialization.COMPRESS_MIN_BYTES:
+            encoding = serialization.choose_encoding(parse_accept_header(request_headers.get('accept-encoding')))
+            if encoding:
+                self.body = serialization.compress(self.body, encoding)
+                self.headers['content-encoding'] = encoding
+        self.headers['content-length'] = str(len(self.body))
+        await super().__call__(scope, receive, send)
+
+
+class MetricsMiddleware:
+    """Times a native route to its response headers, like metrics.instrument() does for Flask."""
+
+    def __init__(self, app, route):
+        self.app = app
+        self.route = route
+
+    async def __call__(self, scope, receive, send):
+        start = time.perf_counter()
+
+        async def timed_send(message):
+            if message['type'] == 'http.response.start':
+                length = dict(message.get('headers', ())).get(b'content-length')
+                metrics.observe_request(self.route, scope['method'], message['status'], time.perf_counter() - start,
+                                        int(length) if length else None, path=scope['path'])
+            await send(message)
+
+        await self.app(scope, receive, timed_send)
+
+
+async def get_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def rate_limit(route, request, data):
+    """Return a 429 response if the request is over its limits (see ratelimit.py), else None."""
+    ip = request.client.host if request.client else None
+    if ratelimit.get_store().blocking:
+        retry_after = await run_in_threadpool(ratelimit.check, route, ip, data)
+    else:
+        retry_after = ratelimit.check(route, ip, data)
+    if retry_after:
+        seconds = math.ceil(retry_after)
+        return JSONResponse({'error': 'Too many requests. Try again later.', 'retry_after': seconds}, 429,
+                            headers={'Retry-After': str(seconds)})
+    return None
+
+
+# The caches are shared with the Flask routes, so their invalidations apply here too
+async def get_user(email):
+    return await flask_app.user_cache.aget_or_load(
+        email, lambda: users_collection.find_one({'email': email}, {'_id': 0}))
+
+
+async def get_group(group_id):
+    return await flask_app.group_cache.aget_or_load(
+        str(group_id), lambda: groups_collection.find_one({'_id': ObjectId(group_id)}))
+
+
+async def get_member_groups(email):
+    async def load():
+        company = await get_company(email)
+        group_ids = await memberships.member_group_ids_async(scope(group_members_collection, company), email)
+        if not group_ids:
+            return []
+        return await groups_collection.find({'_id': {'$in': group_ids}},
+                                            {'_id': 1, 'group_name': 1, 'fanout': 1, TENANT_FIELD: 1}).to_list(None)
+    return await flask_app.member_groups_cache.aget_or_load(email, load)
+
+
+async def get_company(email):
+    user = await get_user(email)
+    return user.get('company_name') if user else None
+
+
+async def conversation_company(a, b):
+    return await get_company(a) or await get_company(b)
+
+
+async def signin(request):
+    user_data = await get_json(request)
+    if not user_data or 'email' not in user_data:
+        return JSONResponse({'error': 'Email is required.'}, 400)
+
+    if await get_user(user_data.get('email')):
+        return JSONResponse({'success': True, 'message': 'Sign in successful.'}, 200)
+    return JSONResponse({'error': 'Email not registered. Please sign up.'}, 404)
+
+
+async def get_records(request):
+    try:
+        user = await get_user(request.query_params.get('email'))
+        if user is None:
+            return JSONResponse({'error': 'User not found.'}, 404)
+        return JSONResponse(user, 200)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def send_message(request):
+    data = await get_json(request)
+    limited = await rate_limit('send_message', request, data)
+    if limited:
+        return limited
+    if data is None:
+        return JSONResponse({'success': False, 'error': 'No data received'}, 400)
+
+    sender = data.get('sender')
+    receiver = data.get('receiver')
+    message = data.get('message')
+    timestamp = data.get('timestamp')
+    if not sender or not receiver or not (message or data.get('attachments')) or not timestamp:
+        return JSONResponse({'success': False, 'error': 'Missing required fields'}, 400)
+
+    try:
+        timestamp = datetime.strptime(timestamp, "%Y-%m-%d %I:%M %p")
+    except ValueError:
+        return JSONResponse({'success': False, 'error': 'Invalid timestamp format. Use YYYY-MM-DD hh:mm AM/PM.'}, 400)
+
+    message_data = {
+        'sender': sender,
+        'receiver': receiver,
+        'message': message or '',
+        'timestamp': timestamp,
+        'isRead': False
+    }
+    try:
+        sender_company, receiver_company = await get_company(sender), await get_company(receiver)
+        if sender_company and receiver_company and sender_company != receiver_company:
+            return JSONResponse({'success': False, 'error': 'Sender and receiver belong to different companies.'}, 403)
+        company = sender_company or receiver_company
+
+        message_attachments = await attachments.references_async(
+            attachment_files_collection, attachment_aliases_collection, data.get('attachments'))
+        if message_attachments:
+            message_data['attachments'] = message_attachments
+        await scope(messages_collection, company).insert_one(message_data)
+        await scope(conversations_collection, company).bulk_write(summaries.record_message_ops(message_data),
+                                                                  ordered=False)
+        flask_app.publish_message_event([user_channel(sender), user_channel(receiver)], 'message', message_data)
+        return JSONResponse({'success': True, 'message': 'Message sent successfully!'}, 200)
+    except attachments.InvalidAttachment as e:
+        return JSONResponse({'success': False, 'error': str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)}, 500)
+
+
+async def get_conversation(request):
+    try:
+        params = request.query_params
+        sender = params.get('sender')
+        receiver = params.get('receiver')
+        if not sender or not receiver:
+            return JSONResponse({'error': 'Sender and receiver are required.'}, 400)
+
+        conversation, next_cursor, has_more = await archive.page_async(
+            message_tier.for_company(await conversation_company(sender, receiver)),
+            {'conversation': archive.conversation_key(sender, receiver)},
+            {'$or': [{'sender': sender, 'receiver': receiver}, {'sender': receiver, 'receiver': sender}]},
+            before=params.get('before'),
+            after=params.get('after'),
+            limit=parse_limit(params.get('limit')),
+            projection=flask_app.MESSAGE_FIELDS
+        )
+
+        return JSONResponse({'success': True, 'conversation': conversation,
+                             'next_cursor': next_cursor, 'has_more': has_more,
+                             'newest_cursor': newest_cursor(conversation, params.get('after'))}, 200)
+    except InvalidCursor as e:
+        return JSONResponse({'error': str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def mark_as_read(request):
+    try:
+        data = await get_json(request) or {}
+        current_user = data.get('currentUser')
+        sender = data.get('sender')
+        receiver = data.get('receiver')
+        if not current_user or not sender or not receiver:
+            return JSONResponse({'error': 'Sender, receiver, and current user are required.'}, 400)
+        if current_user != receiver:
+            return JSONResponse({'error': 'Only the receiver can mark messages as read.'}, 403)
+
+        query = {'sender': sender, 'receiver': receiver, 'isRead': False}
+        up_to = data.get('up_to')
+        company = await conversation_company(sender, receiver)
+        if up_to:
+            marker = await scope(messages_collection, company).find_one(
+                {'_id': ObjectId(up_to), 'sender': sender, 'receiver': receiver}, {'timestamp': 1})
+            if not marker:
+                return JSONResponse({'error': 'Message not found.'}, 404)
+            query = keyset_condition(query, marker['timestamp'], marker['_id'], 'before', inclusive=True)
+        result = await scope(messages_collection, company).update_many(
+            query, {'$set': {'isRead': True, 'readAt': datetime.utcnow()}})
+
+        if result.modified_count == 0:
+            return JSONResponse({'success': True, 'message': 'No unread messages found.', 'marked': 0}, 200)
+
+        await summaries.mark_read_async(scope(conversations_collection, company), receiver, sender,
+                                        result.modified_count if up_to else None)
+        return JSONResponse({'success': True, 'message': 'Messages marked as read.',
+                             'marked': result.modified_count}, 200)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def get_user_conversations(request):
+    try:
+        user_email = request.query_params.get('email')
+        if not user_email:
+            return JSONResponse({'error': 'Email is required.'}, 400)
+
+        conversations, next_cursor, has_more = await keyset_page_async(
+            scope(conversations_collection, await get_company(user_email)),
+            {'owner': user_email},
+            before=request.query_params.get('before'),
+            limit=parse_limit(request.query_params.get('limit')),
+            field='last_timestamp',
+            projection={'owner': 0, 'last_message_id': 0, TENANT_FIELD: 0}
+        )
+
+        if request.query_params.get('presence') == '1':
+            # The presence store may be Redis, so it is read off the event loop
+            await run_in_threadpool(flask_app.annotate_presence, user_email, conversations)
+
+        return JSONResponse({'success': True,
+                             'contacts': [conversation['partner'] for conversation in conversations],
+                             'conversations': conversations,
+                             'next_cursor': next_cursor, 'has_more': has_more}, 200)
+    except InvalidCursor as e:
+        return JSONResponse({'error': str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def send_group_message(request):
+    try:
+        data = await get_json(request) or {}
+        limited = await rate_limit('send_group_message', request, data)
+        if limited:
+            return limited
+        sender = data.get('sender')
+        group_id = data.get('group_id')
+        message = data.get('message')
+        if not sender or not group_id or not (message or data.get('attachments')):
+            return JSONResponse({'error': 'Sender, group ID, and message are required.'}, 400)
+
+        group = await get_group(group_id)
+        if not group:
+            return JSONResponse({'error': 'Group not found.'}, 404)
+        company = group.get(TENANT_FIELD)
+        if not await memberships.is_member_async(scope(group_members_collection, company), group['_id'], sender):
+            return JSONResponse({'error': 'Sender is not a member of this group.'}, 403)
+
+        message_data = {
+            'group_id': ObjectId(group_id),
+            'sender': sender,
+            'message': message or '',
+            'timestamp': datetime.utcnow()
+        }
+        message_attachments = await attachments.references_async(
+            attachment_files_collection, attachment_aliases_collection, data.get('attachments'))
+        if message_attachments:
+            message_data['attachments'] = message_attachments
+        await scope(group_messages_collection, company).insert_one(message_data)
+        if group.get('fanout') == 'write':
+            members = await memberships.member_emails_async(scope(group_members_collection, company), group['_id'])
+            entries = group_inbox.inbox_entries(members, message_data)
+            if entries:
+                await scope(group_inbox_collection, company).insert_many(entries, ordered=False)
+        flask_app.publish_message_event([group_channel(group_id)], 'group_message', message_data)
+        return JSONResponse({'success': True, 'message': 'Message sent to group.'}, 200)
+    except attachments.InvalidAttachment as e:
+        return JSONResponse({'error': str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def get_group_messages(request):
+    try:
+        group_id = request.query_params.get('group_id')
+        if not group_id:
+            return JSONResponse({'error': 'Group ID is required.'}, 400)
+
+        group = await get_group(group_id)
+        messages, next_cursor, has_more = await archive.page_async(
+            group_message_tier.for_company(group.get(TENANT_FIELD) if group else None),
+            {'group_id': ObjectId(group_id)},
+            {'group_id': ObjectId(group_id)},
+            before=request.query_params.get('before'),
+            after=request.query_params.get('after'),
+            limit=parse_limit(request.query_params.get('limit')),
+            projection=flask_app.GROUP_MESSAGE_FIELDS
+        )
+
+        return JSONResponse({'success': True, 'messages': messages,
+                             'next_cursor': next_cursor, 'has_more': has_more,
+                             'newest_cursor': newest_cursor(messages, request.query_params.get('after'))}, 200)
+    except InvalidCursor as e:
+        return JSONResponse({'error': str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def list_groups(request):
+    try:
+        user_email = request.query_params.get('email')
+        if not user_email:
+            return JSONResponse({'error': 'User email is required.'}, 400)
+
+        groups = [{'_id': group['_id'], 'group_name': group.get('group_name')}
+                  for group in await get_member_groups(user_email)]
+        return JSONResponse({'success': True, 'groups': groups}, 200)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def events(request):
+    email = request.query_params.get('email')
+    if not email:
+        return JSONResponse({'error': 'Email is required.'}, 400)
+    try:
+        group_ids = [str(group['_id']) for group in await get_member_groups(email)]
+        subscription = await get_broker().subscribe_async(
+            [user_channel(email)] + [group_channel(group_id) for group_id in group_ids])
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+    async def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                payload = await subscription.get(timeout=flask_app.PUSH_KEEPALIVE)
+                if payload is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield f'data: {payload}\n\n'
+        except asyncio.CancelledError:
+            pass  # Client disconnected
+        finally:
+            await subscription.aclose()
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# flask-cors already handles the mounted Flask routes
+cors = Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+
+
+def route(path, endpoint, method):
+    return Route(path, endpoint, methods=[method, 'OPTIONS'],
+                 middleware=[Middleware(MetricsMiddleware, route=path), cors])
+
+
+routes = [
+    route('/signin', signin, 'POST'),
+    route('/getrecords', get_records, 'GET'),
+    route('/send_message', send_message, 'POST'),
+    route('/get_conversation', get_conversation, 'GET'),
+    route('/mark_as_read', mark_as_read, 'POST'),
+    route('/get_user_conversations', get_user_conversations, 'GET'),
+    route('/send_group_message', send_group_message, 'POST'),
+    route('/get_group_messages', get_group_messages, 'GET'),
+    route('/list_groups', list_groups, 'GET'),
+    route('/events', events, 'GET'),
+    # Everything else is served by the Flask app on a thread pool
+    Mount('/', app=WSGIMiddleware(flask_app.app, workers=int(os.getenv('WSGI_THREADS', 10)))),
+]
+
+application = Starlette(routes=routes)
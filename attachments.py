@@ -0,0 +1,224 @@
+"""
+File attachments for direct and group messages, stored in GridFS (the
+`attachments` bucket).
+
+An upload is the raw request body. It is copied into GridFS one chunk at a
+time and hashed as it goes, so memory use stays around CHUNK_SIZE whatever
+the file size. When the upload finishes, a stored file with the same sha256
+and length is reused and the new copy dropped, so a file sent to a whole
+group is kept once. A unique index on sha256 (see indexes.py) settles
+concurrent uploads of the same file. The reused upload still gets its own
+id, filename and content type: an alias document (attachment_aliases)
+shaped like a GridFS file document that points at the shared file_id.
+
+Messages only carry references ({id, filename, content_type, length,
+sha256}). Downloads stream the file from its chunks; a single Range request
+seeks straight to the first chunk it needs.
+"""
+import hashlib
+import os
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Response, request
+from werkzeug.datastructures import ContentRange
+
+BUCKET_NAME = 'attachments'
+CHUNK_SIZE = 255 * 1024  # GridFS default
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', 25 * 1024 * 1024))
+MAX_ATTACHMENTS = 10  # Per message
+FILE_FIELDS = {'filename': 1, 'length': 1, 'sha256': 1, 'metadata.content_type': 1, 'file_id': 1}
+
+
+class InvalidAttachment(ValueError):
+    pass
+
+
+class AttachmentTooLarge(ValueError):
+    pass
+
+
+def get_bucket(db):
+    import gridfs
+    return gridfs.GridFSBucket(db, bucket_name=BUCKET_NAME, chunk_size_bytes=CHUNK_SIZE)
+
+
+def reference(file_doc):
+    """The lightweight form of a stored file (or alias) that messages carry."""
+    return {
+        'id': file_doc['_id'],
+        'filename': file_doc['filename'],
+        'content_type': file_doc.get('metadata', {}).get('content_type'),
+        'length': file_doc['length'],
+        'sha256': file_doc.get('sha256'),
+    }
+
+
+def _alias(aliases, file_doc, filename, content_type, uploader):
+    """Record another upload of a stored file under its own id, filename and content type."""
+    alias = {
+        '_id': ObjectId(),
+        'file_id': file_doc['_id'],
+        'filename': filename,
+        'length': file_doc['length'],
+        'sha256': file_doc.get('sha256'),
+        'metadata': {'content_type': content_type, 'uploader': uploader},
+    }
+    aliases.insert_one(alias)
+    return alias
+
+
+def store(bucket, files, aliases, stream, filename, content_type, uploader, max_bytes=ATTACHMENT_MAX_BYTES):
+    """
+    Copy stream into GridFS; returns (file or alias document, whether an
+    existing copy of the bytes was reused).
+    """
+    digest = hashlib.sha256()
+    length = 0
+    grid_in = bucket.open_upload_stream(filename, metadata={'content_type': content_type, 'uploader': uploader})
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            length += len(chunk)
+            if length > max_bytes:
+                raise AttachmentTooLarge(f'Attachments are limited to {max_bytes} bytes.')
+            digest.update(chunk)
+            grid_in.write(chunk)
+    except BaseException:
+        grid_in.abort()
+        raise
+
+    sha256 = digest.hexdigest()
+    existing = files.find_one({'sha256': sha256, 'length': length}, FILE_FIELDS)
+    if existing:
+        grid_in.abort()
+        return _alias(aliases, existing, filename, content_type, uploader), True
+
+    from gridfs.errors import FileExists
+    grid_in.sha256 = sha256  # Extra attributes are saved on the files document
+    try:
+        grid_in.close()
+    except FileExists:
+        # A concurrent upload stored the same file first (unique sha256); use that one
+        grid_in.abort()
+        existing = files.find_one({'sha256': sha256, 'length': length}, FILE_FIELDS)
+        return _alias(aliases, existing, filename, content_type, uploader), True
+    return files.find_one({'_id': grid_in._id}, FILE_FIELDS), False
+
+
+def parse_ids(values):
+    if values is None:
+        return []
+    if not isinstance(values, list) or len(values) > MAX_ATTACHMENTS:
+        raise InvalidAttachment(f'attachments must be a list of at most {MAX_ATTACHMENTS} ids.')
+    try:
+        return [ObjectId(value) for value in values]
+    except (InvalidId, TypeError):
+        raise InvalidAttachment('Invalid attachment id.')
+
+
+def _unresolved(ids, by_id):
+    return [_id for _id in ids if _id not in by_id]
+
+
+def _references(ids, by_id):
+    missing = [str(_id) for _id in _unresolved(ids, by_id)]
+    if missing:
+        raise InvalidAttachment(f"Unknown attachment: {', '.join(missing)}.")
+    return [reference(by_id[_id]) for _id in ids]
+
+
+def references(files, aliases, values):
+    """Resolve the attachment ids a client sent with a message into references (aliases only read if needed)."""
+    ids = parse_ids(values)
+    if not ids:
+        return []
+    by_id = {doc['_id']: doc for doc in files.find({'_id': {'$in': ids}}, FILE_FIELDS)}
+    unresolved = _unresolved(ids, by_id)
+    if unresolved:
+        by_id.update((doc['_id'], doc) for doc in aliases.find({'_id': {'$in': unresolved}}, FILE_FIELDS))
+    return _references(ids, by_id)
+
+
+async def references_async(files, aliases, values):
+    """references() for async (motor) collections."""
+    ids = parse_ids(values)
+    if not ids:
+        return []
+    by_id = {doc['_id']: doc for doc in await files.find({'_id': {'$in': ids}}, FILE_FIELDS).to_list(None)}
+    unresolved = _unresolved(ids, by_id)
+    if unresolved:
+        docs = await aliases.find({'_id': {'$in': unresolved}}, FILE_FIELDS).to_list(None)
+        by_id.update((doc['_id'], doc) for doc in docs)
+    return _references(ids, by_id)
+
+
+def open_download(bucket, aliases, attachment_id):
+    """Return (GridOut, alias document or None) for the attachment; raises gridfs.NoFile or InvalidAttachment."""
+    from gridfs.errors import NoFile
+    try:
+        _id = ObjectId(attachment_id)
+    except (InvalidId, TypeError):
+        raise InvalidAttachment('Invalid attachment id.')
+    try:
+        return bucket.open_download_stream(_id), None
+    except NoFile:
+        alias = aliases.find_one({'_id': _id})
+        if alias is None:
+            raise
+        return bucket.open_download_stream(alias['file_id']), alias
+
+
+def _iter_range(grid_out, start, stop):
+    try:
+        grid_out.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = grid_out.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        grid_out.close()
+
+
+def download_response(grid_out, alias=None):
+    """
+    A streamed response for the current request, honouring If-None-Match
+    and a single byte Range. An alias supplies its own filename and type.
+    """
+    length = grid_out.length
+    etag = getattr(grid_out, 'sha256', None) or str(grid_out._id)
+    if request.if_none_match.contains(etag):
+        grid_out.close()
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    start, stop, status = 0, length, 200
+    byte_range = request.range
+    # Serve the whole file for multi-range requests, or when If-Range names another version
+    if byte_range is not None and len(byte_range.ranges) == 1 and request.if_range.etag in (None, etag):
+        bounds = byte_range.range_for_length(length)
+        if bounds is None:
+            grid_out.close()
+            response = Response(status=416)
+            response.content_range = ContentRange('bytes', None, None, length)
+            return response
+        (start, stop), status = bounds, 206
+
+    described = alias or {'filename': grid_out.filename, 'metadata': grid_out.metadata or {}}
+    metadata = described['metadata']
+    response = Response(_iter_range(grid_out, start, stop), status=status, direct_passthrough=True,
+                        content_type=metadata.get('content_type') or 'application/octet-stream')
+    response.content_length = stop - start
+    if status == 206:
+        response.content_range = ContentRange('bytes', start, stop, length)
+    response.accept_ranges = 'bytes'
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 31536000  # An id always names the same bytes
+    response.headers.set('Content-Disposition', 'attachment', filename=described['filename'])
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
@@ -0,0 +1,172 @@
+"""
+Concurrency of the Flask (WSGI) app vs. the ASGI entry point.
+
+    python -m benchmarks.asgi_concurrency --mongomock
+    python -m benchmarks.asgi_concurrency --uri mongodb://localhost:27017 --streams 100 --out asgi.json
+
+The WSGI server is limited to --wsgi-threads concurrent requests, like a
+gunicorn worker with that many threads. For each server, --streams clients
+hold an /events push connection open while --concurrency clients fetch
+/get_conversation; the report has throughput, latency percentiles and
+errors (timeouts) for both.
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.common import add_database_arguments, load_app, percentile
+
+
+class BoundedWSGI:
+    """Admit at most `threads` requests at once; streaming responses hold their slot until closed."""
+
+    def __init__(self, app, threads):
+        self.app = app
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def __call__(self, environ, start_response):
+        self.slots.acquire()
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            self.slots.release()
+            raise
+        return _ReleasingIterable(body, self.slots)
+
+
+class _ReleasingIterable:
+    def __init__(self, body, slots):
+        self.body = body
+        self.slots = slots
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.slots.release()
+
+
+def start_wsgi(app, threads):
+    server = make_server('127.0.0.1', 0, BoundedWSGI(app, threads), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server.shutdown
+
+
+def start_asgi(application):
+    import socket
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    server = uvicorn.Server(uvicorn.Config(application, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+    return f'http://127.0.0.1:{port}', stop
+
+
+def hold_stream(base_url, i, stop):
+    try:
+        with requests.get(f'{base_url}/events', params={'email': f'listener{i}@bench.local'},
+                          stream=True, timeout=(5, 2)) as response:
+            for _ in response.iter_lines():
+                if stop.is_set():
+                    return
+    except requests.RequestException:
+        pass
+
+
+def measure(base_url, args):
+    stop = threading.Event()
+    streams = [threading.Thread(target=hold_stream, args=(base_url, i, stop), daemon=True)
+               for i in range(args.streams)]
+    for thread in streams:
+        thread.start()
+    time.sleep(1)  # Let the streams connect
+
+    def fetch(_):
+        start = time.perf_counter()
+        try:
+            response = requests.get(f'{base_url}/get_conversation',
+                                    params={'sender': 'a@bench.local', 'receiver': 'b@bench.local', 'limit': 50},
+                                    timeout=args.timeout)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        return ok, (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(fetch, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+
+    latencies = [ms for ok, ms in results if ok]
+    return {
+        'requests': args.requests,
+        'errors': sum(1 for ok, _ in results if not ok),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_database_arguments(parser)
+    parser.add_argument('--streams', type=int, default=50, help='open /events connections during the run')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--wsgi-threads', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=10, help='per-request timeout in seconds')
+    parser.add_argument('--out', help='write results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app = load_app(args.uri, args.mongomock)
+    if args.mongomock:
+        # Point motor at the same in-memory store as the Flask app
+        import database
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+        motor.motor_asyncio.AsyncIOMotorClient = lambda *a, **kw: AsyncMongoMockClient(
+            mock_mongo_client=database.get_client())
+    import asgi
+
+    client = app.app.test_client()
+    for i in range(200):
+        client.post('/send_message', json={'sender': 'a@bench.local', 'receiver': 'b@bench.local',
+                                           'message': f'seed {i}', 'timestamp': '2024-01-01 09:00 AM'})
+
+    results = {}
+    for name, start in (('wsgi', lambda: start_wsgi(app.app, args.wsgi_threads)),
+                        ('asgi', lambda: start_asgi(asgi.application))):
+        base_url, stop = start()
+        results[name] = measure(base_url, args)
+        stop()
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Cold-start cost of app.py, measured in fresh interpreters.
+
+    python -m benchmarks.cold_start --uri mongodb://localhost:27017
+    python -m benchmarks.cold_start --uri mongodb://localhost:27017 --compare HEAD~1 --runs 10 --out cold.json
+
+Each run starts a new Python process that imports app.py, then makes a
+first database request (/signin) and a first mail request (/send_sms, which
+only queues). The report has the median import, first-request times and
+loaded module count. --compare also measures other git revisions,
+exported to a temporary directory, so before/after numbers come from the
+same machine. With --mongomock, pymongo is imported before the timer starts
+and there is no connection setup, so only use it to check that the script runs.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+from io import BytesIO
+
+from benchmarks.common import BENCH_DB_NAME, add_database_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r'''
+import json, os, sys, time
+if os.environ.get('BENCH_MONGOMOCK') == '1':
+    import mongomock, pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+client.post('/signin', json={'email': 'cold-start@bench.local'})
+first_db = time.perf_counter()
+client.post('/send_sms', json={'numbers': ['5550000000'], 'message': 'cold start'})
+first_mail = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_db_request_ms': (first_db - imported) * 1000,
+    'first_mail_request_ms': (first_mail - first_db) * 1000,
+    'modules': len(sys.modules),
+}))
+'''
+
+
+def export_revision(revision, directory):
+    """Write the tree of a git revision into directory."""
+    archive = subprocess.check_output(['git', 'archive', '--format=tar', revision], cwd=ROOT)
+    with tarfile.open(fileobj=BytesIO(archive)) as tar:
+        tar.extractall(directory)
+
+
+def measure(source_dir, args):
+    env = dict(os.environ, MONGO_DB_NAME=BENCH_DB_NAME, PYTHONDONTWRITEBYTECODE='1',
+               # Mail is only queued; point the workers somewhere harmless
+               SMTP_HOST='127.0.0.1', SMTP_USE_TLS='0', SMS_SMTP_PORT='9', OTP_SMTP_PORT='9')
+    if args.mongomock:
+        env['BENCH_MONGOMOCK'] = '1'
+    else:
+        env['MONGO_URI'] = args.uri or os.getenv('MONGO_URI', 'mongodb://localhost:27017')
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=source_dir, env=env,
+                                         stderr=subprocess.DEVNULL, text=True)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_database_arguments(parser)
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per revision')
+    parser.add_argument('--compare', action='append', default=[], metavar='REVISION',
+                        help='also measure this git revision (repeatable)')
+    parser.add_argument('--out', help='write results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    results = {'working tree': measure(ROOT, args)}
+    for revision in args.compare:
+        with tempfile.TemporaryDirectory() as directory:
+            export_revision(revision, directory)
+            results[revision] = measure(directory, args)
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
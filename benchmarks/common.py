@@ -0,0 +1,124 @@
+"""
+Shared helpers for the benchmark scripts.
+
+Benchmarks run against a local mongod (--uri) or, with --mongomock, an
+in-memory mongomock stand-in. Database operations are counted with a
+pymongo command listener, or by wrapping mongomock's collection methods.
+"""
+import functools
+import os
+import sys
+import threading
+from collections import Counter
+
+from pymongo import monitoring
+
+BENCH_DB_NAME = 'InOfficeMessagingBench'
+READ_COMMANDS = {'find', 'getMore', 'aggregate', 'distinct', 'count'}
+MONGOMOCK_OPERATIONS = {
+    'find': 'find', 'find_one': 'find', 'count_documents': 'count', 'distinct': 'distinct',
+    'aggregate': 'aggregate', 'insert_one': 'insert', 'insert_many': 'insert',
+    'update_one': 'update', 'update_many': 'update', 'bulk_write': 'update',
+    'delete_one': 'delete', 'delete_many': 'delete', 'find_one_and_update': 'findAndModify',
+    'find_one_and_delete': 'findAndModify',
+}
+
+
+class OpCounter(monitoring.CommandListener):
+    """Counts database commands by name, for both pymongo and mongomock."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def started(self, event):
+        self.record(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    @property
+    def total(self):
+        with self._lock:
+            return sum(self.counts.values())
+
+    @property
+    def reads(self):
+        with self._lock:
+            return sum(n for name, n in self.counts.items() if name in READ_COMMANDS)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+    def wrap_mongomock(self):
+        import mongomock.collection
+
+        def counted(method, name):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                # mongomock calls its own public methods internally; count the outermost only
+                if getattr(self._local, 'depth', 0):
+                    return method(*args, **kwargs)
+                self.record(name)
+                self._local.depth = 1
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    self._local.depth = 0
+            return wrapper
+
+        for attr, name in MONGOMOCK_OPERATIONS.items():
+            setattr(mongomock.collection.Collection, attr,
+                    counted(getattr(mongomock.collection.Collection, attr), name))
+
+
+def load_app(uri=None, use_mongomock=False, counter=None):
+    """Import app.py against the chosen database and return the module."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+
+    # Never touch the application database
+    os.environ.setdefault('MONGO_DB_NAME', BENCH_DB_NAME)
+    # Load generators come from one address and would trip the rate limits
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+    if use_mongomock:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        if counter is not None:
+            counter.wrap_mongomock()
+    else:
+        os.environ['MONGO_URI'] = uri or os.getenv('MONGO_URI', 'mongodb://localhost:27017')
+        if counter is not None:
+            monitoring.register(counter)
+
+    import app
+    return app
+
+
+def add_database_arguments(parser):
+    parser.add_argument('--uri', default=None, help='local MongoDB URI (default: MONGO_URI or localhost)')
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory mongomock database')
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
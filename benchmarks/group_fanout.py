@@ -0,0 +1,87 @@
+"""
+Compare fan-out-on-write and fan-out-on-read for groups of increasing size.
+
+    python -m benchmarks.group_fanout --mongomock
+    python -m benchmarks.group_fanout --uri mongodb://localhost:27017 --out fanout.json
+
+For each group size a reader joins --groups groups of that size. The
+benchmark times /send_group_message and the reader's /group_activity in
+both modes, weights them by --reads-per-send and reports the largest size
+where fan-out-on-write is still cheaper: a candidate for
+GROUP_FANOUT_MAX_MEMBERS.
+"""
+import argparse
+import json
+import time
+
+from benchmarks.common import add_database_arguments, load_app
+
+COLLECTIONS = ('groups', 'group_members', 'group_messages', 'group_inbox')
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def run_case(app, size, mode, args):
+    import group_inbox
+    for name in COLLECTIONS:
+        app.db.drop_collection(name)
+    for cache in (app.group_cache, app.member_groups_cache):
+        cache.backend.clear()
+    # 'write' fans out every group in this run, 'read' none of them
+    group_inbox.GROUP_FANOUT_MAX_MEMBERS = size if mode == 'write' else 0
+
+    client = app.app.test_client()
+    reader = 'reader@bench.local'
+    group_ids = []
+    for g in range(args.groups):
+        members = [reader] + [f'member{g}-{i}@bench.local' for i in range(size - 1)]
+        group_ids.append(client.post('/create_group', json={'group_name': f'g{g}', 'members': members}).json['group_id'])
+
+    sends = iter(range(10 ** 9))
+
+    def send():
+        group_id = group_ids[next(sends) % len(group_ids)]
+        client.post('/send_group_message', json={'sender': reader, 'group_id': group_id, 'message': 'benchmark'})
+
+    send_ms = timed(send, args.messages)
+    read_ms = timed(lambda: client.get('/group_activity', query_string={'email': reader, 'limit': 50}), args.reads)
+    return {'size': size, 'mode': mode, 'send_ms': send_ms, 'read_ms': read_ms,
+            'weighted_ms': send_ms + args.reads_per_send * read_ms}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_database_arguments(parser)
+    parser.add_argument('--sizes', default='5,10,25,50,100,250,500,1000', help='comma separated group sizes')
+    parser.add_argument('--groups', type=int, default=20, help='groups the reader belongs to')
+    parser.add_argument('--messages', type=int, default=200, help='group messages sent per case')
+    parser.add_argument('--reads', type=int, default=100, help='activity reads timed per case')
+    parser.add_argument('--reads-per-send', type=float, default=5, help='expected activity reads per message sent')
+    parser.add_argument('--out', help='write results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    app = load_app(args.uri, args.mongomock)
+    results = []
+    threshold = 0
+    for size in [int(size) for size in args.sizes.split(',')]:
+        write, read = run_case(app, size, 'write', args), run_case(app, size, 'read', args)
+        results += [write, read]
+        if write['weighted_ms'] <= read['weighted_ms']:
+            threshold = size
+        print(f"size {size:>5}: write send {write['send_ms']:.2f}ms read {write['read_ms']:.2f}ms | "
+              f"read send {read['send_ms']:.2f}ms read {read['read_ms']:.2f}ms")
+
+    summary = {'suggested_GROUP_FANOUT_MAX_MEMBERS': threshold, 'results': results}
+    print(f'Suggested GROUP_FANOUT_MAX_MEMBERS={threshold}')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
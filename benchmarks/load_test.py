@@ -0,0 +1,391 @@
+"""
+Load test for the HTTP routes in app.py (see SKIPPED_ROUTES for the rest).
+
+    python -m benchmarks.load_test --mongomock --users-per-company 500 --requests 200
+    python -m benchmarks.load_test --uri mongodb://localhost:27017 --out results.json
+    python -m benchmarks.load_test --uri mongodb://localhost:27017 --baseline results.json --out new.json
+
+Seeds the benchmark database with --companies companies of
+--users-per-company users, --dm-pairs direct conversations of
+--dm-messages messages, --groups large groups and --small-groups small
+(fanned-out) ones, plus unverified users with codes for the OTP routes and
+one stored attachment. Then each route in turn gets --requests requests
+from --concurrency clients over HTTP. For every route the report has
+throughput, p50/p95/p99 latency, errors and database operations per
+request. /events is timed to its first chunk, i.e. until the subscription
+is open. Mail from /signup, /resend-otp and /send_sms goes to a local SMTP
+sink. /search needs the text indexes of a real mongod (python indexes.py);
+under --mongomock every /search request is an error. Results are tagged
+with the git revision; --baseline prints the change against an earlier run.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.common import OpCounter, add_database_arguments, load_app, percentile
+from benchmarks.smtp_sink import SMTPSink
+
+SEED_BATCH = 5000
+SEED_START = datetime(2024, 1, 1)
+ATTACHMENT_BYTES = 64 * 1024
+
+# Routes without a scenario, and why
+SKIPPED_ROUTES = {
+    '/getr': 'debug route',
+    '/sms_status/<job_id>': 'one find_one by _id; covered by send_sms',
+    '/otp_status': 'one find_one by _id; covered by signup',
+    '/resume_deliveries': 'cron job, not client traffic',
+    '/remove_members': 'would empty the seeded groups for the routes after it',
+    '/cache_stats': 'no database access',
+    '/warmup': 'no database access',
+    '/metrics': 'no database access',
+}
+
+
+def user_email(company, i):
+    return f'user{i}@company{company}.bench.local'
+
+
+def company_name(company):
+    return f'Company {company}'
+
+
+def insert_batched(collection, docs):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == SEED_BATCH:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def seed(app, args):
+    """Fill the benchmark database and return the ids the scenarios need."""
+    import attachments
+    import group_inbox
+    import otp_store
+    import summaries
+
+    for name in ('users', 'messages', 'conversations', 'groups', 'group_members', 'group_messages', 'group_inbox',
+                 'read_cursors', 'otps', 'otp_deliveries', 'sms_jobs', 'attachments.files', 'attachments.chunks',
+                 'attachment_aliases', 'message_archive', 'group_message_archive'):
+        app.db.drop_collection(name)
+    for cache in (app.user_cache, app.group_cache, app.member_groups_cache):
+        cache.backend.clear()
+
+    insert_batched(app.users_collection, ({
+        'name': f'User {i}',
+        'email': user_email(c, i),
+        'company_name': company_name(c),
+        'phone': f'555{c:03d}{i:04d}',
+        'provider': 'AT&T',
+        'signup_date': SEED_START,
+    } for c in range(args.companies) for i in range(args.users_per_company)))
+
+    # Unverified signups: one per /verify-otp request (each code is consumed) and a pool for /resend-otp
+    pending = [f'pending{i}@company0.bench.local' for i in range(args.requests)]
+    resending = [f'resending{i}@company0.bench.local' for i in range(args.requests)]
+    insert_batched(app.users_collection, ({
+        'name': 'Pending User', 'email': email, 'company_name': company_name(0), 'phone': '5550000000',
+        'provider': 'AT&T', 'signup_date': SEED_START, 'verified': False,
+    } for email in pending + resending))
+    codes = [(email, otp_store.issue(app.otps_collection, email)) for email in pending]
+
+    attachment, _ = attachments.store(
+        app.get_attachment_bucket(), app.attachment_files_collection, app.attachment_aliases_collection,
+        io.BytesIO(random.randbytes(ATTACHMENT_BYTES)), 'seeded.bin', 'application/octet-stream', user_email(0, 0))
+
+    # Direct conversations between neighbouring users of the first company, stamped with it like the routes do
+    company = company_name(0)
+    pairs = [(user_email(0, 2 * p), user_email(0, 2 * p + 1)) for p in range(args.dm_pairs)]
+    insert_batched(app.messages_collection, ({
+        'sender': pair[n % 2],
+        'receiver': pair[1 - n % 2],
+        'message': f'seeded message {n}',
+        'timestamp': SEED_START + timedelta(minutes=n),
+        'isRead': n < args.dm_messages - 20,
+        'company_name': company,
+    } for pair in pairs for n in range(args.dm_messages)))
+    summaries.rebuild(app.messages_collection, app.conversations_collection)
+
+    group_ids = []
+    group_members = {}
+    sizes = [args.group_size] * args.groups + [args.small_group_size] * args.small_groups
+    for g, size in enumerate(sizes):
+        members = [user_email(0, i) for i in range(min(size, args.users_per_company))]
+        group_id = app.groups_collection.insert_one({
+            'group_name': f'Group {g}',
+            'member_count': len(members),
+            'fanout': group_inbox.fanout_mode(len(members)),
+            'company_name': company,
+            'created_at': SEED_START,
+        }).inserted_id
+        insert_batched(app.group_members_collection, ({'group_id': group_id, 'member': member, 'joined_at': SEED_START,
+                                                       'company_name': company} for member in members))
+        messages = [{
+            'group_id': group_id,
+            'sender': members[n % len(members)],
+            'message': f'seeded group message {n}',
+            'timestamp': SEED_START + timedelta(minutes=n),
+            'company_name': company,
+        } for n in range(args.group_messages)]
+        insert_batched(app.group_messages_collection, messages)
+        if group_inbox.fanout_mode(len(members)) == 'write':
+            insert_batched(app.group_inbox_collection, (dict(entry, company_name=company) for message in messages
+                                                        for entry in group_inbox.inbox_entries(members, message)))
+        group_ids.append(str(group_id))
+        group_members[str(group_id)] = members
+
+    return {'pairs': pairs, 'group_ids': group_ids, 'group_members': group_members, 'codes': codes,
+            'resending': resending, 'attachment_id': str(attachment['_id'])}
+
+
+def build_scenarios(ctx, args):
+    """Map route name -> function(i) returning (method, path, request kwargs)."""
+    pairs = ctx['pairs']
+    group_ids = ctx['group_ids']
+    run_id = int(time.time())
+    since = (datetime.utcnow() - timedelta(minutes=5)).isoformat()
+
+    def any_user():
+        return user_email(random.randrange(args.companies), random.randrange(args.users_per_company))
+
+    def member():
+        # Users of the first company belong to the seeded groups and conversations
+        return user_email(0, random.randrange(min(args.users_per_company, 2 * len(pairs) or 1)))
+
+    def pair():
+        return random.choice(pairs)
+
+    def send_group_message(i):
+        # Only members may post
+        group_id = random.choice(group_ids)
+        return 'POST', '/send_group_message', {'json': {
+            'sender': random.choice(ctx['group_members'][group_id]), 'group_id': group_id, 'message': 'load test'}}
+
+    payload = random.randbytes(ATTACHMENT_BYTES)
+
+    def upload_attachment(i):
+        # A distinct prefix per request so each upload is stored rather than deduplicated
+        return 'POST', '/attachments', {'params': {'email': member(), 'filename': f'load-{i}.bin'},
+                                        'data': f'{run_id}-{i}:'.encode() + payload,
+                                        'headers': {'Content-Type': 'application/octet-stream'}}
+
+    def verify_otp(i):
+        email, code = ctx['codes'][i % len(ctx['codes'])]
+        return 'POST', '/verify-otp', {'json': {'email': email, 'otp': code}}
+
+    def mark_as_read(i):
+        # Only the receiver may mark a conversation as read
+        sender, receiver = pair()
+        return 'POST', '/mark_as_read', {'json': {'sender': sender, 'receiver': receiver, 'currentUser': receiver}}
+
+    return {
+        'home': lambda i: ('GET', '/', {}),
+        'create_post': lambda i: ('POST', '/create_post', {'json': {'email': any_user(), 'phone': '5550000000'}}),
+        'signup': lambda i: ('POST', '/signup', {'json': {
+            'name': 'Load Test', 'email': f'new{run_id}-{i}@bench.local', 'company_name': company_name(0),
+            'phone': '5550000000', 'provider': 'AT&T'}}),
+        'signin': lambda i: ('POST', '/signin', {'json': {'email': any_user()}}),
+        'verify_otp': verify_otp,
+        'resend_otp': lambda i: ('POST', '/resend-otp', {'json': {'email': random.choice(ctx['resending'])}}),
+        'getrecords': lambda i: ('GET', '/getrecords', {'params': {'email': any_user()}}),
+        'get_forms_company_name': lambda i: ('GET', '/get_forms_company_name', {'params': {
+            'company_name': company_name(random.randrange(args.companies))}}),
+        'directory': lambda i: ('GET', '/directory', {'params': {
+            'company_name': company_name(random.randrange(args.companies))}}),
+        'send_sms': lambda i: ('POST', '/send_sms', {'json': {
+            'numbers': ['5550000000', '5550000001'], 'message': 'load test', 'provider': 'AT&T'}}),
+        'events': lambda i: ('GET', '/events', {'params': {'email': member()}, 'stream': True}),
+        'presence_heartbeat': lambda i: ('POST', '/presence/heartbeat', {'json': {
+            'email': member(), 'status': random.choice(('online', 'away'))}}),
+        'presence_typing': lambda i: ('POST', '/presence/typing', {'json': dict(zip(
+            ('email', 'receiver'), pair()))}),
+        'presence': lambda i: ('GET', '/presence', {'params': {
+            'emails': ','.join(member() for _ in range(20)), 'email': member()}}),
+        'presence_group': lambda i: ('GET', '/presence', {'params': {'group_id': random.choice(group_ids)}}),
+        'send_message': lambda i: ('POST', '/send_message', {'json': dict(zip(
+            ('sender', 'receiver'), pair()), message='load test', timestamp='2024-06-01 09:00 AM')}),
+        'send_messages': lambda i: ('POST', '/send_messages', {'json': {
+            'sender': member(), 'receivers': [member() for _ in range(10)], 'message': 'load test',
+            'timestamp': '2024-06-01 09:00 AM'}}),
+        'get_conversation': lambda i: ('GET', '/get_conversation', {'params': dict(zip(
+            ('sender', 'receiver'), pair()), limit=50)}),
+        'upload_attachment': upload_attachment,
+        'download_attachment': lambda i: ('GET', f"/attachments/{ctx['attachment_id']}", {}),
+        'search': lambda i: ('GET', '/search', {'params': {'email': member(), 'q': 'seeded message'}}),
+        'get_user_conversations': lambda i: ('GET', '/get_user_conversations', {'params': {'email': member()}}),
+        'mark_as_read': mark_as_read,
+        'sync': lambda i: ('GET', '/sync', {'params': {'email': member(), 'since': since}}),
+        'create_group': lambda i: ('POST', '/create_group', {'json': {
+            'group_name': f'load {i}', 'members': [member() for _ in range(5)]}}),
+        'add_member': lambda i: ('POST', '/add_member', {'json': {
+            'group_id': random.choice(group_ids), 'new_member': member()}}),
+        'add_members': lambda i: ('POST', '/add_members', {'json': {
+            'group_id': random.choice(group_ids), 'members': [member() for _ in range(10)]}}),
+        'group_members': lambda i: ('GET', '/group_members', {'params': {
+            'group_id': random.choice(group_ids), 'limit': 100}}),
+        'send_group_message': send_group_message,
+        'get_group_messages': lambda i: ('GET', '/get_group_messages', {'params': {
+            'group_id': random.choice(group_ids), 'limit': 50}}),
+        'mark_group_read': lambda i: ('POST', '/mark_group_read', {'json': {
+            'email': member(), 'group_id': random.choice(group_ids)}}),
+        'group_unread_counts': lambda i: ('GET', '/group_unread_counts', {'params': {'email': member()}}),
+        'group_activity': lambda i: ('GET', '/group_activity', {'params': {'email': member()}}),
+        'list_groups': lambda i: ('GET', '/list_groups', {'params': {'email': member()}}),
+    }
+
+
+def run_route(base_url, scenario, counter, args):
+    local = threading.local()
+
+    def call(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        method, path, kwargs = scenario(i)
+        start = time.perf_counter()
+        try:
+            response = session.request(method, base_url + path, timeout=args.timeout, **kwargs)
+            if kwargs.get('stream'):
+                # A push stream never ends: time it until its first chunk, then hang up
+                next(response.iter_content(None), None)
+                response.close()
+            else:
+                response.content
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        return ok, (time.perf_counter() - start) * 1000
+
+    counter.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(call, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    ops = counter.snapshot()
+
+    latencies = [ms for _, ms in results]
+    return {
+        'requests': args.requests,
+        'errors': sum(1 for ok, _ in results if not ok),
+        'throughput_rps': args.requests / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'db_ops_per_request': sum(ops.values()) / args.requests,
+        'db_ops': ops,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results, baseline):
+    print(f"{'route':<24}{'p95 ms':>10}{'was':>10}{'rps':>10}{'was':>10}{'ops/req':>9}{'was':>7}")
+    for name, now in results['routes'].items():
+        then = baseline.get('routes', {}).get(name)
+        if then is None:
+            continue
+        print(f"{name:<24}{now['p95_ms']:>10.1f}{then['p95_ms']:>10.1f}"
+              f"{now['throughput_rps']:>10.1f}{then['throughput_rps']:>10.1f}"
+              f"{now['db_ops_per_request']:>9.1f}{then['db_ops_per_request']:>7.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_database_arguments(parser)
+    parser.add_argument('--companies', type=int, default=3)
+    parser.add_argument('--users-per-company', type=int, default=2000)
+    parser.add_argument('--dm-pairs', type=int, default=20)
+    parser.add_argument('--dm-messages', type=int, default=2000, help='messages per direct conversation')
+    parser.add_argument('--groups', type=int, default=3, help='large, fan-out-on-read groups')
+    parser.add_argument('--group-size', type=int, default=1000)
+    parser.add_argument('--small-groups', type=int, default=10, help='small, fan-out-on-write groups')
+    parser.add_argument('--small-group-size', type=int, default=20)
+    parser.add_argument('--group-messages', type=int, default=1000, help='messages per group')
+    parser.add_argument('--requests', type=int, default=500, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=30, help='per-request timeout in seconds')
+    parser.add_argument('--routes', help='comma separated routes to run (default: all)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for request parameters')
+    parser.add_argument('--out', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    random.seed(args.seed)
+
+    # Mail goes to the local sink; mailer reads these at import time
+    sink = SMTPSink().start()
+    os.environ.update({'SMTP_HOST': '127.0.0.1', 'SMTP_USE_TLS': '0',
+                       'SMS_SMTP_PORT': str(sink.port), 'OTP_SMTP_PORT': str(sink.port)})
+    os.environ.setdefault('EMAIL_USER', 'otp@bench.local')
+    os.environ.setdefault('PUSH_KEEPALIVE', '1')  # Streams closed by the events scenario end within a second
+
+    counter = OpCounter()
+    app = load_app(args.uri, args.mongomock, counter)
+    if args.mongomock:
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()  # For the attachment routes
+    start = time.perf_counter()
+    ctx = seed(app, args)
+    seed_s = time.perf_counter() - start
+
+    scenarios = build_scenarios(ctx, args)
+    if args.routes:
+        unknown = set(args.routes.split(',')) - set(scenarios)
+        if unknown:
+            parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+        scenarios = {name: scenarios[name] for name in args.routes.split(',')}
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    routes = {}
+    for name, scenario in scenarios.items():
+        routes[name] = run_route(base_url, scenario, counter, args)
+        print(f"{name:<24}{routes[name]['throughput_rps']:>8.1f} rps  p95 {routes[name]['p95_ms']:>7.1f} ms  "
+              f"{routes[name]['db_ops_per_request']:>5.1f} ops/req  {routes[name]['errors']} errors")
+    server.shutdown()
+
+    results = {
+        'revision': git_revision(),
+        'started_at': datetime.utcnow().isoformat(),
+        'database': 'mongomock' if args.mongomock else 'mongodb',
+        'config': {key: value for key, value in vars(args).items() if key not in ('out', 'baseline', 'uri')},
+        'seed_s': seed_s,
+        'smtp': {'messages': sink.messages, 'recipients': sink.recipients},
+        'routes': routes,
+    }
+    sink.shutdown()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(results, json.load(f))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
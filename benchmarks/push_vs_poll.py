@@ -0,0 +1,121 @@
+"""
+Load test comparing DB reads per active user for polling vs. SSE push.
+
+    python -m benchmarks.push_vs_poll --mongomock --users 20 --duration 10
+
+Each simulated user follows one direct conversation while a sender thread
+posts messages at a fixed rate. In poll mode users call /get_conversation
+every --poll-interval seconds; in push mode they hold one /events stream.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.common import OpCounter, add_database_arguments, load_app
+
+
+def partner(i):
+    return f'user{i ^ 1}@bench.local'
+
+
+def run_sender(base_url, users, rate, stop):
+    while not stop.is_set():
+        i = random.randrange(users)
+        requests.post(f'{base_url}/send_message', json={
+            'sender': f'user{i}@bench.local',
+            'receiver': partner(i),
+            'message': 'benchmark message',
+            'timestamp': time.strftime('%Y-%m-%d %I:%M %p'),
+        })
+        time.sleep(1 / rate)
+
+
+def run_poller(base_url, i, interval, stop, received):
+    cursor = None
+    while not stop.is_set():
+        params = {'sender': f'user{i}@bench.local', 'receiver': partner(i)}
+        if cursor:
+            params['after'] = cursor
+        body = requests.get(f'{base_url}/get_conversation', params=params).json()
+        cursor = body.get('newest_cursor') or cursor
+        received[i] += len(body.get('conversation', []))
+        time.sleep(interval)
+
+
+def run_subscriber(base_url, i, stop, received):
+    with requests.get(f'{base_url}/events', params={'email': f'user{i}@bench.local'}, stream=True) as response:
+        for line in response.iter_lines():
+            if stop.is_set():
+                return
+            if line.startswith(b'data:'):
+                received[i] += 1
+
+
+def run_mode(mode, base_url, counter, args):
+    stop = threading.Event()
+    received = [0] * args.users
+    if mode == 'poll':
+        clients = [threading.Thread(target=run_poller, args=(base_url, i, args.poll_interval, stop, received))
+                   for i in range(args.users)]
+    else:
+        clients = [threading.Thread(target=run_subscriber, args=(base_url, i, stop, received))
+                   for i in range(args.users)]
+    for thread in clients:
+        thread.daemon = True
+        thread.start()
+    time.sleep(0.5)  # Let subscribers connect before counting
+
+    counter.reset()
+    sender = threading.Thread(target=run_sender, args=(base_url, args.users, args.send_rate, stop), daemon=True)
+    sender.start()
+    time.sleep(args.duration)
+    stop.set()
+    sender.join()
+    reads = counter.reads
+
+    return {
+        'mode': mode,
+        'users': args.users,
+        'duration_s': args.duration,
+        'db_reads': reads,
+        'db_reads_per_user': reads / args.users,
+        'messages_received': sum(received),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_database_arguments(parser)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--poll-interval', type=float, default=1)
+    parser.add_argument('--send-rate', type=float, default=5, help='messages per second')
+    parser.add_argument('--out', help='write results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    os.environ.setdefault('PUSH_KEEPALIVE', '1')  # Lets stream readers notice the end of a run
+    counter = OpCounter()
+    app = load_app(args.uri, args.mongomock, counter).app
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    results = [run_mode(mode, base_url, counter, args) for mode in ('poll', 'push')]
+    server.shutdown()
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Read-through caches for small, hot documents (users, groups, memberships).
+
+Each Cache keeps hit/miss counters and stores entries in a backend: an
+in-process LRU with TTL by default, or Redis (CACHE_BACKEND=redis plus
+REDIS_URL) so invalidations are shared between workers. Routes that change
+the underlying documents must call invalidate(); the TTL bounds staleness
+for anything else. Cached values are shared, so callers must not mutate them.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import bson
+
+CACHE_TTL = float(os.getenv('CACHE_TTL', 60))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+
+_MISSING = object()
+
+
+class LocalBackend:
+    """Thread-safe LRU with per-entry expiry."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    """Shared backend; values are BSON encoded so ObjectId and datetime survive (requires redis)."""
+
+    def __init__(self, url, prefix):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self._redis.get(f'{self.prefix}:{key}')
+        return _MISSING if raw is None else bson.decode(raw)['v']
+
+    def set(self, key, value, ttl):
+        self._redis.set(f'{self.prefix}:{key}', bson.encode({'v': value}), px=int(ttl * 1000))
+
+    def delete(self, key):
+        self._redis.delete(f'{self.prefix}:{key}')
+
+    def clear(self):
+        for key in self._redis.scan_iter(f'{self.prefix}:*'):
+            self._redis.delete(key)
+
+
+class Cache:
+    def __init__(self, name, backend=None, ttl=CACHE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend or LocalBackend()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss. None is never cached."""
+        value = self.backend.get(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    async def aget_or_load(self, key, loader):
+        """get_or_load for async callers; loader is a coroutine function."""
+        value = self.backend.get(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await loader()
+        if value is not None:
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.backend.delete(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None}
+
+
+def make_cache(name, ttl=CACHE_TTL):
+    """Create a cache on the configured backend."""
+    if os.getenv('CACHE_BACKEND') == 'redis':
+        return Cache(name, RedisBackend(os.getenv('REDIS_URL', 'redis://localhost:6379'), f'cache:{name}'), ttl)
+    return Cache(name, ttl=ttl)
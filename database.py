@@ -0,0 +1,114 @@
+"""
+Lazily created, process-wide MongoDB client.
+
+Serverless cold starts should not pay for DNS/SRV resolution and pool
+setup at import time, so the client is only built the first time a
+collection is used and then reused for the life of the process (and across
+invocations of a warm function). Module-level code holds LazyCollection /
+LazyDatabase proxies that resolve on first attribute access.
+
+Pool settings come from the environment: MONGO_MAX_POOL_SIZE,
+MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS, MONGO_CONNECT_TIMEOUT_MS,
+MONGO_SERVER_SELECTION_TIMEOUT_MS and MONGO_SOCKET_TIMEOUT_MS. Small pools
+and short timeouts suit serverless functions, which handle one request at
+a time.
+"""
+import logging
+import os
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _int_env(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def client_options():
+    options = {
+        'maxPoolSize': _int_env('MONGO_MAX_POOL_SIZE', 100),
+        'minPoolSize': _int_env('MONGO_MIN_POOL_SIZE', 0),
+        'maxIdleTimeMS': _int_env('MONGO_MAX_IDLE_TIME_MS', None),
+        'connectTimeoutMS': _int_env('MONGO_CONNECT_TIMEOUT_MS', 10000),
+        'serverSelectionTimeoutMS': _int_env('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000),
+        'socketTimeoutMS': _int_env('MONGO_SOCKET_TIMEOUT_MS', None),
+    }
+    options = {key: value for key, value in options.items() if value is not None}
+    options['event_listeners'] = [metrics.mongo_listener]
+    return options
+
+
+def get_client():
+    """Return the shared MongoClient, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import pymongo
+                _client = pymongo.MongoClient(os.getenv('MONGO_URI'), **client_options())
+    return _client
+
+
+def get_database():
+    return get_client()[os.getenv('MONGO_DB_NAME', 'InOfficeMessaging')]
+
+
+def close():
+    """Close the shared client; the next use creates a new one."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def warm_up(background=False):
+    """Create the client and open a connection ahead of the first request."""
+    def ping():
+        try:
+            get_client().admin.command('ping')
+        except Exception as e:
+            logger.warning('MongoDB warm-up failed: %s', e)
+
+    if background:
+        threading.Thread(target=ping, name='mongo-warm-up', daemon=True).start()
+    else:
+        ping()
+
+
+class LazyDatabase:
+    """Stands in for the app's Database until it is first used."""
+
+    def __getattr__(self, name):
+        return getattr(get_database(), name)
+
+    def __getitem__(self, name):
+        return get_database()[name]
+
+
+class LazyCollection:
+    """Stands in for a Collection until it is first used."""
+
+    def __init__(self, name):
+        self._name = name
+        self._collection = None
+        self._client = None
+
+    def _resolve(self):
+        client = get_client()
+        if self._collection is None or self._client is not client:
+            self._collection = get_database()[self._name]
+            self._client = client
+        return self._collection
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __repr__(self):
+        return f'LazyCollection({self._name!r})'
@@ -0,0 +1,82 @@
+"""
+Fan-out-on-write inboxes for small groups.
+
+Groups with at most GROUP_FANOUT_MAX_MEMBERS members are marked
+fanout='write': every group message also gets a lightweight entry per
+member in group_inbox, so "my recent group activity" is one indexed range
+query. Larger groups stay fanout='read' and are merged in from
+group_messages at read time. benchmarks/group_fanout.py measures both
+modes to pick the threshold.
+"""
+import os
+
+from pagination import encode_cursor, keyset_page
+from summaries import SNIPPET_LENGTH
+from tenancy import TENANT_FIELD
+
+GROUP_FANOUT_MAX_MEMBERS = int(os.getenv('GROUP_FANOUT_MAX_MEMBERS', 100))
+
+
+def fanout_mode(member_count, threshold=None):
+    threshold = GROUP_FANOUT_MAX_MEMBERS if threshold is None else threshold
+    return 'write' if member_count <= threshold else 'read'
+
+
+def inbox_entries(members, message):
+    """Build one inbox entry per member for a stored group message."""
+    return [{
+        'member': member,
+        'group_id': message['group_id'],
+        'message_id': message['_id'],
+        'sender': message['sender'],
+        'message': message['message'][:SNIPPET_LENGTH],
+        'timestamp': message['timestamp'],
+    } for member in members]
+
+
+def fan_out(inbox_collection, members, message):
+    """Write one inbox entry per member for a stored group message."""
+    entries = inbox_entries(members, message)
+    if entries:
+        inbox_collection.insert_many(entries, ordered=False)
+
+
+def drop_group(inbox_collection, group_id):
+    """Remove a group's inbox entries once it switches to fan-out-on-read."""
+    inbox_collection.delete_many({'group_id': group_id})
+
+
+def drop_members(inbox_collection, group_id, members):
+    """Remove the inbox entries of members who left a group."""
+    inbox_collection.delete_many({'group_id': group_id, 'member': {'$in': list(members)}})
+
+
+def activity_page(inbox_collection, group_messages_collection, member, read_group_ids, before=None, limit=50):
+    """
+    Newest-first group activity for one member across all their groups.
+
+    Fanned-out groups come from the member's inbox; fan-out-on-read groups
+    (read_group_ids) are fetched from group_messages and merged in. Both are
+    ordered by (timestamp, message id), so one cursor pages through both.
+    """
+    projection = {'_id': 0, 'member': 0, TENANT_FIELD: 0}
+    entries, _, inbox_more = keyset_page(inbox_collection, {'member': member}, before=before, limit=limit,
+                                         projection=projection, tiebreak='message_id')
+
+    direct_more = False
+    if read_group_ids:
+        messages, _, direct_more = keyset_page(group_messages_collection, {'group_id': {'$in': read_group_ids}},
+                                               before=before, limit=limit)
+        entries += [{
+            'group_id': message['group_id'],
+            'message_id': message['_id'],
+            'sender': message['sender'],
+            'message': message['message'][:SNIPPET_LENGTH],
+            'timestamp': message['timestamp'],
+        } for message in messages]
+        entries.sort(key=lambda entry: (entry['timestamp'], entry['message_id']), reverse=True)
+
+    has_more = inbox_more or direct_more or len(entries) > limit
+    entries = entries[:limit]
+    next_cursor = encode_cursor(entries[-1], 'timestamp', 'message_id') if has_more and entries else None
+    return entries, next_cursor, has_more
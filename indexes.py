@@ -0,0 +1,251 @@
+"""
+Index declarations for every collection the app queries.
+
+    python indexes.py            # create missing indexes
+    python indexes.py --verify   # create them, then fail on any COLLSCAN plan
+
+Point MONGO_URI at a local mongod to run the verification; mongomock does
+not produce query plans. Compound indexes on tenant data start with
+company_name (see tenancy.py); companies with their own database get the
+same indexes there.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+from tenancy import TENANT_DATABASES, TENANT_FIELD as TENANT
+
+# collection name -> indexes the routes rely on
+INDEXES = {
+    'users': [
+        # signup / signin / verify-otp / getrecords
+        IndexModel([('email', ASCENDING)], name='email_unique', unique=True),
+        # get_forms_company_name and the paginated /directory
+        IndexModel([('company_name', ASCENDING), ('email', ASCENDING)], name='company_name_email'),
+    ],
+    'messages': [
+        # get_conversation (each $or branch) and mark_as_read, newest first
+        IndexModel([(TENANT, ASCENDING), ('sender', ASCENDING), ('receiver', ASCENDING), ('timestamp', DESCENDING),
+                    ('_id', DESCENDING)], name='company_sender_receiver_timestamp'),
+        # summaries.py rebuild and incoming-message lookups
+        IndexModel([(TENANT, ASCENDING), ('receiver', ASCENDING), ('sender', ASCENDING)],
+                   name='company_receiver_sender'),
+        # sync: new messages and read receipts per participant
+        IndexModel([(TENANT, ASCENDING), ('sender', ASCENDING), ('_id', ASCENDING)], name='company_sender_id'),
+        IndexModel([(TENANT, ASCENDING), ('receiver', ASCENDING), ('_id', ASCENDING)], name='company_receiver_id'),
+        IndexModel([(TENANT, ASCENDING), ('sender', ASCENDING), ('readAt', ASCENDING), ('_id', ASCENDING)],
+                   name='company_sender_read_at', partialFilterExpression={'readAt': {'$exists': True}}),
+        IndexModel([(TENANT, ASCENDING), ('receiver', ASCENDING), ('readAt', ASCENDING), ('_id', ASCENDING)],
+                   name='company_receiver_read_at', partialFilterExpression={'readAt': {'$exists': True}}),
+        # search (the only text index allowed on the collection; queries must name the company)
+        IndexModel([(TENANT, ASCENDING), ('message', TEXT)], name='company_message_text', default_language='english'),
+        # archive.py: oldest messages first, one company at a time
+        IndexModel([(TENANT, ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)], name='company_timestamp_id'),
+    ],
+    'conversations': [
+        # summaries.py upserts
+        IndexModel([(TENANT, ASCENDING), ('owner', ASCENDING), ('partner', ASCENDING)], name='company_owner_partner',
+                   unique=True),
+        # get_user_conversations inbox, most recent first
+        IndexModel([(TENANT, ASCENDING), ('owner', ASCENDING), ('last_timestamp', DESCENDING), ('_id', DESCENDING)],
+                   name='company_owner_last_timestamp'),
+    ],
+    'read_cursors': [
+        # read_state.py: one read mark per user and group
+        IndexModel([(TENANT, ASCENDING), ('user', ASCENDING), ('conversation', ASCENDING)],
+                   name='company_user_conversation', unique=True),
+    ],
+    'group_inbox': [
+        # group_activity: one member's fanned-out entries, newest first
+        IndexModel([(TENANT, ASCENDING), ('member', ASCENDING), ('timestamp', DESCENDING), ('message_id', DESCENDING)],
+                   name='company_member_timestamp'),
+        # dropping a group's entries when it switches to fan-out-on-read
+        IndexModel([(TENANT, ASCENDING), ('group_id', ASCENDING)], name='company_group_id'),
+    ],
+    'group_members': [
+        # memberships.py: one document per member, membership checks on sends, and paginated /group_members
+        IndexModel([(TENANT, ASCENDING), ('group_id', ASCENDING), ('member', ASCENDING)], name='company_group_member',
+                   unique=True),
+        # get_member_groups (list_groups, sends, /events), covered
+        IndexModel([(TENANT, ASCENDING), ('member', ASCENDING), ('group_id', ASCENDING)], name='company_member_group'),
+    ],
+    'group_messages': [
+        # get_group_messages, newest first
+        IndexModel([(TENANT, ASCENDING), ('group_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)],
+                   name='company_group_timestamp'),
+        # sync and group unread counts: messages past an id in a group
+        IndexModel([(TENANT, ASCENDING), ('group_id', ASCENDING), ('_id', ASCENDING)], name='company_group_id'),
+        # search
+        IndexModel([(TENANT, ASCENDING), ('message', TEXT)], name='company_message_text', default_language='english'),
+        # archive.py: oldest messages first, one company at a time
+        IndexModel([(TENANT, ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)], name='company_timestamp_id'),
+    ],
+    'message_archive': [
+        # archive.py: a conversation's buckets, newest first for `before` pages, oldest first for `after`
+        IndexModel([(TENANT, ASCENDING), ('conversation', ASCENDING), ('last_timestamp', DESCENDING),
+                    ('last_id', DESCENDING)], name='company_conversation_last'),
+        IndexModel([(TENANT, ASCENDING), ('conversation', ASCENDING), ('first_timestamp', ASCENDING),
+                    ('first_id', ASCENDING)], name='company_conversation_first'),
+    ],
+    'group_message_archive': [
+        IndexModel([(TENANT, ASCENDING), ('group_id', ASCENDING), ('last_timestamp', DESCENDING),
+                    ('last_id', DESCENDING)], name='company_group_last'),
+        IndexModel([(TENANT, ASCENDING), ('group_id', ASCENDING), ('first_timestamp', ASCENDING),
+                    ('first_id', ASCENDING)], name='company_group_first'),
+    ],
+    'attachments.files': [
+        # attachments.py: one stored copy per content hash (files without a hash are not constrained)
+        IndexModel([('sha256', ASCENDING), ('length', ASCENDING)], name='sha256_length', unique=True,
+                   partialFilterExpression={'sha256': {'$exists': True}}),
+    ],
+    'otps': [
+        # otp_store.py: MongoDB deletes codes once expires_at has passed (lookups are by _id)
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'otp_deliveries': [
+        # mailer.py: resume() looks for stale unfinished deliveries; status lookups are by _id
+        IndexModel([('status', ASCENDING), ('updated_at', ASCENDING)], name='status_updated_at'),
+        IndexModel([('updated_at', ASCENDING)], name='updated_at_ttl', expireAfterSeconds=86400),
+    ],
+    'sms_jobs': [
+        # mailer.py: resume() looks for stale jobs with unfinished recipients; status lookups are by _id
+        IndexModel([('recipients.status', ASCENDING), ('updated_at', ASCENDING)], name='recipients_status_updated_at'),
+        IndexModel([('updated_at', ASCENDING)], name='updated_at_ttl', expireAfterSeconds=86400),
+    ],
+}
+
+# (route, collection, filter, sort) for the queries each route runs.
+# Values are placeholders; only the shape matters to the planner.
+ROUTE_QUERIES = [
+    ('signin', 'users', {'email': 'someone@example.com'}, None),
+    ('get_forms_company_name', 'users', {'company_name': 'Example'}, None),
+    ('directory', 'users', {'company_name': 'Example', 'email': {'$gt': 'a@example.com'}}, [('email', ASCENDING)]),
+    ('get_conversation', 'messages', {TENANT: 'Example', '$or': [
+        {'sender': 'a@example.com', 'receiver': 'b@example.com'},
+        {'sender': 'b@example.com', 'receiver': 'a@example.com'},
+    ]}, [('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('mark_as_read', 'messages', {TENANT: 'Example', 'sender': 'a@example.com', 'receiver': 'b@example.com',
+                                  'isRead': False}, [('timestamp', DESCENDING)]),
+    ('get_user_conversations', 'conversations', {TENANT: 'Example', 'owner': 'a@example.com'},
+     [('last_timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('list_groups', 'group_members', {TENANT: 'Example', 'member': 'a@example.com'}, None),
+    ('send_group_message', 'group_members', {TENANT: 'Example', 'group_id': ObjectId(),
+                                             'member': 'a@example.com'}, None),
+    ('group_members', 'group_members', {TENANT: 'Example', 'group_id': ObjectId(),
+                                        'member': {'$gt': 'a@example.com'}}, [('member', ASCENDING)]),
+    ('get_group_messages', 'group_messages', {TENANT: 'Example', 'group_id': ObjectId()},
+     [('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('sync (messages)', 'messages', {TENANT: 'Example', '$or': [{'sender': 'a@example.com'},
+                                                                {'receiver': 'a@example.com'}],
+                                     '_id': {'$gt': ObjectId()}}, [('_id', ASCENDING)]),
+    ('sync (read receipts)', 'messages', {TENANT: 'Example', '$or': [{'sender': 'a@example.com'},
+                                                                     {'receiver': 'a@example.com'}],
+                                          'readAt': {'$gt': datetime(2024, 1, 1)}},
+     [('readAt', ASCENDING), ('_id', ASCENDING)]),
+    ('sync (group messages)', 'group_messages', {TENANT: 'Example', 'group_id': {'$in': [ObjectId(), ObjectId()]},
+                                                 '_id': {'$gt': ObjectId()}}, [('_id', ASCENDING)]),
+    ('group_activity (inbox)', 'group_inbox', {TENANT: 'Example', 'member': 'a@example.com'},
+     [('timestamp', DESCENDING), ('message_id', DESCENDING)]),
+    ('group_activity (large groups)', 'group_messages', {TENANT: 'Example',
+                                                         'group_id': {'$in': [ObjectId(), ObjectId()]}},
+     [('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('group_unread_counts', 'group_messages', {TENANT: 'Example', 'group_id': ObjectId(),
+                                               '_id': {'$gt': ObjectId()}}, None),
+    ('search (direct)', 'messages', {TENANT: 'Example', '$text': {'$search': 'lunch'},
+                                     '$or': [{'sender': 'a@example.com'}, {'receiver': 'a@example.com'}]}, None),
+    ('search (groups)', 'group_messages', {TENANT: 'Example', '$text': {'$search': 'lunch'},
+                                           'group_id': {'$in': [ObjectId(), ObjectId()]}}, None),
+    ('archive (messages)', 'messages', {TENANT: 'Example', 'timestamp': {'$lt': datetime(2024, 1, 1)},
+                                       'isRead': {'$ne': False}}, [('timestamp', ASCENDING), ('_id', ASCENDING)]),
+    ('get_conversation (archive)', 'message_archive', {TENANT: 'Example',
+                                                      'conversation': 'a@example.com\nb@example.com',
+                                                      'first_timestamp': {'$lte': datetime(2024, 1, 1)}},
+     [('last_timestamp', DESCENDING), ('last_id', DESCENDING)]),
+    ('get_group_messages (archive)', 'group_message_archive', {TENANT: 'Example', 'group_id': ObjectId(),
+                                                              'last_timestamp': {'$gte': datetime(2024, 1, 1)}},
+     [('first_timestamp', ASCENDING), ('first_id', ASCENDING)]),
+]
+
+
+# Text indexes replaced by a company-first one; a collection can only have one text index
+LEGACY_TEXT_INDEXES = {'messages': 'message_text', 'group_messages': 'message_text'}
+
+
+def replace_legacy_text_indexes(db):
+    """Drop the pre-tenancy text indexes so their company-first replacements can be created. Returns their names."""
+    dropped = []
+    for name, index_name in LEGACY_TEXT_INDEXES.items():
+        if index_name in db[name].index_information():
+            db[name].drop_index(index_name)
+            dropped.append(f'{name}.{index_name}')
+    return dropped
+
+
+def ensure_indexes(db):
+    """Create any missing indexes. Safe to run repeatedly."""
+    replace_legacy_text_indexes(db)
+    created = {}
+    for name, models in INDEXES.items():
+        created[name] = db[name].create_indexes(models)
+    return created
+
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() plan tree."""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+def collscan_routes(db):
+    """Return the routes whose winning plan contains a COLLSCAN."""
+    failures = []
+    for route, collection, query, sort in ROUTE_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in _plan_stages(winning_plan):
+            failures.append(route)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create and verify MongoDB indexes.')
+    parser.add_argument('--uri', default=None, help='MongoDB URI (defaults to MONGO_URI)')
+    parser.add_argument('--verify', action='store_true', help='fail if any route query plan is a COLLSCAN')
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    load_dotenv()
+
+    client = MongoClient(args.uri or os.getenv('MONGO_URI'))
+    db = client[os.getenv('MONGO_DB_NAME', 'InOfficeMessaging')]
+    for name, indexes in ensure_indexes(db).items():
+        print(f"{name}: {', '.join(indexes)}")
+    # Companies with a dedicated database (TENANT_DATABASES) need the same indexes there
+    for database_name in sorted(set(TENANT_DATABASES.values())):
+        ensure_indexes(client[database_name])
+        print(f"{database_name}: indexes created")
+
+    if args.verify:
+        failures = collscan_routes(db)
+        if failures:
+            print(f"COLLSCAN in: {', '.join(failures)}")
+            return 1
+        print('All route queries use an index.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,376 @@
+import logging
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import metrics
+from providers import PROVIDERS
+
+logger = logging.getLogger(__name__)
+
+# SMTP settings; point SMTP_HOST at a local stand-in (e.g. aiosmtpd) with SMTP_USE_TLS=0 for testing
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+SMTP_USE_TLS = os.getenv('SMTP_USE_TLS', '1') == '1'
+SMS_SMTP_PORT = int(os.getenv('SMS_SMTP_PORT', 465))
+OTP_SMTP_PORT = int(os.getenv('OTP_SMTP_PORT', 587))
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', 2))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', 30))
+
+SMS_WORKERS = int(os.getenv('SMS_WORKERS', 2))
+SMS_MAX_ATTEMPTS = int(os.getenv('SMS_MAX_ATTEMPTS', 3))
+SMS_RETRY_BACKOFF = float(os.getenv('SMS_RETRY_BACKOFF', 2))
+SMS_BATCH_SIZE = 50  # Recipients per SMTP transaction
+
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', 2))
+
+# 'background' sends from worker threads after the response; 'inline' sends before it, for serverless
+# functions (Vercel) that are frozen once they respond. Unfinished deliveries are retried by resume().
+MAIL_DELIVERY = os.getenv('MAIL_DELIVERY') or ('inline' if os.getenv('VERCEL') else 'background')
+DELIVERY_STALE_AFTER = float(os.getenv('DELIVERY_STALE_AFTER', 300))  # Seconds before resume() takes over
+UNFINISHED = ('queued', 'sending', 'retrying')
+
+
+class SMTPPool:
+    """A small pool of persistent, logged-in SMTP connections."""
+
+    def __init__(self, host, port, credentials=None, use_ssl=False, starttls=False,
+                 size=SMTP_POOL_SIZE, timeout=SMTP_TIMEOUT, name='smtp'):
+        self.name = name  # Label for the send duration metrics
+        self.host = host
+        self.port = port
+        self.credentials = credentials
+        self.use_ssl = use_ssl
+        self.starttls = starttls
+        self.timeout = timeout
+        self._context = None  # Created on first connect; loading CA certificates is slow
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        if (self.use_ssl or self.starttls) and self._context is None:
+            self._context = ssl.create_default_context()
+        if self.use_ssl:
+            conn = smtplib.SMTP_SSL(self.host, self.port, context=self._context, timeout=self.timeout)
+        else:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                conn.starttls(context=self._context)
+        conn.ehlo_or_helo_if_needed()
+        # Local stand-ins usually don't offer AUTH
+        if self.credentials and conn.has_extn('auth'):
+            conn.login(*self.credentials)
+        return conn
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.quit()
+        except Exception:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection; it is dropped instead of returned if the caller fails."""
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except Exception:
+                self._discard(conn)
+                raise
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def sendmail(self, from_addr, to_addrs, message):
+        """Send over a pooled connection, reconnecting once if the server dropped it."""
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            try:
+                with self.connection() as conn:
+                    result = conn.sendmail(from_addr, to_addrs, message)
+            except smtplib.SMTPServerDisconnected:
+                with self.connection() as conn:
+                    result = conn.sendmail(from_addr, to_addrs, message)
+            outcome = 'sent'
+            return result
+        finally:
+            metrics.observe_smtp(self.name, time.perf_counter() - start, outcome)
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def sms_gateway_address(number, provider):
+    """Return the email-to-SMS address for a number, or None if the carrier has no SMS gateway."""
+    gateway = (PROVIDERS.get(provider) or {}).get('sms', '').strip()
+    return f'{number}@{gateway}' if gateway else None
+
+
+class SMSDeliveryQueue:
+    """
+    Delivery of SMS-over-email, recorded in MongoDB (sms_jobs, one document
+    per job with a status per recipient) so any instance can report it.
+
+    submit() records a job and returns its id. In 'background' mode worker
+    threads send one SMTP transaction per carrier gateway batch and retry
+    failed recipients with exponential backoff. In 'inline' mode each batch
+    gets one attempt before submit() returns. Recipients left unfinished
+    either way are picked up by resume().
+    """
+
+    def __init__(self, pool, sender, jobs, mode=None, workers=SMS_WORKERS, max_attempts=SMS_MAX_ATTEMPTS,
+                 backoff=SMS_RETRY_BACKOFF):
+        self.pool = pool
+        self.sender = sender
+        self.jobs = jobs
+        self.mode = mode or MAIL_DELIVERY
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'sms-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    @staticmethod
+    def _batches(recipients):
+        """Pending recipients as (index, number, address) batches, one gateway per batch."""
+        by_gateway = {}
+        for index, recipient in enumerate(recipients):
+            if recipient['status'] not in UNFINISHED:
+                continue
+            address = recipient['address']
+            by_gateway.setdefault(address.split('@', 1)[1], []).append((index, recipient['number'], address))
+        for batch in by_gateway.values():
+            for i in range(0, len(batch), SMS_BATCH_SIZE):
+                yield batch[i:i + SMS_BATCH_SIZE]
+
+    def submit(self, numbers, message, provider, subject="NVision InOffice Messaging"):
+        job_id = uuid.uuid4().hex
+        recipients = []
+        for number in dict.fromkeys(numbers):
+            address = sms_gateway_address(number, provider)
+            if address is None:
+                recipients.append({'number': number, 'address': None, 'status': 'failed', 'attempts': 0,
+                                   'error': 'No SMS gateway for provider.'})
+            else:
+                recipients.append({'number': number, 'address': address, 'status': 'queued', 'attempts': 0,
+                                   'error': None})
+        now = datetime.utcnow()
+        self.jobs.insert_one({'_id': job_id, 'provider': provider, 'subject': subject, 'message': message,
+                              'recipients': recipients, 'created_at': now, 'updated_at': now})
+
+        if self.mode == 'inline':
+            for batch in self._batches(recipients):
+                self._deliver(job_id, subject, message, batch, 1, retry=False)
+            return job_id
+        self._start()
+        for batch in self._batches(recipients):
+            self._tasks.put((job_id, subject, message, batch, 1))
+        return job_id
+
+    def status(self, job_id):
+        job = self.jobs.find_one({'_id': job_id}, {'provider': 1, 'recipients': 1})
+        if job is None:
+            return None
+        recipients = {recipient['number']: {key: recipient[key] for key in ('status', 'attempts', 'error')}
+                      for recipient in job['recipients']}
+        counts = {}
+        for state in recipients.values():
+            counts[state['status']] = counts.get(state['status'], 0) + 1
+        return {'job_id': job_id, 'provider': job['provider'], 'counts': counts, 'recipients': recipients}
+
+    def _update(self, job_id, batch, **state):
+        # One write per batch; recipients are addressed by their position in the job's list
+        fields = {f'recipients.{index}.{key}': value for index, _, _ in batch for key, value in state.items()}
+        fields['updated_at'] = datetime.utcnow()
+        self.jobs.update_one({'_id': job_id}, {'$set': fields})
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                self._deliver(*task)
+            except Exception:
+                logger.exception('SMS worker failed')
+            finally:
+                self._tasks.task_done()
+
+    def _deliver(self, job_id, subject, message, batch, attempt, retry=True):
+        self._update(job_id, batch, status='sending', attempts=attempt)
+
+        # Bcc-style envelope so recipients don't see each other's numbers
+        email_message = f"Subject:{subject}\nTo:undisclosed-recipients:;\n\n{message}"
+        try:
+            refused = self.pool.sendmail(self.sender, [address for _, _, address in batch], email_message)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except Exception as e:
+            self._retry(job_id, subject, message, batch, attempt, str(e), retry)
+            return
+
+        sent = [recipient for recipient in batch if recipient[2] not in refused]
+        failed = [recipient for recipient in batch if recipient[2] in refused]
+        if sent:
+            self._update(job_id, sent, status='sent', error=None)
+        if failed:
+            self._retry(job_id, subject, message, failed, attempt, 'Recipient refused by server.', retry)
+
+    def _retry(self, job_id, subject, message, batch, attempt, error, retry):
+        if attempt >= self.max_attempts:
+            self._update(job_id, batch, status='failed', error=error)
+            return
+        self._update(job_id, batch, status='retrying', error=error)
+        if not retry:
+            return  # Left for resume()
+        delay = self.backoff * 2 ** (attempt - 1)
+        timer = threading.Timer(delay, self._tasks.put, args=((job_id, subject, message, batch, attempt + 1),))
+        timer.daemon = True
+        timer.start()
+
+    def resume(self, stale_after=DELIVERY_STALE_AFTER):
+        """
+        Give recipients of jobs untouched for stale_after seconds (frozen or
+        restarted instances, inline failures) their next attempt, inline.
+        Returns how many jobs were resumed.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+        resumed = 0
+        for job in self.jobs.find({'recipients.status': {'$in': list(UNFINISHED)}, 'updated_at': {'$lt': cutoff}}):
+            # Claim the job so an overlapping resume() skips it
+            claimed = self.jobs.update_one({'_id': job['_id'], 'updated_at': job['updated_at']},
+                                           {'$set': {'updated_at': datetime.utcnow()}})
+            if not claimed.modified_count:
+                continue
+            for batch in self._batches(job['recipients']):
+                attempt = max(job['recipients'][index]['attempts'] for index, _, _ in batch) + 1
+                self._deliver(job['_id'], job['subject'], job['message'], batch, attempt, retry=False)
+            resumed += 1
+        return resumed
+
+
+class OTPDispatcher:
+    """
+    Sends OTP emails over a single reused SMTP session, recording each
+    address's latest delivery in MongoDB (otp_deliveries, one document per
+    email) so any instance can report it.
+
+    In 'background' mode dispatch() only enqueues and a thread sends with
+    retries, so callers never wait on SMTP. In 'inline' mode (serverless,
+    where the process is frozen once the response is sent) dispatch() makes
+    one attempt before returning. Either way a failed or interrupted send is
+    left 'retrying' / 'queued' for resume() to pick up.
+    """
+
+    def __init__(self, pool, sender, deliveries, mode=None, max_attempts=OTP_MAX_ATTEMPTS,
+                 backoff=SMS_RETRY_BACKOFF):
+        self.pool = pool
+        self.sender = sender
+        self.deliveries = deliveries
+        self.mode = mode or MAIL_DELIVERY
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='otp-dispatcher', daemon=True)
+                self._thread.start()
+
+    def dispatch(self, email, otp):
+        self.deliveries.replace_one({'_id': email}, {'status': 'queued', 'attempts': 0, 'error': None,
+                                                     'updated_at': datetime.utcnow()}, upsert=True)
+        if self.mode == 'inline':
+            self._send(email, otp, attempts=1)
+            return
+        self._start()
+        self._tasks.put((email, otp))
+
+    def status(self, email):
+        return self.deliveries.find_one({'_id': email}, {'_id': 0, 'status': 1, 'error': 1, 'updated_at': 1})
+
+    def _set_status(self, email, status, attempts, error=None):
+        self.deliveries.update_one({'_id': email}, {'$set': {'status': status, 'attempts': attempts, 'error': error,
+                                                             'updated_at': datetime.utcnow()}})
+
+    def _run(self):
+        while True:
+            email, otp = self._tasks.get()
+            try:
+                self._send(email, otp)
+            except Exception:
+                logger.exception('OTP dispatcher failed')
+            finally:
+                self._tasks.task_done()
+
+    def _send(self, email, otp, attempts=None, first_attempt=1):
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = email
+        msg['Subject'] = "Your OTP for InOfficeMessaging"
+        msg.attach(MIMEText(f"Your OTP is {otp} ", 'plain'))
+        text = msg.as_string()
+
+        last_attempt = min(self.max_attempts, first_attempt - 1 + (attempts or self.max_attempts))
+        for attempt in range(first_attempt, last_attempt + 1):
+            try:
+                self.pool.sendmail(self.sender, email, text)
+                self._set_status(email, 'sent', attempt)
+                return
+            except Exception as e:
+                logger.warning('Failed to send OTP to %s (attempt %d): %s', email, attempt, e)
+                if attempt >= self.max_attempts:
+                    self._set_status(email, 'failed', attempt, str(e))
+                elif attempt == last_attempt:
+                    self._set_status(email, 'retrying', attempt, str(e))  # Left for resume()
+                else:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def resume(self, issue, stale_after=DELIVERY_STALE_AFTER):
+        """
+        Retry deliveries that were not finished (frozen or restarted
+        instances, inline failures). Only the code's hash is stored, so each
+        resumed send issues a fresh code with issue(email). Returns how many.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+        resumed = 0
+        for delivery in self.deliveries.find({'status': {'$in': ['queued', 'retrying']},
+                                              'updated_at': {'$lt': cutoff}}):
+            # Claim the delivery so an overlapping resume() skips it instead of issuing a second code
+            claimed = self.deliveries.update_one({'_id': delivery['_id'], 'updated_at': delivery['updated_at']},
+                                                 {'$set': {'updated_at': datetime.utcnow()}})
+            if not claimed.modified_count:
+                continue
+            self._send(delivery['_id'], issue(delivery['_id']), attempts=1,
+                       first_attempt=delivery.get('attempts', 0) + 1)
+            resumed += 1
+        return resumed
@@ -0,0 +1,126 @@
+"""
+Group membership as one group_members document per (group, member).
+
+Groups used to embed a members array, so company-wide groups meant large
+group documents and a multikey index over them. Now the group document
+only keeps member_count (and its fan-out mode), and:
+
+- "which groups is X in" is an index lookup on (company_name, member, group_id),
+- "is X in this group" is a single lookup on (company_name, group_id, member),
+- member listings page through (group_id, member) in email order,
+- adding or removing members is one bulk write, however many there are.
+
+Run `python memberships.py --migrate` once to move existing members arrays
+into the collection.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from pagination import DEFAULT_PAGE_SIZE, decode_token, encode_token
+
+MAX_MEMBERS_PER_CALL = 1000  # Emails accepted by one add/remove request
+DUPLICATE_KEY = 11000
+
+
+def add(collection, group_id, members):
+    """Add members to a group, skipping existing ones; returns the emails that were new."""
+    members = list(dict.fromkeys(members))
+    if not members:
+        return []
+    now = datetime.utcnow()
+    operations = [UpdateOne({'group_id': group_id, 'member': member}, {'$setOnInsert': {'joined_at': now}},
+                            upsert=True) for member in members]
+    try:
+        upserted = collection.bulk_write(operations, ordered=False).upserted_ids
+    except BulkWriteError as e:
+        # A concurrent add of the same member loses the race on the unique index; that is fine
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+        upserted = {item['index']: item['_id'] for item in e.details['upserted']}
+    return [members[index] for index in sorted(upserted)]
+
+
+def remove(collection, group_id, members):
+    """Remove members from a group; returns how many were members."""
+    return collection.delete_many({'group_id': group_id, 'member': {'$in': list(members)}}).deleted_count
+
+
+def member_group_ids(collection, member):
+    """Ids of every group member belongs to (a covered index read)."""
+    return [doc['group_id'] for doc in collection.find({'member': member}, {'_id': 0, 'group_id': 1})]
+
+
+async def member_group_ids_async(collection, member):
+    docs = await collection.find({'member': member}, {'_id': 0, 'group_id': 1}).to_list(None)
+    return [doc['group_id'] for doc in docs]
+
+
+def is_member(collection, group_id, member):
+    """Whether member belongs to the group: one covered read on (company_name, group_id, member)."""
+    return collection.find_one({'group_id': group_id, 'member': member}, {'_id': 0, 'member': 1}) is not None
+
+
+async def is_member_async(collection, group_id, member):
+    return await collection.find_one({'group_id': group_id, 'member': member}, {'_id': 0, 'member': 1}) is not None
+
+
+def member_emails(collection, group_id):
+    """Every member of a group; only for small (fan-out-on-write) groups."""
+    return [doc['member'] for doc in collection.find({'group_id': group_id}, {'_id': 0, 'member': 1})]
+
+
+async def member_emails_async(collection, group_id):
+    docs = await collection.find({'group_id': group_id}, {'_id': 0, 'member': 1}).to_list(None)
+    return [doc['member'] for doc in docs]
+
+
+def page(collection, group_id, after=None, limit=DEFAULT_PAGE_SIZE):
+    """One page of a group's members in email order; returns (members, next_cursor, has_more)."""
+    query = {'group_id': group_id}
+    if after:
+        query['member'] = {'$gt': decode_token(after).get('member')}
+    docs = list(collection.find(query, {'_id': 0, 'member': 1, 'joined_at': 1})
+                .sort('member', 1).limit(limit + 1))
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = encode_token({'member': docs[-1]['member']}) if has_more else None
+    return docs, next_cursor, has_more
+
+
+def migrate(groups_collection, members_collection):
+    """Move embedded members arrays into group_members; safe to rerun. Returns the groups migrated."""
+    migrated = 0
+    for group in groups_collection.find({'members': {'$exists': True}}, {'members': 1}):
+        add(members_collection, group['_id'], group['members'])
+        count = members_collection.count_documents({'group_id': group['_id']})
+        groups_collection.update_one({'_id': group['_id']},
+                                     {'$set': {'member_count': count}, '$unset': {'members': ''}})
+        migrated += 1
+    return migrated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain group memberships.')
+    parser.add_argument('--uri', default=None, help='MongoDB URI (defaults to MONGO_URI)')
+    parser.add_argument('--migrate', action='store_true', help='move members arrays into group_members')
+    args = parser.parse_args(argv)
+    if not args.migrate:
+        parser.print_help()
+        return 1
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    load_dotenv()
+
+    db = MongoClient(args.uri or os.getenv('MONGO_URI'))[os.getenv('MONGO_DB_NAME', 'InOfficeMessaging')]
+    print(f"Migrated {migrate(db.groups, db.group_members)} groups.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
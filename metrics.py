@@ -0,0 +1,200 @@
+"""
+In-process request metrics, exposed in the Prometheus text format.
+
+instrument(app) times every Flask request per route and records response
+sizes. MongoListener is a pymongo command listener that records command
+durations and counts the commands each request issues. SMTPPool reports
+its sends through observe_smtp(). Requests slower than SLOW_REQUEST_MS are
+written to the 'slow_requests' logger as one JSON object per line.
+Recording is a bisect and a short critical section per observation.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from pymongo import monitoring
+
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000))
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+slow_log = logging.getLogger('slow_requests')
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_string(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_label_string(self.labelnames, labels)} {value}' for labels, value in values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self._series = {}  # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            snapshot = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in snapshot.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_label_string(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_label_string(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_label_string(self.labelnames, labels)} {count}')
+        return lines
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Time to produce the response headers.',
+                             LATENCY_BUCKETS, ('route', 'method', 'status'))
+response_size = Histogram('http_response_size_bytes', 'Response body size (non-streamed responses).',
+                          SIZE_BUCKETS, ('route',))
+request_db_commands = Histogram('http_request_db_commands', 'MongoDB commands issued per request.',
+                                COUNT_BUCKETS, ('route',))
+mongo_duration = Histogram('mongodb_command_duration_seconds', 'MongoDB command round trips.',
+                           LATENCY_BUCKETS, ('command',))
+mongo_failures = Counter('mongodb_command_failures_total', 'MongoDB commands that failed.', ('command',))
+smtp_duration = Histogram('smtp_send_duration_seconds', 'SMTP sendmail calls, including connection setup.',
+                          LATENCY_BUCKETS, ('pool', 'outcome'))
+slow_requests = Counter('http_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS.', ('route',))
+
+# Database work done by the request running on this thread
+_request_state = threading.local()
+
+
+class MongoListener(monitoring.CommandListener):
+    """Records command durations, and per-request command counts for the calling thread."""
+
+    def _record(self, event):
+        seconds = event.duration_micros / 1e6
+        mongo_duration.observe(seconds, event.command_name)
+        if getattr(_request_state, 'active', False):
+            _request_state.commands += 1
+            _request_state.db_seconds += seconds
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        mongo_failures.inc(event.command_name)
+        self._record(event)
+
+
+mongo_listener = MongoListener()
+
+
+def begin_request():
+    _request_state.active = True
+    _request_state.commands = 0
+    _request_state.db_seconds = 0.0
+
+
+def end_request():
+    """Stop counting and return (commands, db seconds) for the request on this thread."""
+    _request_state.active = False
+    return getattr(_request_state, 'commands', 0), getattr(_request_state, 'db_seconds', 0.0)
+
+
+def observe_request(route, method, status, seconds, size=None, db_commands=None, db_seconds=None, path=None):
+    request_duration.observe(seconds, route, method, status)
+    if size is not None:
+        response_size.observe(size, route)
+    if db_commands is not None:
+        request_db_commands.observe(db_commands, route)
+    if seconds * 1000 >= SLOW_REQUEST_MS:
+        slow_requests.inc(route)
+        slow_log.warning(json.dumps({
+            'route': route, 'path': path, 'method': method, 'status': status,
+            'duration_ms': round(seconds * 1000, 1), 'response_bytes': size,
+            'db_commands': db_commands, 'db_ms': None if db_seconds is None else round(db_seconds * 1000, 1),
+        }))
+
+
+def observe_smtp(pool, seconds, outcome):
+    smtp_duration.observe(seconds, pool, outcome)
+
+
+def instrument(app):
+    """Time every request of a Flask app."""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+        begin_request()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        commands, db_seconds = end_request()
+        # Streamed responses are timed to their headers and have no known size
+        observe_request(request.url_rule.rule if request.url_rule else 'unmatched', request.method,
+                        response.status_code, time.perf_counter() - start,
+                        None if response.is_streamed else response.content_length,
+                        commands, db_seconds, request.path)
+        return response
+
+    return app
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,58 @@
+"""
+One-time signup codes, kept in their own TTL-indexed collection.
+
+Each email has at most one live code: {_id: email, code_hash, attempts,
+created_at, expires_at}. Issuing a code replaces the previous one and
+resets its attempt counter. A correct guess is checked and consumed in a
+single find_one_and_delete; a wrong guess counts an attempt, and after
+OTP_MAX_GUESSES wrong guesses the code is dead. MongoDB's TTL monitor
+purges expired codes (see indexes.py), and expires_at is also checked on
+verify because the monitor only runs about once a minute.
+"""
+import hashlib
+import os
+import secrets
+from datetime import datetime, timedelta
+
+OTP_TTL = int(os.getenv('OTP_TTL', 600))  # Seconds a code stays valid
+OTP_MAX_GUESSES = int(os.getenv('OTP_MAX_GUESSES', 5))
+
+VERIFIED = 'verified'
+INVALID = 'invalid'
+EXPIRED = 'expired'  # Missing, expired or out of attempts; a new code is needed
+
+
+def generate_code():
+    """A 6-digit code from the OS CSPRNG."""
+    return 100000 + secrets.randbelow(900000)
+
+
+def _hash(email, code):
+    return hashlib.sha256(f'{email}:{str(code).strip()}'.encode()).hexdigest()
+
+
+def issue(collection, email):
+    """Store a new code for email, replacing any previous one, and return it."""
+    code = generate_code()
+    now = datetime.utcnow()
+    collection.replace_one(
+        {'_id': email},
+        {'code_hash': _hash(email, code), 'attempts': 0, 'created_at': now,
+         'expires_at': now + timedelta(seconds=OTP_TTL)},
+        upsert=True
+    )
+    return code
+
+
+def verify(collection, email, code):
+    """Check and consume a code; returns VERIFIED, INVALID or EXPIRED."""
+    now = datetime.utcnow()
+    if collection.find_one_and_delete({'_id': email, 'code_hash': _hash(email, code),
+                                       'attempts': {'$lt': OTP_MAX_GUESSES}, 'expires_at': {'$gt': now}},
+                                      projection={'_id': 1}):
+        return VERIFIED
+
+    # Wrong guess: count it against the live code, if there is one
+    result = collection.update_one({'_id': email, 'attempts': {'$lt': OTP_MAX_GUESSES}, 'expires_at': {'$gt': now}},
+                                   {'$inc': {'attempts': 1}})
+    return INVALID if result.matched_count else EXPIRED
@@ -0,0 +1,135 @@
+import base64
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(doc, field='timestamp', tiebreak='_id'):
+    """Build an opaque cursor from the (sort field, tiebreak id) pair of a document."""
+    raw = f"{doc[field].isoformat()}|{doc[tiebreak]}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into its (datetime, ObjectId) pair."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, _id = base64.urlsafe_b64decode(padded.encode()).decode().rsplit('|', 1)
+        return datetime.fromisoformat(value), ObjectId(_id)
+    except (ValueError, TypeError, InvalidId, UnicodeDecodeError):
+        raise InvalidCursor('Invalid cursor.')
+
+
+def encode_token(data):
+    """Build an opaque token from a small JSON-serializable dict."""
+    raw = json.dumps(data, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_token(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise InvalidCursor('Invalid cursor.')
+    if not isinstance(data, dict):
+        raise InvalidCursor('Invalid cursor.')
+    return data
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Clamp a client supplied page size to [1, maximum]."""
+    if value is None or value == '':
+        return default
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise InvalidCursor('limit must be an integer.')
+    return max(1, min(limit, maximum))
+
+
+def keyset_condition(query, value, _id, direction, field='timestamp', tiebreak='_id', inclusive=False):
+    """Restrict query to documents ordered before or after (value, _id), optionally including it."""
+    op = '$lt' if direction == 'before' else '$gt'
+    keyset = {'$or': [
+        {field: {op: value}},
+        {field: value, tiebreak: {op + 'e' if inclusive else op: _id}},
+    ]}
+    return {'$and': [query, keyset]} if query else keyset
+
+
+def keyset_query(query, cursor, direction, field='timestamp', tiebreak='_id'):
+    """Add the keyset condition for a page older ('before') or newer ('after') than cursor."""
+    if not cursor:
+        return query
+    value, _id = decode_cursor(cursor)
+    return keyset_condition(query, value, _id, direction, field, tiebreak)
+
+
+def keyset_find(query, before=None, after=None, field='timestamp', tiebreak='_id'):
+    """Return the (filter, sort) for one keyset window; shared by the sync and async drivers."""
+    if before and after:
+        raise InvalidCursor('Use either before or after, not both.')
+
+    direction = 'after' if after else 'before'
+    order = 1 if after else -1
+    return (keyset_query(query, after or before, direction, field, tiebreak),
+            [(field, order), (tiebreak, order)])
+
+
+def keyset_result(docs, limit, after=None, field='timestamp', tiebreak='_id'):
+    """Trim the limit + 1 fetched documents into (docs, next_cursor, has_more)."""
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+
+    if after:
+        next_cursor = encode_cursor(docs[-1], field, tiebreak) if docs else after
+        docs.reverse()
+    else:
+        next_cursor = encode_cursor(docs[-1], field, tiebreak) if has_more else None
+    return docs, next_cursor, has_more
+
+
+def newest_cursor(docs, after=None, field='timestamp', tiebreak='_id'):
+    """
+    Cursor of the newest document on a page from keyset_result (pages come
+    back newest first either way), or after for an empty `after` page.
+
+    Unlike a `before` page's next_cursor it can always be passed as `after`
+    to poll for what arrives next.
+    """
+    return encode_cursor(docs[0], field, tiebreak) if docs else after
+
+
+def keyset_page(collection, query, before=None, after=None, limit=DEFAULT_PAGE_SIZE,
+                field='timestamp', projection=None, tiebreak='_id'):
+    """
+    Fetch one newest-first window of documents ordered by (field, tiebreak).
+
+    Without a cursor the newest page is returned. `before` pages back into
+    history and `after` fetches what arrived since a previously seen document.
+    Returns (docs, next_cursor, has_more). For `before` pages next_cursor is
+    None once history is exhausted; for `after` pages it always points at the
+    newest document seen so the client can keep polling forward.
+    """
+    filter_query, sort = keyset_find(query, before, after, field, tiebreak)
+    # Fetch one extra document to know whether another page exists
+    docs = list(collection.find(filter_query, projection).sort(sort).limit(limit + 1))
+    return keyset_result(docs, limit, after, field, tiebreak)
+
+
+async def keyset_page_async(collection, query, before=None, after=None, limit=DEFAULT_PAGE_SIZE,
+                            field='timestamp', projection=None, tiebreak='_id'):
+    """keyset_page for an async (motor) collection."""
+    filter_query, sort = keyset_find(query, before, after, field, tiebreak)
+    docs = await collection.find(filter_query, projection).sort(sort).limit(limit + 1).to_list(limit + 1)
+    return keyset_result(docs, limit, after, field, tiebreak)
@@ -0,0 +1,151 @@
+"""
+Presence (online / away / offline) and typing indicators.
+
+Clients send a heartbeat every PRESENCE_TTL / 2 seconds or so with their
+status ('online', or 'away' when idle). A user whose last heartbeat is older
+than PRESENCE_TTL (default 60) is offline; the last heartbeat is remembered
+for LAST_SEEN_TTL (default one day) so offline users still show when they
+were last seen. Typing is a flag per (user, conversation) that lapses after
+TYPING_TTL (default 6) unless refreshed. Conversations are named like pubsub
+channels: user_channel(receiver) for a direct conversation, group_channel(id)
+for a group.
+
+None of this touches MongoDB. Entries live in an expiring in-process map,
+or in Redis when PRESENCE_BACKEND=redis and REDIS_URL are set so that all
+workers see the same state. A heartbeat is one write, and a bulk lookup
+is one read per user (one MGET on Redis).
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+PRESENCE_TTL = float(os.getenv('PRESENCE_TTL', 60))
+LAST_SEEN_TTL = float(os.getenv('LAST_SEEN_TTL', 86400))
+TYPING_TTL = float(os.getenv('TYPING_TTL', 6))
+PRESENCE_MAX_ENTRIES = int(os.getenv('PRESENCE_MAX_ENTRIES', 100000))
+MAX_PRESENCE_QUERY = 500  # Users per bulk lookup
+
+ONLINE = 'online'
+AWAY = 'away'
+OFFLINE = 'offline'
+STATUSES = (ONLINE, AWAY, OFFLINE)
+
+
+class LocalPresenceStore:
+    """Thread-safe expiring map, bounded to max_entries by evicting the least recently written."""
+
+    def __init__(self, max_entries=PRESENCE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds; returns the previous live value or None."""
+        now = time.monotonic()
+        with self._lock:
+            previous = self._entries.get(key)
+            self._entries[key] = (now + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return previous[1] if previous is not None and previous[0] > now else None
+
+    def delete(self, key):
+        """Remove key; returns whether it was live."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            entries = [self._entries.get(key) for key in keys]
+        return [entry[1] if entry is not None and entry[0] > now else None for entry in entries]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisPresenceStore:
+    """Entries shared between workers, expired by Redis itself (requires redis)."""
+
+    def __init__(self, url, prefix='presence'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def set(self, key, value, ttl):
+        previous = self._redis.set(self._key(key), json.dumps(value), px=int(ttl * 1000), get=True)
+        return None if previous is None else json.loads(previous)
+
+    def delete(self, key):
+        return bool(self._redis.delete(self._key(key)))
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [None if raw is None else json.loads(raw) for raw in self._redis.mget([self._key(key) for key in keys])]
+
+    def clear(self):
+        for key in self._redis.scan_iter(f'{self.prefix}:*'):
+            self._redis.delete(key)
+
+
+def make_store():
+    if os.getenv('PRESENCE_BACKEND') == 'redis':
+        return RedisPresenceStore(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+    return LocalPresenceStore()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = make_store()
+    return _store
+
+
+def heartbeat(email, status=ONLINE):
+    """Record that email is active (or away, or signing off with 'offline')."""
+    get_store().set(f'seen:{email}', {'status': status, 'at': time.time()}, LAST_SEEN_TTL)
+
+
+def statuses(emails):
+    """{email: {'status', 'last_seen'}} for each email, from one bulk read."""
+    emails = list(dict.fromkeys(emails))
+    now = time.time()
+    result = {}
+    for email, entry in zip(emails, get_store().get_many([f'seen:{email}' for email in emails])):
+        if entry is None:
+            result[email] = {'status': OFFLINE, 'last_seen': None}
+            continue
+        status = entry['status'] if now - entry['at'] < PRESENCE_TTL else OFFLINE
+        result[email] = {'status': status, 'last_seen': datetime.utcfromtimestamp(entry['at'])}
+    return result
+
+
+def set_typing(email, conversation, typing=True):
+    """Start (or refresh) or stop email typing in conversation; returns True if the state changed."""
+    key = f'typing:{conversation}:{email}'
+    if typing:
+        return get_store().set(key, 1, TYPING_TTL) is None
+    return get_store().delete(key)
+
+
+def typing_in(conversation, emails):
+    """The subset of emails currently typing in conversation, in order."""
+    emails = list(dict.fromkeys(emails))
+    flags = get_store().get_many([f'typing:{conversation}:{email}' for email in emails])
+    return [email for email, flag in zip(emails, flags) if flag]
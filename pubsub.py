@@ -0,0 +1,185 @@
+"""
+Fan-out of new messages to push (SSE) subscribers.
+
+Messages are published as JSON strings on per-user channels (direct
+messages) and per-group channels. The default broker is in-process; set
+REDIS_URL to share events between workers, or call set_broker() with any
+object that has the same publish()/subscribe()/subscribe_async() interface.
+"""
+import asyncio
+import os
+import queue
+import threading
+from collections import defaultdict
+
+SUBSCRIPTION_BUFFER = 1000  # Undelivered events kept per subscriber before dropping
+
+
+def user_channel(email):
+    return f'user:{email}'
+
+
+def group_channel(group_id):
+    return f'group:{group_id}'
+
+
+class Subscription:
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = channels
+        self._queue = queue.Queue(maxsize=SUBSCRIPTION_BUFFER)
+
+    def deliver(self, payload):
+        try:
+            self._queue.put_nowait(payload)
+        except queue.Full:
+            pass  # Slow consumer; it can catch up through the paginated routes
+
+    def get(self, timeout=None):
+        """Return the next payload, or None if nothing arrived within timeout."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """Subscription for asyncio consumers; publishers may call deliver() from any thread."""
+
+    def __init__(self, broker, channels, loop):
+        super().__init__(broker, channels)
+        self._loop = loop
+        self._async_queue = asyncio.Queue(maxsize=SUBSCRIPTION_BUFFER)
+
+    def deliver(self, payload):
+        try:
+            self._loop.call_soon_threadsafe(self._put, payload)
+        except RuntimeError:
+            pass  # Event loop already closed
+
+    def _put(self, payload):
+        try:
+            self._async_queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self._async_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def aclose(self):
+        self.close()
+
+
+class InProcessBroker:
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def _register(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers[channel].add(subscription)
+        return subscription
+
+    def subscribe(self, channels):
+        return self._register(Subscription(self, list(channels)))
+
+    async def subscribe_async(self, channels):
+        return self._register(AsyncSubscription(self, list(channels), asyncio.get_running_loop()))
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def publish(self, channel, payload):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.deliver(payload)
+        return len(subscribers)
+
+
+class RedisSubscription:
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def get(self, timeout=None):
+        message = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout or 0)
+        if message is None:
+            return None
+        data = message['data']
+        return data.decode() if isinstance(data, bytes) else data
+
+    def close(self):
+        self._pubsub.close()
+
+
+class RedisAsyncSubscription:
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    async def get(self, timeout=None):
+        message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        if message is None:
+            return None
+        data = message['data']
+        return data.decode() if isinstance(data, bytes) else data
+
+    async def aclose(self):
+        await self._pubsub.aclose()
+
+
+class RedisBroker:
+    """Shares events across processes through Redis pub/sub (requires the redis package)."""
+
+    def __init__(self, url):
+        import redis
+        self.url = url
+        self._redis = redis.Redis.from_url(url)
+        self._async_redis = None
+
+    def subscribe(self, channels):
+        pubsub = self._redis.pubsub()
+        pubsub.subscribe(*channels)
+        return RedisSubscription(pubsub)
+
+    async def subscribe_async(self, channels):
+        if self._async_redis is None:
+            import redis.asyncio
+            self._async_redis = redis.asyncio.Redis.from_url(self.url)
+        pubsub = self._async_redis.pubsub()
+        await pubsub.subscribe(*channels)
+        return RedisAsyncSubscription(pubsub)
+
+    def publish(self, channel, payload):
+        return self._redis.publish(channel, payload)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                redis_url = os.getenv('REDIS_URL')
+                _broker = RedisBroker(redis_url) if redis_url else InProcessBroker()
+    return _broker
+
+
+def set_broker(broker):
+    global _broker
+    _broker = broker
@@ -0,0 +1,196 @@
+"""
+Token-bucket rate limits for routes that send mail or write messages.
+
+Each route has rules keyed by client IP or by a field of the JSON body
+(email, phone, SMS numbers, sender). A bucket holds up to `count` tokens
+and refills at count/period per second; a request takes one token from
+every matching bucket and is rejected with 429 if any bucket is empty.
+Checks run before the route touches the database or SMTP.
+
+Buckets live in an in-process LRU (O(1) per check, idle buckets expire
+once they would be full again), or in Redis when RATE_LIMIT_BACKEND=redis
+and REDIS_URL are set so that all workers share them. Override a limit
+with e.g. RATE_LIMIT_SIGNUP_EMAIL=5/3600; RATE_LIMIT_ENABLED=0 turns
+limiting off.
+"""
+import functools
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify, request
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv('RATE_LIMIT_MAX_BUCKETS', 100000))
+
+
+class Limit:
+    def __init__(self, count, period):
+        self.capacity = float(count)
+        self.period = float(period)
+        self.rate = self.capacity / self.period  # Tokens per second
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse 'count/seconds', e.g. '10/60'."""
+        count, period = spec.split('/')
+        return cls(int(count), float(period))
+
+
+def _limit(name, default):
+    return Limit.parse(os.getenv(f'RATE_LIMIT_{name.upper()}', default))
+
+
+# route -> [(key, limit)]; 'ip' is the client address, anything else a JSON body field
+RULES = {
+    'signup': [('ip', _limit('signup_ip', '10/3600')), ('email', _limit('signup_email', '3/3600')),
+               ('phone', _limit('signup_phone', '3/3600'))],
+    'verify_otp': [('ip', _limit('verify_otp_ip', '30/900')), ('email', _limit('verify_otp_email', '5/900'))],
+    'resend_otp': [('ip', _limit('resend_otp_ip', '10/3600')), ('email', _limit('resend_otp_email', '3/900'))],
+    'send_sms': [('ip', _limit('send_sms_ip', '20/60')), ('numbers', _limit('send_sms_number', '5/3600'))],
+    'send_message': [('ip', _limit('send_message_ip', '120/60')), ('sender', _limit('send_message_sender', '60/60'))],
+    'send_messages': [('ip', _limit('send_messages_ip', '20/60')),
+                      ('sender', _limit('send_messages_sender', '10/60'))],
+    'send_group_message': [('ip', _limit('send_group_message_ip', '120/60')),
+                           ('sender', _limit('send_group_message_sender', '60/60'))],
+    'upload_attachment': [('ip', _limit('upload_attachment_ip', '60/60')),
+                          ('email', _limit('upload_attachment_email', '30/60'))],
+}
+
+
+class LocalBucketStore:
+    """Thread-safe in-process buckets: key -> (tokens, updated_at, full_at)."""
+
+    blocking = False
+
+    def __init__(self, max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, limit):
+        """Take a token; return 0 if allowed, else seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = limit.capacity if bucket is None else min(limit.capacity,
+                                                                bucket[0] + (now - bucket[1]) * limit.rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / limit.rate
+            self._buckets[key] = (tokens, now, now + (limit.capacity - tokens) / limit.rate)
+            self._buckets.move_to_end(key)
+
+            # A bucket that has refilled is the same as no bucket; drop those from the LRU end
+            while self._buckets:
+                oldest = next(iter(self._buckets.values()))
+                if oldest[2] > now and len(self._buckets) <= self.max_buckets:
+                    break
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# KEYS[1] bucket; ARGV capacity, rate. Uses the server clock so workers agree.
+_REDIS_TAKE = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+
+class RedisBucketStore:
+    """Buckets shared between workers, updated atomically by a Lua script (requires redis)."""
+
+    blocking = True
+
+    def __init__(self, url, prefix='ratelimit'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(_REDIS_TAKE)
+        self.prefix = prefix
+
+    def take(self, key, limit):
+        return float(self._take(keys=[f'{self.prefix}:{key}'], args=[limit.capacity, limit.rate]))
+
+    def clear(self):
+        for key in self._redis.scan_iter(f'{self.prefix}:*'):
+            self._redis.delete(key)
+
+
+def make_store():
+    if os.getenv('RATE_LIMIT_BACKEND') == 'redis':
+        return RedisBucketStore(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+    return LocalBucketStore()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = make_store()
+    return _store
+
+
+def _values(data, field):
+    value = data.get(field) if isinstance(data, dict) else None
+    values = value if isinstance(value, list) else [value]
+    return [str(v).strip().lower() for v in values if v]
+
+
+def check(route, ip, data):
+    """Apply the route's rules; return 0 if allowed, else the longest Retry-After in seconds."""
+    if not RATE_LIMIT_ENABLED:
+        return 0
+    store = get_store()
+    retry_after = 0
+    for field, limit in RULES.get(route, ()):
+        for value in ([ip] if field == 'ip' else _values(data, field)):
+            if value:
+                retry_after = max(retry_after, store.take(f'{route}:{field}:{value}', limit))
+    return retry_after
+
+
+def too_many_requests(retry_after):
+    response = jsonify({'error': 'Too many requests. Try again later.', 'retry_after': math.ceil(retry_after)})
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response, 429
+
+
+def rate_limited(route):
+    """Decorator for Flask views: reject with 429 before the view runs."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            retry_after = check(route, request.remote_addr, request.get_json(silent=True))
+            if retry_after:
+                return too_many_requests(retry_after)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,44 @@
+"""
+Per-user read high-water marks for group conversations.
+
+Groups have no per-message isRead flag; instead each member has one
+read_cursors document per group holding the newest message id they have
+read. Unread counts are an indexed count of group messages past that id.
+"""
+from datetime import datetime
+
+# Unread counts stop at this many; clients show it as "99+"-style
+UNREAD_COUNT_CAP = 100
+
+
+def group_conversation(group_id):
+    return f'group:{group_id}'
+
+
+def advance(collection, user, conversation, message_id):
+    """Move the user's read mark forward to message_id (never backwards)."""
+    collection.update_one(
+        {'user': user, 'conversation': conversation},
+        {'$max': {'last_read_id': message_id}, '$set': {'updated_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+
+def last_read_ids(collection, user, conversations):
+    """Return {conversation: last_read_id} for the given conversations in one query."""
+    cursors = collection.find({'user': user, 'conversation': {'$in': list(conversations)}},
+                              {'conversation': 1, 'last_read_id': 1})
+    return {cursor['conversation']: cursor['last_read_id'] for cursor in cursors}
+
+
+def group_unread_counts(read_cursors_collection, group_messages_collection, user, group_ids):
+    """Return {group_id: unread count (capped)} for the user's groups."""
+    marks = last_read_ids(read_cursors_collection, user, [group_conversation(g) for g in group_ids])
+    counts = {}
+    for group_id in group_ids:
+        query = {'group_id': group_id}
+        mark = marks.get(group_conversation(group_id))
+        if mark is not None:
+            query['_id'] = {'$gt': mark}
+        counts[str(group_id)] = group_messages_collection.count_documents(query, limit=UNREAD_COUNT_CAP)
+    return counts
@@ -0,0 +1,69 @@
+"""
+Full-text search over a user's direct and group messages.
+
+Both message collections carry a MongoDB text index on `message` (see
+indexes.py), so new messages are searchable as soon as they are stored.
+A search runs one text query per collection, restricted to the caller's
+conversations (direct messages they sent or received, messages in groups
+they belong to), and merges the two by relevance. Pages are keyset
+paginated on (score, _id), newest first among equal scores, with an
+opaque cursor.
+"""
+from bson import ObjectId
+
+from pagination import InvalidCursor, decode_token, encode_token
+
+MAX_QUERY_LENGTH = 200
+
+DIRECT_FIELDS = {'_id': 1, 'sender': 1, 'receiver': 1, 'message': 1, 'timestamp': 1, 'isRead': 1, 'score': 1}
+GROUP_FIELDS = {'_id': 1, 'group_id': 1, 'sender': 1, 'message': 1, 'timestamp': 1, 'score': 1}
+
+
+def _decode_cursor(cursor):
+    state = decode_token(cursor)
+    try:
+        return float(state['s']), ObjectId(state['id'])
+    except Exception:
+        raise InvalidCursor('Invalid cursor.')
+
+
+def _ranked(collection, query, scope, fields, after, limit):
+    """Text matches within scope, best first, past the (score, _id) position `after`."""
+    pipeline = [
+        {'$match': {'$text': {'$search': query}, **scope}},
+        {'$addFields': {'score': {'$meta': 'textScore'}}},
+    ]
+    if after is not None:
+        score, last_id = after
+        pipeline.append({'$match': {'$or': [{'score': {'$lt': score}},
+                                            {'score': score, '_id': {'$lt': last_id}}]}})
+    pipeline += [
+        {'$sort': {'score': -1, '_id': -1}},
+        {'$limit': limit + 1},
+        {'$project': fields},
+    ]
+    return list(collection.aggregate(pipeline))
+
+
+def search_messages(messages_collection, group_messages_collection, user, group_ids, query, cursor=None, limit=20):
+    """
+    Return (results, next_cursor, has_more) for `query` across the user's
+    direct messages and the given groups. Each result has a 'type' of
+    'direct' or 'group' and its relevance 'score'.
+    """
+    after = _decode_cursor(cursor) if cursor else None
+
+    results = [dict(doc, type='direct') for doc in _ranked(
+        messages_collection, query, {'$or': [{'sender': user}, {'receiver': user}]}, DIRECT_FIELDS, after, limit)]
+    if group_ids:
+        results += [dict(doc, type='group') for doc in _ranked(
+            group_messages_collection, query, {'group_id': {'$in': list(group_ids)}}, GROUP_FIELDS, after, limit)]
+
+    results.sort(key=lambda doc: (doc['score'], doc['_id']), reverse=True)
+    has_more = len(results) > limit
+    results = results[:limit]
+    next_cursor = None
+    if has_more and results:
+        last = results[-1]
+        next_cursor = encode_token({'s': last['score'], 'id': str(last['_id'])})
+    return results, next_cursor, has_more
@@ -0,0 +1,144 @@
+"""
+Response encoding: a JSON provider that understands BSON types, optional
+MessagePack, and gzip/brotli compression.
+
+install(app) replaces the Flask JSON provider with FastJSONProvider, which
+encodes ObjectId as its hex string and datetimes in Flask's usual HTTP-date
+format, so routes can hand Mongo documents to jsonify() without fixing them
+up first. It uses orjson when installed and the standard library otherwise.
+respond() encodes a payload as MessagePack instead when the client sends
+`Accept: application/msgpack` (requires msgpack). Responses of at least
+COMPRESS_MIN_BYTES are compressed with br (requires brotli) or gzip,
+following Accept-Encoding. The negotiation helpers take parsed headers so
+asgi.py's native routes share them.
+"""
+import gzip
+import os
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from flask import Response, current_app, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COMPRESSIBLE_TYPES = ('application/json', 'application/msgpack', 'text/plain')
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return http_date(value)
+    return DefaultJSONProvider.default(value)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """DefaultJSONProvider output (sorted keys, HTTP dates) plus ObjectId, encoded by orjson when available."""
+
+    default = staticmethod(_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                            | orjson.OPT_NON_STR_KEYS).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is None or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        return self._app.response_class(self.dumps(obj) + '\n', mimetype=self.mimetype)
+
+
+def _msgpack_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        # Stored datetimes are naive UTC
+        return msgpack.Timestamp.from_datetime(value if value.tzinfo else value.replace(tzinfo=timezone.utc))
+    raise TypeError(f'Object of type {type(value).__name__} is not MessagePack serializable')
+
+
+def wants_msgpack(accept_mimetypes=None):
+    """Whether the client prefers MessagePack; accept_mimetypes defaults to the Flask request's."""
+    if msgpack is None:
+        return False
+    if accept_mimetypes is None:
+        accept_mimetypes = request.accept_mimetypes
+    best = accept_mimetypes.best_match(('application/json',) + MSGPACK_TYPES)
+    return best in MSGPACK_TYPES
+
+
+def pack(payload):
+    return msgpack.packb(payload, default=_msgpack_default)
+
+
+def respond(payload):
+    """Encode payload as MessagePack or JSON, whichever the client prefers."""
+    if wants_msgpack():
+        response = Response(pack(payload), mimetype='application/msgpack')
+    else:
+        response = current_app.json.response(payload)
+    response.vary.add('Accept')
+    return response
+
+
+def choose_encoding(accept_encodings=None):
+    """br, gzip or None for the client's Accept-Encoding; accept_encodings defaults to the Flask request's."""
+    if accept_encodings is None:
+        accept_encodings = request.accept_encodings
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compress_response(response):
+    """after_request hook: compress buffered, compressible responses the client can decode."""
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.content_length or 0) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def install(app):
+    app.json = FastJSONProvider(app)
+    app.after_request(compress_response)
+    return app
@@ -0,0 +1,146 @@
+"""
+Per-user conversation summaries backing the inbox (/get_user_conversations).
+
+One document per (owner, partner), stamped with their company, holds the
+latest message snippet, its timestamp and the owner's unread count. send_message and mark_as_read keep
+it current; rebuild it from the messages collection with
+
+    python summaries.py --rebuild
+"""
+import argparse
+import os
+import sys
+
+from pymongo import ReplaceOne, UpdateOne
+
+from tenancy import TENANT_FIELD
+
+SNIPPET_LENGTH = 100
+REBUILD_BATCH_SIZE = 1000
+
+
+def _last_message_fields(message):
+    return {
+        'last_message': message['message'][:SNIPPET_LENGTH],
+        'last_sender': message['sender'],
+        'last_timestamp': message['timestamp'],
+        'last_message_id': message['_id'],
+    }
+
+
+def _older_than(message):
+    """Match a summary whose last message sorts before `message` on (timestamp, _id)."""
+    return {'$or': [
+        {'last_timestamp': {'$lt': message['timestamp']}},
+        {'last_timestamp': message['timestamp'], 'last_message_id': {'$lt': message['_id']}},
+    ]}
+
+
+def record_message_ops(message):
+    """Return the summary upserts for a newly stored direct message.
+
+    The last_* fields only move forward, so a message with an older timestamp than the
+    summary's still counts as unread but does not replace the newer snippet.
+    """
+    sender, receiver = message['sender'], message['receiver']
+    last = _last_message_fields(message)
+    keys = [({'owner': sender, 'partner': receiver}, 0)]
+    if sender != receiver:
+        keys.append(({'owner': receiver, 'partner': sender}, 1))
+    ops = []
+    for key, unread in keys:
+        ops.append(UpdateOne(key, {'$setOnInsert': last, '$inc': {'unread_count': unread}}, upsert=True))
+        ops.append(UpdateOne({**key, **_older_than(message)}, {'$set': last}))
+    return ops
+
+
+def record_message(collection, message):
+    """Update both participants' summaries for a newly stored direct message."""
+    collection.bulk_write(record_message_ops(message), ordered=False)
+
+
+def mark_read(collection, owner, partner, count=None):
+    """Take `count` messages off the owner's unread count, or clear it when count is None."""
+    key = {'owner': owner, 'partner': partner}
+    if count is None:
+        collection.update_one(key, {'$set': {'unread_count': 0}})
+    elif count:
+        result = collection.update_one({**key, 'unread_count': {'$gte': count}}, {'$inc': {'unread_count': -count}})
+        if result.matched_count == 0:
+            # Never let a drifted counter go negative
+            collection.update_one(key, {'$set': {'unread_count': 0}})
+
+
+async def mark_read_async(collection, owner, partner, count=None):
+    """mark_read for an async (motor) collection."""
+    key = {'owner': owner, 'partner': partner}
+    if count is None:
+        await collection.update_one(key, {'$set': {'unread_count': 0}})
+    elif count:
+        result = await collection.update_one({**key, 'unread_count': {'$gte': count}},
+                                             {'$inc': {'unread_count': -count}})
+        if result.matched_count == 0:
+            await collection.update_one(key, {'$set': {'unread_count': 0}})
+
+
+def rebuild(messages_collection, conversations_collection):
+    """Recompute every summary from the messages collection. Returns the number written."""
+    received = {'$eq': ['$role', 'received']}
+    pipeline = [
+        # Each message counts once for its sender and once for its receiver
+        {'$project': {'message': 1, 'sender': 1, 'receiver': 1, 'timestamp': 1, 'isRead': 1, TENANT_FIELD: 1,
+                      'role': {'$literal': ['sent', 'received']}}},
+        {'$unwind': '$role'},
+        {'$project': {
+            'message': 1, 'sender': 1, 'timestamp': 1, TENANT_FIELD: 1,
+            'owner': {'$cond': [received, '$receiver', '$sender']},
+            'partner': {'$cond': [received, '$sender', '$receiver']},
+            'unread': {'$cond': [{'$and': [received, {'$eq': ['$isRead', False]}]}, 1, 0]},
+        }},
+        {'$sort': {'timestamp': -1, '_id': -1}},
+        {'$group': {
+            '_id': {TENANT_FIELD: f'${TENANT_FIELD}', 'owner': '$owner', 'partner': '$partner'},
+            'last_message': {'$first': '$message'},
+            'last_sender': {'$first': '$sender'},
+            'last_timestamp': {'$first': '$timestamp'},
+            'last_message_id': {'$first': '$_id'},
+            'unread_count': {'$sum': '$unread'},
+        }},
+    ]
+
+    written = 0
+    batch = []
+    for row in messages_collection.aggregate(pipeline, allowDiskUse=True):
+        key = row.pop('_id')
+        row['last_message'] = row['last_message'][:SNIPPET_LENGTH]
+        batch.append(ReplaceOne(key, {**key, **row}, upsert=True))
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            conversations_collection.bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch = []
+    if batch:
+        conversations_collection.bulk_write(batch, ordered=False)
+        written += len(batch)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain conversation summaries.')
+    parser.add_argument('--uri', default=None, help='MongoDB URI (defaults to MONGO_URI)')
+    parser.add_argument('--rebuild', action='store_true', help='recompute all summaries from messages')
+    args = parser.parse_args(argv)
+    if not args.rebuild:
+        parser.print_help()
+        return 1
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    load_dotenv()
+
+    db = MongoClient(args.uri or os.getenv('MONGO_URI'))[os.getenv('MONGO_DB_NAME', 'InOfficeMessaging')]
+    print(f"Rebuilt {rebuild(db.messages, db.conversations)} conversation summaries.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+"""
+Company-scoped (multi-tenant) storage.
+
+    python tenancy.py --backfill                       # stamp company_name on existing documents
+    python tenancy.py --shard                          # shard the tenant collections on company-prefixed keys
+    python tenancy.py --zone eu --company Acme         # pin one company's key ranges to a shard zone
+    python tenancy.py --drop-legacy-indexes            # after indexes.py and --backfill: drop pre-tenancy indexes
+
+Users already carry company_name. Messages, groups, group messages and the
+documents derived from them (memberships, conversation summaries, read
+marks, inbox entries, archive buckets) carry it too, and every compound
+index on them starts with it (see indexes.py). Routes read and write these
+collections through scope(collection, company): the company is added to
+every filter and stamped on every new document, so each query is an index
+range inside one tenant and costs what that tenant's data costs, however
+large the deployment grows.
+
+Routing: a company named in TENANT_DATABASES (a JSON object, e.g.
+{"Acme": "acme_messaging"}) gets its own database on the same cluster;
+everyone else shares the default one. On a sharded cluster, --shard keys
+the collections on (company_name, ...) so each tenant's documents sit in
+their own chunk ranges, and --zone pins a tenant's ranges to a zone.
+
+Direct messages stay within a company: both participants are users of the
+same company, or the message belongs to the one that is registered.
+Groups belong to the company they were created in. Users, signup codes
+and attachments are shared and stay unscoped.
+"""
+import argparse
+import json
+import os
+import sys
+
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+
+TENANT_FIELD = 'company_name'
+
+# company -> name of its dedicated database
+TENANT_DATABASES = json.loads(os.getenv('TENANT_DATABASES') or '{}')
+
+# Shard key per tenant collection; each one is a prefix of an index in indexes.py
+SHARD_KEYS = {
+    'messages': [(TENANT_FIELD, 1), ('sender', 1)],
+    'conversations': [(TENANT_FIELD, 1), ('owner', 1)],
+    'read_cursors': [(TENANT_FIELD, 1), ('user', 1)],
+    'group_inbox': [(TENANT_FIELD, 1), ('member', 1)],
+    'group_members': [(TENANT_FIELD, 1), ('group_id', 1)],
+    'group_messages': [(TENANT_FIELD, 1), ('group_id', 1)],
+    'message_archive': [(TENANT_FIELD, 1), ('conversation', 1)],
+    'group_message_archive': [(TENANT_FIELD, 1), ('group_id', 1)],
+}
+TENANT_COLLECTIONS = tuple(SHARD_KEYS)
+BACKFILL_BATCH_SIZE = 1000
+
+
+def routed(collection, company):
+    """The collection itself, or its namesake in the company's dedicated database."""
+    database_name = TENANT_DATABASES.get(company)
+    if not database_name:
+        return collection
+    return collection.database.client[database_name][collection.name]
+
+
+class Scoped:
+    """
+    A collection as one company sees it (sync or motor alike).
+
+    Only the operations the app uses are exposed, so nothing reaches the
+    underlying collection without the company in its filter.
+    """
+
+    def __init__(self, collection, company):
+        self.collection = routed(collection, company)
+        self.company = company
+
+    @property
+    def name(self):
+        return self.collection.name
+
+    def _filter(self, filter=None):
+        return {**(filter or {}), TENANT_FIELD: self.company}
+
+    def _stamp(self, document):
+        # Stamped in place, like insert_one sets _id, so callers see the stored document
+        document[TENANT_FIELD] = self.company
+        return document
+
+    def _request(self, request):
+        # Rebuilt from pymongo's request attributes; the app's bulk writes only use filter, document and upsert
+        if isinstance(request, InsertOne):
+            return InsertOne(self._stamp(request._doc))
+        if isinstance(request, ReplaceOne):
+            return ReplaceOne(self._filter(request._filter), self._stamp(request._doc), upsert=request._upsert)
+        if isinstance(request, (UpdateOne, UpdateMany)):
+            return type(request)(self._filter(request._filter), request._doc, upsert=request._upsert)
+        if isinstance(request, (DeleteOne, DeleteMany)):
+            return type(request)(self._filter(request._filter))
+        raise TypeError(f'Unsupported bulk write request: {request!r}')
+
+    def find(self, filter=None, *args, **kwargs):
+        return self.collection.find(self._filter(filter), *args, **kwargs)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        return self.collection.find_one(self._filter(filter), *args, **kwargs)
+
+    def count_documents(self, filter, **kwargs):
+        return self.collection.count_documents(self._filter(filter), **kwargs)
+
+    def distinct(self, key, filter=None, **kwargs):
+        return self.collection.distinct(key, self._filter(filter), **kwargs)
+
+    def aggregate(self, pipeline, **kwargs):
+        pipeline = list(pipeline)
+        # Merged into a leading $match so a $text stage stays first
+        if pipeline and '$match' in pipeline[0]:
+            pipeline[0] = {'$match': self._filter(pipeline[0]['$match'])}
+        else:
+            pipeline.insert(0, {'$match': self._filter()})
+        return self.collection.aggregate(pipeline, **kwargs)
+
+    def insert_one(self, document, **kwargs):
+        return self.collection.insert_one(self._stamp(document), **kwargs)
+
+    def insert_many(self, documents, **kwargs):
+        return self.collection.insert_many([self._stamp(document) for document in documents], **kwargs)
+
+    def replace_one(self, filter, replacement, **kwargs):
+        return self.collection.replace_one(self._filter(filter), self._stamp(replacement), **kwargs)
+
+    # Upserts need no stamping: MongoDB copies the filter's company_name into the new document
+    def update_one(self, filter, update, **kwargs):
+        return self.collection.update_one(self._filter(filter), update, **kwargs)
+
+    def update_many(self, filter, update, **kwargs):
+        return self.collection.update_many(self._filter(filter), update, **kwargs)
+
+    def find_one_and_update(self, filter, update, **kwargs):
+        return self.collection.find_one_and_update(self._filter(filter), update, **kwargs)
+
+    def find_one_and_delete(self, filter, **kwargs):
+        return self.collection.find_one_and_delete(self._filter(filter), **kwargs)
+
+    def delete_one(self, filter, **kwargs):
+        return self.collection.delete_one(self._filter(filter), **kwargs)
+
+    def delete_many(self, filter, **kwargs):
+        return self.collection.delete_many(self._filter(filter), **kwargs)
+
+    def bulk_write(self, requests, **kwargs):
+        return self.collection.bulk_write([self._request(request) for request in requests], **kwargs)
+
+
+def scope(collection, company):
+    return Scoped(collection, company)
+
+
+def companies(collection):
+    """Every company with documents in collection, None for unstamped ones, and those with their own database."""
+    found = set(collection.distinct(TENANT_FIELD)) | set(TENANT_DATABASES) | {None}
+    return [None] + sorted(company for company in found if company is not None)
+
+
+def _chunks(items, size=BACKFILL_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def backfill(db):
+    """Stamp company_name on documents written before tenancy; safe to rerun. Returns counts per collection."""
+    unstamped = {TENANT_FIELD: {'$exists': False}}
+    stamped = {name: 0 for name in ('groups',) + TENANT_COLLECTIONS}
+
+    def stamp(collection_name, query, company):
+        result = db[collection_name].update_many({**query, **unstamped}, {'$set': {TENANT_FIELD: company}})
+        stamped[collection_name] += result.modified_count
+
+    company_of = {user['email']: user.get('company_name')
+                  for user in db.users.find({}, {'_id': 0, 'email': 1, 'company_name': 1})}
+    by_company = {}
+    for email, company in company_of.items():
+        if company:
+            by_company.setdefault(company, []).append(email)
+
+    # Per-user documents: a direct message belongs to its sender's company, else its receiver's
+    for company, emails in by_company.items():
+        for batch in _chunks(emails):
+            stamp('messages', {'sender': {'$in': batch}}, company)
+            stamp('conversations', {'owner': {'$in': batch}}, company)
+            stamp('read_cursors', {'user': {'$in': batch}}, company)
+    for company, emails in by_company.items():
+        for batch in _chunks(emails):
+            stamp('messages', {'receiver': {'$in': batch}}, company)
+            stamp('conversations', {'partner': {'$in': batch}}, company)
+
+    for bucket in db.message_archive.find(unstamped, {'conversation': 1}):
+        company = next(filter(None, map(company_of.get, bucket['conversation'].split('\n'))), None)
+        if company:
+            stamp('message_archive', {'_id': bucket['_id']}, company)
+
+    # A group belongs to the company of its registered members, and everything in it follows
+    for group in db.groups.find(unstamped, {'_id': 1}):
+        company = None
+        for member in db.group_members.find({'group_id': group['_id']}, {'_id': 0, 'member': 1}):
+            company = company_of.get(member['member'])
+            if company:
+                break
+        if not company:
+            continue
+        stamp('groups', {'_id': group['_id']}, company)
+        for name in ('group_members', 'group_messages', 'group_inbox', 'group_message_archive'):
+            stamp(name, {'group_id': group['_id']}, company)
+    return stamped
+
+
+def shard(client, database_name):
+    """Enable sharding on the database and shard each tenant collection on its company-prefixed key."""
+    from bson import SON
+    client.admin.command('enableSharding', database_name)
+    for name, key in SHARD_KEYS.items():
+        client.admin.command('shardCollection', f'{database_name}.{name}', key=SON(key))
+
+
+def pin(client, database_name, company, zone, shard_name=None):
+    """Route every key range of one company to a zone (optionally adding a shard to it first)."""
+    from bson import SON
+    from bson.max_key import MaxKey
+    from bson.min_key import MinKey
+    if shard_name:
+        client.admin.command('addShardToZone', shard_name, zone=zone)
+    for name, key in SHARD_KEYS.items():
+        fields = [field for field, _ in key[1:]]
+        client.admin.command(
+            'updateZoneKeyRange', f'{database_name}.{name}',
+            min=SON([(TENANT_FIELD, company)] + [(field, MinKey()) for field in fields]),
+            max=SON([(TENANT_FIELD, company)] + [(field, MaxKey()) for field in fields]),
+            zone=zone,
+        )
+
+
+def drop_legacy_indexes(db):
+    """Drop indexes on the tenant collections that indexes.py no longer declares. Returns their names."""
+    from indexes import INDEXES
+    dropped = []
+    for name in TENANT_COLLECTIONS:
+        declared = {model.document['name'] for model in INDEXES[name]} | {'_id_'}
+        for index in db[name].list_indexes():
+            if index['name'] not in declared:
+                db[name].drop_index(index['name'])
+                dropped.append(f"{name}.{index['name']}")
+    return dropped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain company-scoped (multi-tenant) storage.')
+    parser.add_argument('--uri', default=None, help='MongoDB URI (defaults to MONGO_URI)')
+    parser.add_argument('--backfill', action='store_true', help='stamp company_name on existing documents')
+    parser.add_argument('--shard', action='store_true', help='shard the tenant collections by company')
+    parser.add_argument('--zone', default=None, help='pin --company to this shard zone')
+    parser.add_argument('--company', default=None, help='company for --zone')
+    parser.add_argument('--shard-name', default=None, help='shard to add to --zone first')
+    parser.add_argument('--drop-legacy-indexes', action='store_true',
+                        help='drop tenant collection indexes that are not company-first')
+    args = parser.parse_args(argv)
+    if not (args.backfill or args.shard or args.zone or args.drop_legacy_indexes):
+        parser.print_help()
+        return 1
+    if args.zone and not args.company:
+        parser.error('--zone requires --company')
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    load_dotenv()
+
+    client = MongoClient(args.uri or os.getenv('MONGO_URI'))
+    database_name = os.getenv('MONGO_DB_NAME', 'InOfficeMessaging')
+    db = client[database_name]
+    if args.backfill:
+        for name, count in backfill(db).items():
+            print(f"{name}: stamped {count} documents")
+    if args.drop_legacy_indexes:
+        for database in [db] + [client[name] for name in sorted(set(TENANT_DATABASES.values()))]:
+            print(f"{database.name}: dropped {', '.join(drop_legacy_indexes(database)) or 'nothing'}")
+    if args.shard:
+        for name in [database_name] + sorted(set(TENANT_DATABASES.values())):
+            shard(client, name)
+            print(f"{name}: sharded {', '.join(SHARD_KEYS)}")
+    if args.zone:
+        pin(client, TENANT_DATABASES.get(args.company, database_name), args.company, args.zone, args.shard_name)
+        print(f"{args.company}: pinned to zone {args.zone}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())